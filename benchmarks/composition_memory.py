@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compares the memory allocated for a composition by each backend."""
+
+import json
+import tracemalloc
+
+from flatehr.factory import composition_factory, template_factory
+
+
+def main(
+    *,
+    template_file: str = "tests/resources/web_template.json",
+    path: str = "test/histopathology/result_group/laboratory_test_result/any_event",
+    leaf: str = "test_name",
+    occurrences: int = 1000,
+):
+    """Prints the memory allocated by each backend for a composition with
+    the given number of occurrences of path, each one with a leaf.
+
+    :param template_file: web template path
+    :param path: multiple cardinality path
+    :param leaf: leaf below path
+    :param occurrences: number of occurrences of path
+    """
+    with open(template_file, "r") as f_obj:
+        web_template = json.load(f_obj)
+
+    for backend in composition_factory.backends():
+        template = template_factory(backend, web_template).get()
+        tracemalloc.start()
+        composition = composition_factory(backend, template).get()
+        for _ in range(occurrences):
+            composition.add(path)
+            composition[f"{path}/{leaf}"] = None
+        allocated, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(
+            f"{backend:<10} {allocated / 1024:10.1f} KiB,"
+            f" {allocated / (2 * occurrences):8.1f} B/node"
+        )
+
+
+if __name__ == "__main__":
+    import defopt
+
+    defopt.run(main)
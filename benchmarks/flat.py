@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Times the serialization of a composition with many leaves."""
+
+import json
+import timeit
+
+from flatehr.core import flat, structured
+from flatehr.factory import composition_factory, template_factory
+
+
+def main(
+    *,
+    template_file: str = "tests/resources/web_template.json",
+    path: str = "test/histopathology/result_group/laboratory_test_result/any_event",
+    instances: int = 5000,
+    number: int = 10,
+):
+    """Prints the time for flat(), structured() and json.dumps() for each backend.
+
+    :param template_file: web template path
+    :param path: multiple cardinality node, whose leaves are set for every instance
+    :param instances: number of instances of path
+    :param number: number of serializations for each run
+    """
+    with open(template_file, "r") as f_obj:
+        web_template = json.load(f_obj)
+
+    for backend in template_factory.backends():
+        template = template_factory(backend, web_template).get()
+        composition = composition_factory(backend, template).get()
+        leaves = [str(leaf) for leaf in template[path].leaves]
+        for i in range(instances):
+            composition.add(path)
+            for leaf in leaves:
+                composition[leaf] = {"": f"value-{i}", "|code": "code"}
+
+        n_leaves = len(flat(composition))
+        for label, func in (
+            ("flat", lambda: flat(composition)),
+            ("flat + json", lambda: json.dumps(flat(composition))),
+            ("structured", lambda: structured(composition)),
+            ("structured + json", lambda: json.dumps(structured(composition))),
+        ):
+            elapsed = min(timeit.repeat(func, number=number, repeat=3))
+            print(
+                f"{backend:<8} {label:<18} {elapsed / number * 1e3:8.1f} ms"
+                f" ({n_leaves} values)"
+            )
+
+
+if __name__ == "__main__":
+    import defopt
+
+    defopt.run(main)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compares JSONPath expressions parsed on every iteration
+(the behaviour before compile_path) against the process-wide cache."""
+
+import json
+import re
+import timeit
+
+from jsonpath_ng.ext import parse
+
+from flatehr.sources import json as json_source
+from flatehr.sources.json import DocumentSource
+
+
+def main(
+    *,
+    input_file: str = "tests/resources/source.json",
+    n_paths: int = 200,
+    number: int = 20,
+):
+    """Prints the time per source iteration with n_paths mapped paths.
+
+    :param input_file: json source
+    :param n_paths: number of mapped paths
+    :param number: number of iterations for each run
+    """
+    with open(input_file, "r") as f_obj:
+        data = f_obj.read()
+    document = json.loads(data)
+    elements = sorted(set(re.findall(r'"(Dataelement_\w+)"', data)))
+    templates = (
+        "$..{}.'#text'",
+        "$..{}.@name",
+        "$..Event[?(@.@eventtype == Sample)]..{}.'#text'",
+        "$..Form..{}",
+        "$.BHImport..{}.'#text'",
+    )
+    paths = [
+        template.format(element) for template in templates for element in elements
+    ][:n_paths]
+
+    source = DocumentSource(document, paths)
+
+    def _iter(cached: bool):
+        if not cached:
+            json_source.compile_path.cache_clear()
+        list(source.iter())
+
+    for label, func in (
+        ("parse per iter", lambda: _iter(False)),
+        ("cached", lambda: _iter(True)),
+        ("parse only", lambda: [parse(path) for path in paths]),
+    ):
+        elapsed = min(timeit.repeat(func, number=number, repeat=3))
+        print(f"{label:<15} {elapsed / number * 1e3:10.1f} ms/iter ({len(paths)} paths)")
+
+
+if __name__ == "__main__":
+    import defopt
+
+    defopt.run(main)
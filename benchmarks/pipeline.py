@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Times each stage of the generation of compositions from synthetic sources
+(see synthetic.py): template loading, source evaluation, building,
+setting of the missing required defaults and serialization."""
+
+import io
+import json
+import time
+from typing import Callable, Dict, List, Optional
+
+from synthetic import conf, json_source, web_template, xml_source
+
+from flatehr.build import Config, build_composition
+from flatehr.core import flat
+from flatehr.factory import template_factory
+from flatehr.sources.json import StreamingJsonPathSource
+from flatehr.sources.xml import XPathSource
+
+
+def _time(func: Callable, setup: Optional[Callable] = None, repeat: int = 3) -> float:
+    """Returns the best elapsed time of func(setup())."""
+    elapsed = []
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        start = time.perf_counter()
+        func(*args)
+        elapsed.append(time.perf_counter() - start)
+    return min(elapsed)
+
+
+def _xml_sources(source: str, paths: List[str]) -> List[List]:
+    xpath_source = XPathSource(io.StringIO(source), paths)
+    kvs = []
+    for el in xpath_source.get_elements("//ns:record"):
+        xpath_source.relative_root = el
+        kvs.append(list(xpath_source.iter()))
+    return kvs
+
+
+def _json_sources(source: str, paths: List[str]) -> List[List]:
+    return [
+        list(document_source.iter())
+        for document_source in StreamingJsonPathSource(
+            io.StringIO(source), paths
+        ).iter_sources()
+    ]
+
+
+def main(
+    *,
+    depth: int = 4,
+    breadth: int = 4,
+    cardinality_level: int = 2,
+    required_every: int = 3,
+    records: int = 20,
+    repetitions: int = 3,
+    repeat: int = 3,
+    output_file: Optional[str] = None,
+):
+    """Prints the time of each stage for each backend and source format,
+    in total and per composition.
+
+    :param depth: depth of the template leaves
+    :param breadth: children of each node
+    :param cardinality_level: level of the multiple cardinality nodes
+    :param required_every: one every required_every leaves is required
+    :param records: number of compositions
+    :param repetitions: occurrences of each multiple cardinality node in a composition
+    :param repeat: runs of each stage, the best is reported
+    :param output_file: if set, timings (seconds) are also written as json,
+        for comparing runs
+    """
+    template_dict = web_template(depth, breadth, cardinality_level, required_every)
+    results: Dict[str, float] = {}
+
+    def _report(label: str, elapsed: float, per_composition: bool = True):
+        results[label] = elapsed
+        print(
+            f"{label:<32} {elapsed * 1e3:10.2f} ms"
+            + (
+                f" {elapsed / records * 1e6:12.1f} us/composition"
+                if per_composition
+                else ""
+            )
+        )
+
+    print(
+        f"depth {depth}, breadth {breadth}, {records} compositions,"
+        f" {repetitions} repetitions"
+    )
+    for source_format, source_func, sources_func in (
+        ("xml", xml_source, _xml_sources),
+        ("json", json_source, _json_sources),
+    ):
+        conf_dict = conf(template_dict, source_format)
+        source = source_func(template_dict, records, repetitions)
+        paths = list(Config(**conf_dict).inverse_mappings.keys())
+        _report(
+            f"{source_format} source",
+            _time(lambda: sources_func(source, paths), repeat=repeat),
+        )
+        kvs = sources_func(source, paths)
+
+        for backend in template_factory.backends():
+            prefix = f"{backend} {source_format}"
+            _report(
+                f"{prefix} template",
+                _time(
+                    lambda: template_factory(backend, template_dict).get(),
+                    repeat=repeat,
+                ),
+                per_composition=False,
+            )
+            template = template_factory(backend, template_dict).get()
+            # defaults are set (and timed) separately
+            config = Config(**conf_dict, set_missing_required_to_default=False)
+            build_composition(config, template, iter(kvs[0]))
+
+            def _build():
+                return [
+                    build_composition(config, template, iter(record_kvs))
+                    for record_kvs in kvs
+                ]
+
+            _report(f"{prefix} build", _time(_build, repeat=repeat))
+            _report(
+                f"{prefix} set defaults",
+                _time(
+                    lambda built: [
+                        composition.set_defaults() for composition, _, _ in built
+                    ],
+                    lambda: (_build(),),
+                    repeat,
+                ),
+            )
+            built = _build()
+            for composition, _, _ in built:
+                composition.set_defaults()
+            _report(
+                f"{prefix} flat",
+                _time(
+                    lambda: [
+                        json.dumps(flat(composition, ctx))
+                        for composition, ctx, _ in built
+                    ],
+                    repeat=repeat,
+                ),
+            )
+
+    if output_file:
+        with open(output_file, "w") as f_obj:
+            json.dump(results, f_obj, indent=2)
+
+
+if __name__ == "__main__":
+    import defopt
+
+    defopt.run(main)
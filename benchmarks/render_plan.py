@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compares suffix rendering with templates compiled for every value
+(the behaviour before Config.render_plan) against the shared render plan."""
+
+import json
+import timeit
+
+from flatehr.build import ValueDict, build_composition
+from flatehr.cli.generate import conf_from_file
+from flatehr.factory import template_factory
+from flatehr.sources.xml import XPathSource
+
+
+def main(
+    *,
+    template_file: str = "tests/resources/web_template.json",
+    conf_file: str = "tests/resources/xml_conf.yaml",
+    input_file: str = "tests/resources/source.xml",
+    number: int = 200,
+):
+    """Prints the time per composition spent rendering the suffixes.
+
+    :param template_file: web template path
+    :param conf_file: yaml configuration path
+    :param input_file: xml source
+    :param number: number of compositions rendered for each run
+    """
+    conf = conf_from_file(conf_file)
+    with open(template_file, "r") as f_obj:
+        template = template_factory("anytree", json.load(f_obj)).get()
+    with open(input_file, "r") as f_obj:
+        source_kvs = list(
+            XPathSource(f_obj, list(conf.inverse_mappings.keys())).iter()
+        )
+    render_plan = conf.render_plan
+
+    def _render(compiled: bool):
+        for source_key, source_value in source_kvs:
+            for path in conf.inverse_mappings[source_key]:
+                if not path.suffixes or not source_value:
+                    continue
+                value_dict = ValueDict(
+                    template,
+                    path,
+                    path.value_map,
+                    compiled_suffixes=render_plan.suffixes[path._id]
+                    if compiled
+                    else None,
+                )
+                value_dict.add_source_key_value(source_key, source_value)
+
+    def _build():
+        build_composition(conf, template, iter(source_kvs))
+
+    for label, func in (
+        ("compile per value", lambda: _render(False)),
+        ("render plan", lambda: _render(True)),
+        ("build_composition", _build),
+    ):
+        elapsed = min(timeit.repeat(func, number=number, repeat=3))
+        print(f"{label:<20} {elapsed / number * 1e6:10.1f} us/composition")
+
+
+if __name__ == "__main__":
+    import defopt
+
+    defopt.run(main)
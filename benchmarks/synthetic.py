@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Synthetic web templates, configurations and sources of configurable size.
+
+The template is a tree with the given depth and breadth under a COMPOSITION
+root; the nodes at cardinality_level have multiple cardinality. Sources have
+a record element (or object) for each composition, mirroring the template,
+with repetitions occurrences of each multiple cardinality node.
+Leaves alternate text, coded text (value_map or jq) and date values, and
+one every required_every is required, with a default value.
+"""
+
+import json
+import os
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from pyaml import yaml
+
+NAMESPACE = "http://flatehr.example/synthetic"
+CODES = ("alpha", "beta", "gamma")
+
+# leaf kinds
+TEXT, CODED, JQ_CODED, DATE = range(4)
+
+
+def web_template(
+    depth: int = 4,
+    breadth: int = 4,
+    cardinality_level: int = 2,
+    required_every: int = 3,
+) -> Dict:
+    counter = iter(range(1 << 30))
+
+    def _node(level: int, path: str) -> Dict:
+        index = next(counter)
+        _id = f"n{level}_{index}"
+        aql_path = f"{path}/items[at{index:04d}]"
+        node = {
+            "id": _id,
+            "name": _id,
+            "rmType": "CLUSTER",
+            "min": 0,
+            "max": -1 if level == cardinality_level else 1,
+            "aqlPath": aql_path,
+        }
+        if level == depth:
+            node.update(_leaf(index, required_every))
+        else:
+            node["children"] = [_node(level + 1, aql_path) for _ in range(breadth)]
+            # the first child is required, so that required leaves are reachable
+            node["children"][0]["min"] = 1
+        return node
+
+    return {
+        "templateId": "synthetic",
+        "version": "2.3",
+        "defaultLanguage": "en",
+        "languages": ["en"],
+        "tree": {
+            "id": "synthetic",
+            "name": "synthetic",
+            "rmType": "COMPOSITION",
+            "min": 1,
+            "max": 1,
+            "aqlPath": "",
+            "children": [_node(1, "") for _ in range(breadth)],
+        },
+    }
+
+
+def _leaf(index: int, required_every: int) -> Dict:
+    required = index % required_every == 0
+    if _leaf_kind(index) in (CODED, JQ_CODED):
+        leaf_input = {
+            "suffix": "code",
+            "type": "CODED_TEXT",
+            "list": [
+                {"value": f"{i:04d}", "label": code.upper()}
+                for i, code in enumerate(CODES)
+            ],
+            "terminology": "synthetic",
+        }
+        rm_type = "DV_CODED_TEXT"
+    else:
+        leaf_input = {"type": "TEXT"}
+        rm_type = "DV_TEXT"
+    if required:
+        leaf_input["defaultValue"] = "0000" if rm_type == "DV_CODED_TEXT" else "default"
+    return {"rmType": rm_type, "min": 1 if required else 0, "inputs": [leaf_input]}
+
+
+def _leaf_kind(index: int) -> int:
+    return index % 4
+
+
+def leaves(web_template: Dict) -> Iterator[Tuple[List[Dict], Dict]]:
+    """Yields the leaves of the web template, with their ancestors (root excluded)."""
+    stack = [([], child) for child in reversed(web_template["tree"]["children"])]
+    while stack:
+        ancestors, node = stack.pop()
+        if node.get("children"):
+            stack.extend(
+                (ancestors + [node], child) for child in reversed(node["children"])
+            )
+        else:
+            yield ancestors, node
+
+
+def _suffixes(leaf: Dict) -> Dict:
+    index = int(leaf["id"].split("_")[1])
+    kind = _leaf_kind(index)
+    if kind == CODED:
+        return {
+            "|code": "{{ value_map[maps_to[0]] }}",
+            "|value": "{{ maps_to[0] | upper }}",
+            "|terminology": "synthetic",
+        }
+    if kind == JQ_CODED:
+        return {
+            "|code": {
+                "value": '.inputs[0].list[] | select(.label == "{{ maps_to[0] | upper }}")'
+                " | .value",
+                "jq": True,
+            },
+            "|value": "{{ maps_to[0] | upper }}",
+            "|terminology": "synthetic",
+        }
+    if kind == DATE:
+        return {"": "{{ date_isoformat(maps_to[0]) }}"}
+    return {"": "{{ maps_to[0] }}"}
+
+
+def conf(web_template: Dict, source_format: str = "xml") -> Dict:
+    """Returns a configuration mapping every leaf of the web template.
+    Paths are relative to the record, for xml, and to the top level array
+    elements, for json."""
+    root = web_template["tree"]["id"]
+    paths: Dict = {
+        "ctx/language": "en",
+        "ctx/territory": "IT",
+        "ctx/composer_name": "synthetic",
+    }
+    value_map = {code: f"{i:04d}" for i, code in enumerate(CODES)}
+    multiple = set()
+    for ancestors, leaf in leaves(web_template):
+        nodes = ancestors + [leaf]
+        for i, node in enumerate(nodes):
+            if node["max"] == -1 and node["id"] not in multiple:
+                multiple.add(node["id"])
+                paths["/".join([root] + [n["id"] for n in nodes[: i + 1]])] = {
+                    "maps_to": [_source_path(nodes[: i + 1], source_format, False)]
+                }
+        paths["/".join([root] + [n["id"] for n in nodes])] = {
+            "maps_to": [_source_path(nodes, source_format, True)],
+            "suffixes": _suffixes(leaf),
+            "value_map": value_map,
+        }
+    return {
+        "ehr_id": {"maps_to": [], "value": "{{ random_ehr_id() }}"},
+        "paths": paths,
+    }
+
+
+def _source_path(nodes: List[Dict], source_format: str, leaf: bool) -> str:
+    if source_format == "xml":
+        return (
+            "./"
+            + "/".join(f"ns:{n['id']}" for n in nodes)
+            + ("/text()" if leaf else "")
+        )
+    return "$." + ".".join(
+        f"{n['id']}[*]" if n["max"] == -1 else n["id"] for n in nodes
+    )
+
+
+def _values(web_template: Dict, record: int, repetitions: int) -> Dict:
+    def _value(leaf: Dict, occurrence: int) -> str:
+        index = int(leaf["id"].split("_")[1])
+        kind = _leaf_kind(index)
+        if kind in (CODED, JQ_CODED):
+            return CODES[(record + occurrence + index) % len(CODES)]
+        if kind == DATE:
+            return f"20{(record + occurrence) % 23:02d}-{index % 12 + 1:02d}-01"
+        return f"value {record} {occurrence} {index}"
+
+    def _record(node: Dict, occurrence: int):
+        if not node.get("children"):
+            return _value(node, occurrence)
+        obj = {}
+        for child in node["children"]:
+            if child["max"] == -1:
+                obj[child["id"]] = [_record(child, i) for i in range(repetitions)]
+            else:
+                obj[child["id"]] = _record(child, occurrence)
+        return obj
+
+    return _record(web_template["tree"], 0)
+
+
+def json_source(web_template: Dict, records: int = 10, repetitions: int = 3) -> str:
+    """Returns a top level array of records, one for each composition."""
+    return json.dumps(
+        [_values(web_template, record, repetitions) for record in range(records)]
+    )
+
+
+def xml_source(web_template: Dict, records: int = 10, repetitions: int = 3) -> str:
+    """Returns a document with a record element for each composition."""
+    lines = [f'<records xmlns="{NAMESPACE}">']
+
+    def _write(_id: str, value, indent: str):
+        if isinstance(value, list):
+            for occurrence in value:
+                _write(_id, occurrence, indent)
+        elif isinstance(value, dict):
+            lines.append(f"{indent}<{_id}>")
+            for child_id, child in value.items():
+                _write(child_id, child, indent + "  ")
+            lines.append(f"{indent}</{_id}>")
+        else:
+            lines.append(f"{indent}<{_id}>{value}</{_id}>")
+
+    for record in range(records):
+        _write("record", _values(web_template, record, repetitions), "  ")
+    lines.append("</records>")
+    return "\n".join(lines) + "\n"
+
+
+def main(
+    output_dir: str,
+    *,
+    depth: int = 4,
+    breadth: int = 4,
+    cardinality_level: int = 2,
+    required_every: int = 3,
+    records: int = 10,
+    repetitions: int = 3,
+    source_format: Optional[str] = None,
+):
+    """Writes a synthetic web template, its configurations and sources to output_dir
+    (web_template.json, xml_conf.yaml, source.xml, json_conf.yaml, source.json).
+
+    :param output_dir: output directory
+    :param depth: depth of the template leaves
+    :param breadth: children of each node
+    :param cardinality_level: level of the multiple cardinality nodes
+    :param required_every: one every required_every leaves is required
+    :param records: number of records (compositions) in the sources
+    :param repetitions: occurrences of each multiple cardinality node in a record
+    :param source_format: xml or json, both if not set
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    template = web_template(depth, breadth, cardinality_level, required_every)
+    with open(os.path.join(output_dir, "web_template.json"), "w") as f_obj:
+        json.dump(template, f_obj, indent=2)
+
+    for _format, source in (("xml", xml_source), ("json", json_source)):
+        if source_format and source_format != _format:
+            continue
+        with open(os.path.join(output_dir, f"{_format}_conf.yaml"), "w") as f_obj:
+            yaml.safe_dump(conf(template, _format), f_obj, sort_keys=False)
+        with open(os.path.join(output_dir, f"source.{_format}"), "w") as f_obj:
+            f_obj.write(source(template, records, repetitions))
+
+
+if __name__ == "__main__":
+    import defopt
+
+    defopt.run(main)
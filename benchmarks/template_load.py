@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Times loading a template from the web template, from the cache and from
+a compiled template (.fehr), for each backend."""
+
+import json
+import os
+import tempfile
+import timeit
+from typing import Optional
+
+import synthetic
+
+from flatehr.artifact import compile_file, load_template
+from flatehr.factory import template_factory
+
+
+def main(
+    *,
+    template_file: Optional[str] = None,
+    depth: int = 5,
+    breadth: int = 6,
+    number: int = 5,
+):
+    """Prints the best load time of number runs. If template_file is not set,
+    a synthetic web template of the given depth and breadth is used.
+
+    :param template_file: web template path
+    :param depth: depth of the synthetic template
+    :param breadth: children of each node of the synthetic template
+    :param number: number of runs
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if template_file is None:
+            template_file = os.path.join(tmp_dir, "web_template.json")
+            with open(template_file, "w") as f_obj:
+                json.dump(synthetic.web_template(depth, breadth), f_obj, indent=2)
+        compiled_file = os.path.join(tmp_dir, "template.fehr")
+        compile_file(template_file, compiled_file)
+        cache_dir = os.path.join(tmp_dir, "cache")
+        print(
+            f"{template_file}: {os.path.getsize(template_file) / 1e6:.1f} MB,"
+            f" compiled {os.path.getsize(compiled_file) / 1e6:.1f} MB"
+        )
+
+        for backend in template_factory.backends():
+            load_template(template_file, backend, cache_dir)
+            for label, func in (
+                ("web template", lambda: load_template(template_file, backend, "")),
+                ("cached", lambda: load_template(template_file, backend, cache_dir)),
+                ("compiled", lambda: load_template(compiled_file, backend)),
+            ):
+                elapsed = min(timeit.repeat(func, number=1, repeat=number))
+                print(f"{backend:<8} {label:<13} {elapsed * 1e3:8.1f} ms")
+
+
+if __name__ == "__main__":
+    import defopt
+
+    defopt.run(main)
@@ -0,0 +1,292 @@
+"""Compiled templates: the node table of a built Template, as
+magic | format version | sha256 of the web template | sha256 of the payload | payload
+(zlib compressed).
+The payload holds the number of nodes and the size of the json columns, the parents,
+subtree ends and flags of the nodes in pre-order (as in compact_core.TemplateStore),
+the json columns (web template metadata, ids, rm types and aql paths of the nodes)
+and a json array of annotations and inputs of each node, preceded by the offsets of
+its items, so that they are decoded only when needed."""
+
+import hashlib
+import json
+import logging
+import os
+import struct
+import sys
+import tempfile
+import zlib
+from array import array
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from flatehr.core import Template, WebTemplate
+from flatehr.factory import template_factory
+from flatehr.impl.compact_core import (
+    IN_CONTEXT,
+    INF_CARDINALITY,
+    REQUIRED,
+    TemplateStore,
+)
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"FEHR"
+FORMAT_VERSION = 2
+_HEADER = struct.Struct(f">{len(MAGIC)}sH32s32s")
+# number of nodes, size of the json columns
+_SIZES = struct.Struct("<II")
+
+_UNDECODED = object()
+
+
+class InvalidArtifact(Exception):
+    ...
+
+
+def default_cache_dir() -> str:
+    return os.environ.get(
+        "FLATEHR_CACHE_DIR",
+        os.path.join(
+            os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+            "flatehr",
+        ),
+    )
+
+
+class NodeTable:
+    """The built nodes of a template, with the web template metadata
+    (templateId, version...)."""
+
+    def __init__(self, metadata: Dict, store: TemplateStore):
+        self.metadata = metadata
+        self.store = store
+
+    @classmethod
+    def from_web_template(cls, web_template: WebTemplate) -> "NodeTable":
+        return cls(
+            {k: v for k, v in web_template.items() if k != "tree"},
+            TemplateStore(web_template),
+        )
+
+    def template(self, backend: str = "anytree") -> Template:
+        """The compact backend uses the table as it is, the others are built from
+        the (reduced) web template."""
+        if backend == "compact":
+            return Template(self.store.node(0), backend="compact")
+        return template_factory(backend, self.web_template()).get()
+
+    def web_template(self) -> WebTemplate:
+        """Returns the web template, with only the keys used for building a Template."""
+        store = self.store
+        if isinstance(store.annotations, _JsonColumns):
+            annotations, inputs = store.annotations.decode_all()
+        else:
+            annotations, inputs = store.annotations, store.inputs
+        nodes: List[Dict[str, Any]] = []
+        for index, parent in enumerate(store.parents):
+            flags = store.flags[index]
+            node = {
+                "id": store.ids[index],
+                "rmType": store.rm_types[index],
+                "min": 1 if flags & REQUIRED else 0,
+                "max": -1 if flags & INF_CARDINALITY else 1,
+                "inContext": bool(flags & IN_CONTEXT),
+            }
+            if store.aql_paths[index] is not None:
+                node["aqlPath"] = store.aql_paths[index]
+            # missing values are () in the store
+            if annotations[index] != ():
+                node["annotations"] = annotations[index]
+            if inputs[index] != ():
+                node["inputs"] = inputs[index]
+            if parent >= 0:
+                nodes[parent].setdefault("children", []).append(node)
+            nodes.append(node)
+        return dict(self.metadata, tree=nodes[0])
+
+
+class _JsonColumns:
+    """The annotations (column 0) or inputs (column 1) of the nodes, decoded from
+    the json array of both on first access."""
+
+    def __init__(self, data: bytes, offsets: Sequence[int], column: int, size: int):
+        self._data = data
+        self._offsets = offsets
+        self._column = column
+        self._values: List[Any] = [_UNDECODED] * size
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def __getitem__(self, index: int):
+        value = self._values[index]
+        if value is _UNDECODED:
+            item = 2 * index + self._column
+            # items are followed by a comma (or the closing bracket)
+            value = json.loads(
+                self._data[self._offsets[item] : self._offsets[item + 1] - 1]
+            )
+            value = self._values[index] = () if value is None else value
+        return value
+
+    def decode_all(self) -> Tuple[List, List]:
+        values = [() if value is None else value for value in json.loads(self._data)]
+        return values[0::2], values[1::2]
+
+
+def dumps(web_template: WebTemplate, source_hash: bytes) -> bytes:
+    table = NodeTable.from_web_template(web_template)
+    store = table.store
+    json_columns = json.dumps(
+        [table.metadata, store.ids, store.rm_types, store.aql_paths],
+        separators=(",", ":"),
+    ).encode()
+    # missing annotations and inputs are null
+    items = [
+        json.dumps(None if value == () else value, separators=(",", ":")).encode()
+        for node_values in zip(store.annotations, store.inputs)
+        for value in node_values
+    ]
+    offsets = array("i", [1])
+    for item in items:
+        offsets.append(offsets[-1] + len(item) + 1)
+    payload = zlib.compress(
+        b"".join(
+            (
+                _SIZES.pack(len(store.ids), len(json_columns)),
+                _to_bytes(array("i", store.parents)),
+                _to_bytes(array("i", store.subtree_ends)),
+                bytes(store.flags),
+                json_columns,
+                _to_bytes(offsets),
+                b"[" + b",".join(items) + b"]",
+            )
+        )
+    )
+    return (
+        _HEADER.pack(
+            MAGIC, FORMAT_VERSION, source_hash, hashlib.sha256(payload).digest()
+        )
+        + payload
+    )
+
+
+def loads(data: bytes) -> Tuple[NodeTable, bytes]:
+    """Returns the node table and the hash of its source."""
+    if len(data) < _HEADER.size:
+        raise InvalidArtifact("truncated header")
+    magic, version, source_hash, payload_hash = _HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise InvalidArtifact("not a flatehr template artifact")
+    if version != FORMAT_VERSION:
+        raise InvalidArtifact(
+            f"unsupported format version {version}, expected {FORMAT_VERSION}"
+        )
+    payload = data[_HEADER.size :]
+    if hashlib.sha256(payload).digest() != payload_hash:
+        raise InvalidArtifact("corrupted payload")
+    payload = zlib.decompress(payload)
+
+    size, json_size = _SIZES.unpack_from(payload)
+    position = _SIZES.size
+    parents, position = _from_bytes(payload, position, size)
+    subtree_ends, position = _from_bytes(payload, position, size)
+    flags = array("B", payload[position : position + size])
+    position += size
+    metadata, ids, rm_types, aql_paths = json.loads(
+        payload[position : position + json_size]
+    )
+    offsets, position = _from_bytes(payload, position + json_size, 2 * size + 1)
+    values = payload[position:]
+    return (
+        NodeTable(
+            metadata,
+            TemplateStore.from_columns(
+                parents,
+                subtree_ends,
+                flags,
+                ids,
+                rm_types,
+                aql_paths,
+                _JsonColumns(values, offsets, 0, size),
+                _JsonColumns(values, offsets, 1, size),
+            ),
+        ),
+        source_hash,
+    )
+
+
+def is_artifact(data: bytes) -> bool:
+    return data[: len(MAGIC)] == MAGIC
+
+
+def compile_file(template_file: str, output_file: str):
+    with open(template_file, "rb") as f_obj:
+        data = f_obj.read()
+    _write(output_file, dumps(json.loads(data), hashlib.sha256(data).digest()))
+
+
+def load_template(
+    template_file: str,
+    backend: str = "anytree",
+    cache_dir: Optional[str] = None,
+) -> Template:
+    """Loads a template from a web template or from an artifact.
+    Web templates are compiled and cached in cache_dir (by default
+    $FLATEHR_CACHE_DIR or ~/.cache/flatehr, an empty string disables the cache)."""
+    with open(template_file, "rb") as f_obj:
+        data = f_obj.read()
+
+    if is_artifact(data):
+        return loads(data)[0].template(backend)
+
+    cache_dir = default_cache_dir() if cache_dir is None else cache_dir
+    if not cache_dir:
+        return template_factory(backend, json.loads(data)).get()
+
+    source_hash = hashlib.sha256(data).digest()
+    cache_file = os.path.join(cache_dir, f"{source_hash.hex()}.fehr")
+    try:
+        with open(cache_file, "rb") as f_obj:
+            table, cached_source_hash = loads(f_obj.read())
+        if cached_source_hash == source_hash:
+            return table.template(backend)
+    except (OSError, InvalidArtifact, ValueError, struct.error) as ex:
+        logger.debug("cache miss for %s: %s", template_file, ex)
+
+    web_template = json.loads(data)
+    try:
+        _write(cache_file, dumps(web_template, source_hash))
+    except OSError as ex:
+        logger.warning("cannot cache template %s: %s", template_file, ex)
+    return template_factory(backend, web_template).get()
+
+
+def _to_bytes(values: array) -> bytes:
+    # little endian
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_bytes(data: bytes, position: int, size: int) -> Tuple[array, int]:
+    values = array("i")
+    end = position + size * values.itemsize
+    values.frombytes(data[position:end])
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values, end
+
+
+def _write(output_file: str, data: bytes):
+    # written to a temporary file and renamed, so that readers never see partial artifacts
+    output_dir = os.path.dirname(os.path.abspath(output_file))
+    os.makedirs(output_dir, exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=output_dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f_obj:
+            f_obj.write(data)
+        os.replace(tmp_file, output_file)
+    except BaseException:
+        os.unlink(tmp_file)
+        raise
@@ -1,23 +1,49 @@
 import dataclasses
+import re
 from collections import defaultdict
 from dataclasses import dataclass
+from functools import lru_cache
 from inspect import getmembers
-from typing import Callable, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+from types import MappingProxyType
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    cast,
+)
 from uuid import uuid4
 
 import jq
 from dateutil.parser import parse as parse_date
 from jinja2 import Environment
+from jinja2 import Template as JinjaTemplate
 from pyaml import yaml
 
-from flatehr.core import Composition, NullFlavour, Template, TemplatePath
+from flatehr.core import (
+    Composition,
+    NullFlavour,
+    Template,
+    TemplatePath,
+    remove_cardinality,
+)
 from flatehr.factory import composition_factory
+from flatehr.stats import Stats, get_stats
 
 SourceKey = str
 Suffix = str
 CodeStr = str
 Ctx = Dict
 
+JQ_CACHE_SIZE = 1024
+DATE_CACHE_SIZE = 4096
+
 
 class Config:
     def __init__(
@@ -44,6 +70,9 @@ class Config:
         for path in self._paths:
             for map_to in path.maps_to:
                 self._inverse_mappings[map_to].append(path)
+        self._render_plan: Optional[RenderPlan] = None
+        # one per template in practice (prototypes refer to their template anyway)
+        self._prototypes: Dict[Template, "Prototype"] = {}
 
     @property
     def inverse_mappings(self):
@@ -61,6 +90,21 @@ class Config:
     def ehr_id(self) -> "EhrId":
         return self._ehr_id
 
+    @property
+    def render_plan(self) -> "RenderPlan":
+        # compiled lazily, so that user defined functions are looked up
+        # when the first composition is built and not when the conf is loaded
+        if self._render_plan is None:
+            self._render_plan = RenderPlan.compile(self)
+        return self._render_plan
+
+    def prototype(self, template: Template) -> "Prototype":
+        try:
+            return self._prototypes[template]
+        except KeyError:
+            prototype = self._prototypes[template] = Prototype.build(self, template)
+            return prototype
+
 
 @dataclass
 class EhrId:
@@ -80,24 +124,234 @@ class Path:
         return hash(self._id)
 
 
+@dataclass(frozen=True)
+class CompiledSuffix:
+    suffix: Suffix
+    template: JinjaTemplate
+    jq: bool
+    # renders common template shapes without jinja, returns NO_FAST_PATH
+    # when jinja is needed
+    fast_path: Optional[Callable[[Sequence, Dict], Any]] = None
+
+    def render(self, maps_to: Sequence, value_map: Dict) -> str:
+        if self.fast_path is not None:
+            value = self.fast_path(maps_to, value_map)
+            if value is not NO_FAST_PATH:
+                return value
+        return self.template.render(maps_to=maps_to, value_map=value_map)
+
+
+NO_FAST_PATH = object()
+_MAPS_TO = re.compile(r"\{\{\s*maps_to\[(\d+)\]\s*\}\}")
+_VALUE_MAP = re.compile(r"\{\{\s*value_map\[\s*maps_to\[(\d+)\]\s*\]\s*\}\}")
+_DATE_ISOFORMAT = re.compile(
+    r"\{\{\s*date_isoformat\(\s*maps_to\[(\d+)\]\s*\)\s*\}\}"
+)
+
+
+@dataclass(frozen=True)
+class RenderPlan:
+    """Jinja templates of a Config, compiled once and shared by all the
+    compositions built with it."""
+
+    suffixes: Mapping[TemplatePath, Tuple[CompiledSuffix, ...]]
+    ehr_id: JinjaTemplate
+
+    @staticmethod
+    def compile(conf: Config) -> "RenderPlan":
+        udf = get_udf()
+        suffix_env = _get_suffix_env(udf)
+        ehr_id_env = Environment()
+        ehr_id_env.globals["random_ehr_id"] = uuid4
+        ehr_id_env.globals.update(udf)
+
+        return RenderPlan(
+            suffixes=MappingProxyType(
+                {
+                    path._id: compile_suffixes(path.suffixes, suffix_env)
+                    for path in conf.paths
+                }
+            ),
+            ehr_id=ehr_id_env.from_string(conf.ehr_id.value),
+        )
+
+
+@dataclass(frozen=True)
+class Prototype:
+    """The part of the compositions built with a Config and a Template that does
+    not depend on the source: static paths and ctx. It is built once and copied
+    into every composition."""
+
+    composition: Composition
+    ctx: Ctx
+    # static paths set on every composition, since the nodes they set depend on
+    # the source (wildcards, multiple cardinality nodes added from the source)
+    source_dependent_paths: Tuple[Path, ...]
+    # mapped paths with a null flavour, set if the source does not provide them
+    null_flavor_paths: Tuple[Path, ...]
+
+    @staticmethod
+    def build(conf: Config, template: Template) -> "Prototype":
+        composition = composition_factory(template.backend, template).get()
+        render_plan = conf.render_plan
+
+        ctx = {}
+        for path in conf.paths:
+            if not path.maps_to:
+                value_dict = ValueDict(
+                    composition.template,
+                    path,
+                    path.value_map,
+                    path.null_flavor,
+                    render_plan.suffixes[path._id],
+                )
+                if path._id.startswith("ctx/"):
+                    ctx[path._id] = value_dict
+                else:
+                    composition[path._id] = value_dict
+
+        added = [
+            remove_cardinality(path._id)
+            for path in conf.paths
+            if path.maps_to and not path.suffixes
+        ]
+
+        def _source_dependent(path: Path) -> bool:
+            _id = remove_cardinality(path._id)
+            return "*" in _id or any(
+                _id == added_id or _id.startswith(f"{added_id}/")
+                for added_id in added
+            )
+
+        source_dependent_paths = []
+        for path in conf.paths:
+            if path.maps_to or path._id.startswith("ctx"):
+                continue
+            if _source_dependent(path):
+                source_dependent_paths.append(path)
+            else:
+                _set_unmapped(composition, path)
+
+        return Prototype(
+            composition,
+            ctx,
+            tuple(source_dependent_paths),
+            tuple(
+                path
+                for path in conf.paths
+                if path.maps_to
+                and path.null_flavor is not None
+                and not path._id.startswith("ctx")
+            ),
+        )
+
+
+def compile_suffixes(
+    suffixes: Dict[Suffix, CodeStr], env: Optional[Environment] = None
+) -> Tuple[CompiledSuffix, ...]:
+    env = env or _get_suffix_env(get_udf())
+    compiled = []
+    for k, v in suffixes.items():
+        if isinstance(v, str):
+            v = {"value": v, "jq": False}
+        template = env.from_string(v["value"])
+        compiled.append(
+            CompiledSuffix(
+                k, template, v["jq"], _get_fast_path(v["value"], template, env)
+            )
+        )
+    return tuple(compiled)
+
+
+def _get_fast_path(
+    source: str, template: JinjaTemplate, env: Environment
+) -> Optional[Callable[[Sequence, Dict], Any]]:
+    """Returns a function rendering the most common template shapes like jinja
+    (that renders expressions as str(value)), falling back to jinja
+    for missing indexes and keys."""
+    if "{" not in source:
+        constant = template.render()
+        return lambda maps_to, value_map: constant
+
+    match = _MAPS_TO.fullmatch(source)
+    if match:
+        index = int(match.group(1))
+
+        def _maps_to(maps_to: Sequence, value_map: Dict) -> Any:
+            if index < len(maps_to):
+                return str(maps_to[index])
+            return NO_FAST_PATH
+
+        return _maps_to
+
+    match = _VALUE_MAP.fullmatch(source)
+    if match:
+        index = int(match.group(1))
+
+        def _value_map(maps_to: Sequence, value_map: Dict) -> Any:
+            try:
+                return str(value_map[maps_to[index]])
+            except (IndexError, KeyError, TypeError):
+                return NO_FAST_PATH
+
+        return _value_map
+
+    match = _DATE_ISOFORMAT.fullmatch(source)
+    if match:
+        index = int(match.group(1))
+        # user defined functions can override date_isoformat
+        func = env.globals["date_isoformat"]
+
+        def _date_isoformat(maps_to: Sequence, value_map: Dict) -> Any:
+            if index < len(maps_to):
+                return str(func(maps_to[index]))
+            return NO_FAST_PATH
+
+        return _date_isoformat
+
+    return None
+
+
+@lru_cache(maxsize=JQ_CACHE_SIZE)
+def compile_jq(program: str):
+    """Compiles a (rendered) jq program, caching the most recent ones.
+    Hits and misses are returned by compile_jq.cache_info()."""
+    return jq.compile(program)
+
+
+def _get_suffix_env(udf: Dict[str, Callable]) -> Environment:
+    env = Environment()
+    env.globals["date_isoformat"] = date_isoformat
+    env.globals.update(udf)
+    return env
+
+
 @dataclass
 class ValueDict(dict):
     template: Template
     path: Path
     value_map: Dict[str, Dict[str, str]] = dataclasses.field(default_factory=dict)
     null_flavor: Optional[NullFlavour] = None
+    compiled_suffixes: Optional[Tuple[CompiledSuffix, ...]] = None
 
     def __post_init__(self):
+        if self.compiled_suffixes is None:
+            self.compiled_suffixes = compile_suffixes(self.path.suffixes)
         self._dict: Dict[str, str] = {}
         self._source_key_value: Dict[SourceKey, str] = {}
+        self._completed = self._check_completed()
         self._populate_dict()
 
     def completed(self) -> bool:
+        return self._completed
+
+    def _check_completed(self) -> bool:
         return set(self._source_key_value.keys()) == set(self.path.maps_to)
 
     def add_source_key_value(self, source_key: SourceKey, value: str):
         self._source_key_value[source_key] = value
-        if self.completed():
+        self._completed = self._check_completed()
+        if self._completed:
             self._populate_dict()
 
     def __getitem__(self, key):
@@ -139,18 +393,16 @@ class ValueDict(dict):
             self._source_key_value[source_key] for source_key in self.path.maps_to
         ]
 
-        for k, v in self.path.suffixes.items():
-            if isinstance(v, str):
-                v = {"value": v, "jq": False}
-            env = Environment()
-            env.globals["date_isoformat"] = date_isoformat
-            env.globals.update(get_udf())
-            t = env.from_string(v["value"])
-            value = t.render(maps_to=maps_to, value_map=self.value_map)
-            if v["jq"]:
-                tpl = self.template[self.path._id].json()
-                value = jq.first(value, tpl)
-            self._dict[k] = value
+        for compiled in cast(Tuple[CompiledSuffix, ...], self.compiled_suffixes):
+            value = compiled.render(maps_to, self.value_map)
+            if compiled.jq:
+                with get_stats().timer("render.jq"):
+                    value = (
+                        compile_jq(value)
+                        .input(text=self.template.node_json(self.path._id))
+                        .first()
+                    )
+            self._dict[compiled.suffix] = value
 
 
 class ValuesNotReady(Exception):
@@ -162,24 +414,31 @@ def build_composition(
     template: Template,
     source_kvs: Iterator[Tuple[SourceKey, Optional[str]]],
 ) -> Tuple[Composition, Ctx, str]:
+    stats = get_stats()
+    with stats.timer("build"):
+        return _build_composition(
+            conf, template, stats.iter("source.extract", source_kvs), stats
+        )
+
+
+def _build_composition(
+    conf: Config,
+    template: Template,
+    source_kvs: Iterator[Tuple[SourceKey, Optional[str]]],
+    stats: Stats,
+) -> Tuple[Composition, Ctx, str]:
 
-    composition = composition_factory("anytree", template).get()
+    render_plan = conf.render_plan
+    prototype = conf.prototype(template)
+    with stats.timer("mutation"):
+        composition = composition_factory(template.backend, template).get()
+        composition.copy_nodes(prototype.composition)
+    ctx = dict(prototype.ctx)
 
     pending_value_dicts: Dict[
         Tuple[SourceKey, TemplatePath], List[ValueDict]
     ] = defaultdict(lambda: [])
 
-    ctx = {}
-    for path in conf.paths:
-        if not path.maps_to:
-            value_dict = ValueDict(
-                composition.template, path, path.value_map, path.null_flavor
-            )
-            if path._id.startswith("ctx/"):
-                ctx[path._id] = value_dict
-            else:
-                composition[path._id] = value_dict
-
     consumed_paths = []
     ehr_id_kvs = {}
     for source_key, source_value in source_kvs:
@@ -193,14 +452,21 @@ def build_composition(
                 continue
 
             if not path.suffixes:
-                composition.add(path._id)
+                with stats.timer("mutation"):
+                    composition.add(path._id)
             else:
                 try:
                     value_dicts = pending_value_dicts.pop((source_key, path._id))
                 except KeyError:
-                    value_dicts = [
-                        ValueDict(composition.template, path, path.value_map)
-                    ]
+                    with stats.timer("render"):
+                        value_dicts = [
+                            ValueDict(
+                                composition.template,
+                                path,
+                                path.value_map,
+                                compiled_suffixes=render_plan.suffixes[path._id],
+                            )
+                        ]
 
                     for k in path.maps_to:
                         if k != source_key:
@@ -209,36 +475,53 @@ def build_composition(
                     if path._id.startswith("ctx/"):
                         ctx[path._id] = value_dicts[0]
                     else:
-                        composition[path._id] = value_dicts[0]
+                        with stats.timer("mutation"):
+                            composition[path._id] = value_dicts[0]
 
-                for vd in value_dicts:
-                    if source_value:
-                        vd.add_source_key_value(source_key, source_value)
+                if source_value:
+                    with stats.timer("render"):
+                        for vd in value_dicts:
+                            vd.add_source_key_value(source_key, source_value)
             consumed_paths.append(path)
 
-    for path in set([p for p in conf.paths if not p._id.startswith("ctx")]) - set(
-        consumed_paths
-    ):
-        if path.null_flavor is not None:
-            composition[path._id] = path.null_flavor
-        elif not path.maps_to:
-            composition[path._id] = {k: v for k, v in path.suffixes.items()}
+    consumed = set(consumed_paths)
+    with stats.timer("mutation"):
+        for path in prototype.null_flavor_paths:
+            if path not in consumed:
+                _set_unmapped(composition, path)
+        for path in prototype.source_dependent_paths:
+            _set_unmapped(composition, path)
 
     if conf.set_missing_required_to_default:
-        composition.set_defaults()
+        with stats.timer("defaults"):
+            composition.set_defaults()
 
-    env = Environment()
-    env.globals["random_ehr_id"] = uuid4
-    env.globals.update(get_udf())
-    t = env.from_string(conf._ehr_id.value)
-    ehr_id = t.render(maps_to=conf.ehr_id.maps_to)
+    with stats.timer("render"):
+        ehr_id = render_plan.ehr_id.render(maps_to=conf.ehr_id.maps_to)
     return composition, ctx, ehr_id
 
 
+def _set_unmapped(composition: Composition, path: Path):
+    if path.null_flavor is not None:
+        composition[path._id] = path.null_flavor
+    elif not path.maps_to:
+        composition[path._id] = {k: v for k, v in path.suffixes.items()}
+
+
 def date_isoformat(date: str) -> str:
+    # cached by plain str: the smart strings of lxml keep their document alive
+    return _date_isoformat(str(date))
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def _date_isoformat(date: str) -> str:
     return parse_date(date).isoformat()
 
 
+date_isoformat.cache_info = _date_isoformat.cache_info  # type: ignore
+date_isoformat.cache_clear = _date_isoformat.cache_clear  # type: ignore
+
+
 def _get_conf(conf_file: str) -> Config:
     conf_kwargs = yaml.safe_load(open(conf_file, "r"))
     return Config(
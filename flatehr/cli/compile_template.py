@@ -0,0 +1,17 @@
+from flatehr.artifact import compile_file
+
+
+def main(template_file: str, *, output_file: str):
+    """Compiles a web template into a template file (.fehr) holding the built template.
+    The compiled file can be used in place of the web template by all the commands.
+
+    :param template_file: path to the web template (json)
+    :param output_file: path of the compiled template
+    """
+    compile_file(template_file, output_file)
+
+
+if __name__ == "__main__":
+    import defopt
+
+    defopt.run(main)
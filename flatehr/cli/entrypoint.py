@@ -1,15 +1,49 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from typing import List, Optional
+
 import defopt
-from flatehr.cli import generate
-from flatehr.cli import inspect_template
+from flatehr.cli import compile_template, generate
+from flatehr.cli import inspect_template, serve, submit
+
+# defopt generates a short flag only for unambiguous initials, so that adding
+# an option could silently drop one: short flags are pinned instead
+# (options missing in a command are ignored)
+SHORT_FLAGS = {
+    "template-file": "t",
+    "conf-file": "c",
+    "relative-root": "r",
+    "skip-ehr-id": "s",
+    "output-file": "o",
+    "workers": "w",
+    "journal-file": "j",
+    "format": "f",
+    "aql-path": "a",
+    "inputs": "i",
+    "port": "p",
+    "max-body-size": "m",
+    "url": "u",
+    "login": "l",
+    "queue-size": "q",
+    "failure-log": "f",
+}
 
 
-def main():
+def main(argv: Optional[List[str]] = None):
     defopt.run(
         {
-            "generate": [generate.from_file, generate.skeleton],
+            "generate": [
+                generate.from_file,
+                generate.from_dir,
+                generate.from_glob,
+                generate.skeleton,
+            ],
             "inspect": inspect_template.main,
-        }
+            "template": {"compile": compile_template.main},
+            "serve": serve.main,
+            "submit": submit.main,
+        },
+        short=SHORT_FLAGS,
+        argv=argv,
     )
@@ -1,18 +1,37 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import cProfile
+import glob
 import json
 import os
-from typing import Iterator, Optional, Tuple
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import IO, Dict, Iterator, List, Optional, Sequence, Tuple, Union, cast
 
 from dateutil.parser import parse as parse_date
 from pyaml import yaml
-from flatehr.build import Config, SourceKey, build_composition
+from flatehr.build import (
+    Config,
+    Ctx,
+    SourceKey,
+    build_composition,
+    compile_jq,
+    date_isoformat as _date_isoformat,
+)
 
-from flatehr.core import flat
-from flatehr.factory import template_factory
-from flatehr.sources.json import JsonPathSource
-from flatehr.sources.xml import XPathSource
+from flatehr.core import Composition, Template, flat, structured as to_structured
+from flatehr.artifact import load_template
+from flatehr.journal import Journal, composition_hash, file_hash
+from flatehr.sinks import PARTITIONS, Record, Sink, get_sink
+from flatehr.sources.json import (
+    JsonPathSource,
+    StreamingJsonPathSource,
+    compile_path,
+)
+from flatehr.sources.xml import StreamingXPathSource, XPathSource, compile_paths
+from flatehr.stats import Stats, disable_stats, enable_stats, get_stats
 
 
 def from_file(
@@ -22,103 +41,613 @@ def from_file(
     conf_file: str,
     relative_root: Optional[str] = None,
     skip_ehr_id: bool = False,
+    stream: bool = False,
+    stats: bool = False,
+    trace_file: Optional[str] = None,
+    profile: Optional[str] = None,
+    output_file: Optional[str] = None,
+    format: str = "ndjson",
+    compression: Optional[str] = None,
+    partitions: int = PARTITIONS,
+    structured: bool = False,
+    backend: str = "anytree",
 ):
     """
-    Generates composition(s) from a file. xml and json sources supported.
+    Generates composition(s) from a file. xml, json and ndjson (jsonl) sources supported.
     Prints on stdout an external ehr id (if flag --skip-ehr-id is not set) and the flat composition.
     If --relative-root is set, as many compositions are generated as keys with the given value exists in the source.
 
     :param input_file: source file
-    :param template_file: web template path
+    :param template_file: web template (or compiled template) path
     :param conf_file: yaml configuration path
     :param relative_root: id for the root(s) that maps 1:1 to composition
     :param skip_ehr_id: if set, ehr_id is not printed
+    :param stream: if set with --relative-root, an xml source is parsed incrementally
+        and only one relative root at time is kept in memory (xpaths must be relative
+        to the relative root, absolute ones are rejected). If set, each element of a
+        top level json array is read incrementally as a composition (ndjson/jsonl
+        sources are always read a line, i.e. a composition, at time)
+    :param stats: if set, a json summary of time and calls of each stage
+        (template loading, source parsing and extraction, rendering, tree mutation,
+        defaults, serialization) is written on stderr
+    :param trace_file: if set, the stages of each composition are written to this
+        file, a json line for each composition
+    :param profile: if set, cProfile data are dumped to this file
+    :param output_file: file where compositions are written, stdout if not set;
+        the output directory with files and partitioned formats
+    :param format: ndjson (a line for each composition), files (a json file for each
+        composition, named after its hash, in a directory for each ehr id) or
+        partitioned (ndjson files, with the compositions of an ehr id always in the same file)
+    :param compression: gzip or zstd (requires the zstd extra, flatehr[zstd]),
+        inferred from the extension (.gz, .zst) of the ndjson output file if not set
+    :param partitions: number of files of the partitioned format
+    :param structured: if set, compositions are written in the structured format
+        (nested json, with an array for each node), instead of flat
+    :param backend: template backend, anytree or compact (faster to load and build)
     """
-    handlers = {".xml": from_xml, ".json": from_json}
-    ext = os.path.splitext(input_file)[1]
-    try:
-        handler = handlers[ext]
-    except KeyError:
-        raise RuntimeError(
-            f"file {input_file} not supported, Supported types: {list(handlers.keys())}"
-        )
-    return handler(
-        input_file,
+    _get_handler(input_file)
+    # the ehr id is separated by a space, unlike the tab of from-dir and from-glob
+    with _instrumentation(stats, trace_file, profile), get_sink(
+        output_file, format, compression, partitions=partitions, separator=" "
+    ) as sink:
+        conf = conf_from_file(conf_file)
+        template = template_from_file(template_file, backend)
+        for composition, ctx, ehr_id in generate(
+            input_file, conf, template, relative_root, stream=stream
+        ):
+            sink.write(
+                *_format_record(
+                    composition, ctx, ehr_id, skip_ehr_id or not ehr_id, structured
+                )
+            )
+
+
+def from_dir(
+    input_dir: str,
+    *,
+    template_file: str,
+    conf_file: str,
+    relative_root: Optional[str] = None,
+    skip_ehr_id: bool = False,
+    output_file: Optional[str] = None,
+    workers: int = 1,
+    ordered: bool = False,
+    stream: bool = False,
+    stats: bool = False,
+    trace_file: Optional[str] = None,
+    profile: Optional[str] = None,
+    journal_file: Optional[str] = None,
+    only_changed: bool = False,
+    format: str = "ndjson",
+    compression: Optional[str] = None,
+    partitions: int = PARTITIONS,
+    structured: bool = False,
+    backend: str = "anytree",
+):
+    """
+    Generates compositions from all the xml and json files in a directory,
+    loading template and configuration only once.
+    Writes a line for each composition: the external ehr id (if flag --skip-ehr-id is not set),
+    a tab and the flat composition.
+
+    :param input_dir: directory containing the source files
+    :param template_file: web template (or compiled template) path
+    :param conf_file: yaml configuration path
+    :param relative_root: id for the root(s) that maps 1:1 to composition
+    :param skip_ehr_id: if set, ehr_id is not written
+    :param output_file: file where compositions are written, stdout if not set;
+        the output directory with files and partitioned formats
+    :param workers: number of worker processes
+    :param ordered: if set, compositions are written in input order,
+        otherwise as soon as they are generated
+    :param stream: if set with --relative-root, xml sources are parsed incrementally
+        and only one relative root at time is kept in memory (xpaths must be relative
+        to the relative root, absolute ones are rejected). If set, each element of a
+        top level json array is read incrementally as a composition (ndjson/jsonl
+        sources are always read a line, i.e. a composition, at time)
+    :param stats: if set, a json summary of time and calls of each stage
+        (template loading, source parsing and extraction, rendering, tree mutation,
+        defaults, serialization) is written on stderr
+    :param trace_file: if set, the stages of each composition are written to this
+        file, a json line for each composition
+    :param profile: if set, cProfile data are dumped to this file
+        (of the main process only, with workers)
+    :param journal_file: sqlite file recording processed files and compositions;
+        files already processed are skipped and compositions already written are not
+        written again, so that an interrupted run can be resumed. The output file
+        is appended to, not overwritten
+    :param only_changed: if set with --journal-file, processed files are processed again
+        if their content, the configuration or the template have changed
+    :param format: ndjson (a line for each composition), files (a json file for each
+        composition, named after its hash, in a directory for each ehr id) or
+        partitioned (ndjson files, with the compositions of an ehr id always in the same file)
+    :param compression: gzip or zstd (requires the zstd extra, flatehr[zstd]),
+        inferred from the extension (.gz, .zst) of the ndjson output file if not set
+    :param partitions: number of files of the partitioned format
+    :param structured: if set, compositions are written in the structured format
+        (nested json, with an array for each node), instead of flat
+    :param backend: template backend, anytree or compact (faster to load and build)
+    """
+    input_files = sorted(
+        os.path.join(input_dir, f)
+        for f in os.listdir(input_dir)
+        if os.path.splitext(f)[1] in HANDLERS
+    )
+    _batch(
+        input_files,
         template_file=template_file,
         conf_file=conf_file,
         relative_root=relative_root,
         skip_ehr_id=skip_ehr_id,
+        output_file=output_file,
+        workers=workers,
+        ordered=ordered,
+        stream=stream,
+        stats=stats,
+        trace_file=trace_file,
+        profile=profile,
+        journal_file=journal_file,
+        only_changed=only_changed,
+        format=format,
+        compression=compression,
+        partitions=partitions,
+        structured=structured,
+        backend=backend,
     )
 
 
-def from_xml(
-    input_file: str,
+def from_glob(
+    pattern: str,
     *,
     template_file: str,
     conf_file: str,
     relative_root: Optional[str] = None,
     skip_ehr_id: bool = False,
+    output_file: Optional[str] = None,
+    workers: int = 1,
+    ordered: bool = False,
+    stream: bool = False,
+    stats: bool = False,
+    trace_file: Optional[str] = None,
+    profile: Optional[str] = None,
+    journal_file: Optional[str] = None,
+    only_changed: bool = False,
+    format: str = "ndjson",
+    compression: Optional[str] = None,
+    partitions: int = PARTITIONS,
+    structured: bool = False,
+    backend: str = "anytree",
 ):
+    """
+    Generates compositions from all the files matching a glob pattern (recursive ** supported),
+    loading template and configuration only once.
+    Writes a line for each composition: the external ehr id (if flag --skip-ehr-id is not set),
+    a tab and the flat composition.
 
-    conf = conf_from_file(conf_file)
-    template = template_factory("anytree", json.load(open(template_file, "r"))).get()
-    xpath_source = XPathSource(
-        open(input_file, "r"), list(conf.inverse_mappings.keys())
+    :param pattern: glob pattern matching the source files
+    :param template_file: web template (or compiled template) path
+    :param conf_file: yaml configuration path
+    :param relative_root: id for the root(s) that maps 1:1 to composition
+    :param skip_ehr_id: if set, ehr_id is not written
+    :param output_file: file where compositions are written, stdout if not set;
+        the output directory with files and partitioned formats
+    :param workers: number of worker processes
+    :param ordered: if set, compositions are written in input order,
+        otherwise as soon as they are generated
+    :param stream: if set with --relative-root, xml sources are parsed incrementally
+        and only one relative root at time is kept in memory (xpaths must be relative
+        to the relative root, absolute ones are rejected). If set, each element of a
+        top level json array is read incrementally as a composition (ndjson/jsonl
+        sources are always read a line, i.e. a composition, at time)
+    :param stats: if set, a json summary of time and calls of each stage
+        (template loading, source parsing and extraction, rendering, tree mutation,
+        defaults, serialization) is written on stderr
+    :param trace_file: if set, the stages of each composition are written to this
+        file, a json line for each composition
+    :param profile: if set, cProfile data are dumped to this file
+        (of the main process only, with workers)
+    :param journal_file: sqlite file recording processed files and compositions;
+        files already processed are skipped and compositions already written are not
+        written again, so that an interrupted run can be resumed. The output file
+        is appended to, not overwritten
+    :param only_changed: if set with --journal-file, processed files are processed again
+        if their content, the configuration or the template have changed
+    :param format: ndjson (a line for each composition), files (a json file for each
+        composition, named after its hash, in a directory for each ehr id) or
+        partitioned (ndjson files, with the compositions of an ehr id always in the same file)
+    :param compression: gzip or zstd (requires the zstd extra, flatehr[zstd]),
+        inferred from the extension (.gz, .zst) of the ndjson output file if not set
+    :param partitions: number of files of the partitioned format
+    :param structured: if set, compositions are written in the structured format
+        (nested json, with an array for each node), instead of flat
+    :param backend: template backend, anytree or compact (faster to load and build)
+    """
+    _batch(
+        sorted(glob.iglob(pattern, recursive=True)),
+        template_file=template_file,
+        conf_file=conf_file,
+        relative_root=relative_root,
+        skip_ehr_id=skip_ehr_id,
+        output_file=output_file,
+        workers=workers,
+        ordered=ordered,
+        stream=stream,
+        stats=stats,
+        trace_file=trace_file,
+        profile=profile,
+        journal_file=journal_file,
+        only_changed=only_changed,
+        format=format,
+        compression=compression,
+        partitions=partitions,
+        structured=structured,
+        backend=backend,
     )
-    relative_root_elements = (
-        xpath_source.get_elements(f"//ns:{relative_root}")
-        if relative_root
-        else [xpath_source.root]
+
+
+def _batch(
+    input_files: Sequence[str],
+    *,
+    template_file: str,
+    conf_file: str,
+    relative_root: Optional[str],
+    skip_ehr_id: bool,
+    output_file: Optional[str],
+    workers: int = 1,
+    ordered: bool = False,
+    stream: bool = False,
+    stats: bool = False,
+    trace_file: Optional[str] = None,
+    profile: Optional[str] = None,
+    journal_file: Optional[str] = None,
+    only_changed: bool = False,
+    format: str = "ndjson",
+    compression: Optional[str] = None,
+    partitions: int = PARTITIONS,
+    structured: bool = False,
+    backend: str = "anytree",
+):
+    for input_file in input_files:
+        _get_handler(input_file)
+
+    journal = (
+        Journal(
+            journal_file, file_hash(conf_file), file_hash(template_file), only_changed
+        )
+        if journal_file
+        else None
     )
+    if journal is not None:
+        input_files = [f for f in input_files if journal.start_file(f, file_hash(f))]
+
+    try:
+        sink = (
+            get_sink(output_file, format, compression, partitions=partitions)
+            if journal is None
+            else get_sink(
+                output_file,
+                format,
+                compression,
+                append=True,
+                partitions=partitions,
+                offsets=journal.offsets(),
+                on_written=journal.record_written,
+            )
+        )
+    except BaseException:
+        if journal is not None:
+            journal.close()
+        raise
+    try:
+        with _instrumentation(
+            stats, trace_file, profile, cache_info=workers <= 1
+        ) as collected:
+            if workers > 1:
+                # with few files, relative roots of each file are split among workers
+                # (unless streamed, since their number is not known in advance,
+                # or journaled, since compositions are recorded by index in the file)
+                n_chunks = (
+                    max(1, workers // len(input_files))
+                    if relative_root and input_files and not stream and journal is None
+                    else 1
+                )
+                tasks = [
+                    (
+                        input_file,
+                        relative_root,
+                        skip_ehr_id,
+                        (i, n_chunks),
+                        stream,
+                        structured,
+                    )
+                    for input_file in input_files
+                    for i in range(n_chunks)
+                ]
+                with ProcessPoolExecutor(
+                    max_workers=workers,
+                    initializer=_init_worker,
+                    initargs=(
+                        template_file,
+                        conf_file,
+                        backend,
+                        collected.enabled,
+                        trace_file,
+                    ),
+                ) as executor:
+                    if ordered:
+                        results = executor.map(_process, tasks)
+                    else:
+                        results = (
+                            future.result()
+                            for future in as_completed(
+                                [executor.submit(_process, task) for task in tasks]
+                            )
+                        )
+                    for input_file, records, task_stats in results:
+                        if journal is None:
+                            sink.writelines(records)
+                        else:
+                            for index, record in enumerate(records):
+                                _write_unit(sink, journal, input_file, index, record)
+                            sink.flush()
+                            journal.complete_file(input_file)
+                        if task_stats:
+                            collected.merge(task_stats)
+            else:
+                conf = conf_from_file(conf_file)
+                template = template_from_file(template_file, backend)
+                for input_file in input_files:
+                    for index, (composition, ctx, ehr_id) in enumerate(
+                        generate(
+                            input_file, conf, template, relative_root, stream=stream
+                        )
+                    ):
+                        record = _format_record(
+                            composition, ctx, ehr_id, skip_ehr_id, structured
+                        )
+                        if journal is None:
+                            sink.write(*record)
+                        else:
+                            _write_unit(sink, journal, input_file, index, record)
+                    if journal is not None:
+                        sink.flush()
+                        journal.complete_file(input_file)
+    finally:
+        try:
+            sink.close()
+        finally:
+            if journal is not None:
+                journal.close()
+
+
+def _write_unit(
+    sink: Sink, journal: Journal, input_file: str, index: int, record: Record
+):
+    unit_hash = composition_hash(record[1])
+    if not journal.is_done(input_file, index, unit_hash):
+        # recorded by the sink once written
+        sink.write(*record, (input_file, index, unit_hash))
+
+
+_worker_conf: Optional[Config] = None
+_worker_template: Optional[Template] = None
+_worker_trace: Optional[IO] = None
+
+
+def _init_worker(
+    template_file: str,
+    conf_file: str,
+    backend: str = "anytree",
+    stats: bool = False,
+    trace_file: Optional[str] = None,
+):
+    global _worker_conf, _worker_template, _worker_trace
+    if stats:
+        # trace lines are appended by all the workers, each with a single write
+        _worker_trace = open(trace_file, "a", buffering=1) if trace_file else None
+        enable_stats(_worker_trace)
+    _worker_conf = conf_from_file(conf_file)
+    _worker_template = template_from_file(template_file, backend)
+
+
+def _process(
+    task: Tuple[str, Optional[str], bool, Tuple[int, int], bool, bool]
+) -> Tuple[str, List[Record], Optional[Dict]]:
+    """Returns the input file and the records of the task and, if enabled,
+    the stats collected since the previous task of the worker."""
+    input_file, relative_root, skip_ehr_id, chunk, stream, structured = task
+    records = [
+        _format_record(composition, ctx, ehr_id, skip_ehr_id, structured)
+        for composition, ctx, ehr_id in generate(
+            input_file,
+            cast(Config, _worker_conf),
+            cast(Template, _worker_template),
+            relative_root,
+            chunk,
+            stream,
+        )
+    ]
+    stats = get_stats()
+    if not stats.enabled:
+        return input_file, records, None
+    task_stats = stats.as_dict()
+    enable_stats(_worker_trace)
+    return input_file, records, task_stats
+
+
+def generate(
+    input_file: str,
+    conf: Config,
+    template: Template,
+    relative_root: Optional[str] = None,
+    chunk: Tuple[int, int] = (0, 1),
+    stream: bool = False,
+) -> Iterator[Tuple[Composition, Ctx, str]]:
+    """Yields the composition(s), their ctx and ehr_id built from a source file.
+    chunk (index, count) restricts the output to a contiguous slice of the relative roots."""
+    compositions = _get_handler(input_file)(
+        input_file, conf, template, relative_root, chunk, stream
+    )
+    stats = get_stats()
+    if stats.enabled:
+        return _end_compositions(compositions, stats, input_file)
+    return compositions
+
+
+def _end_compositions(
+    compositions: Iterator[Tuple[Composition, Ctx, str]], stats: Stats, input_file: str
+) -> Iterator[Tuple[Composition, Ctx, str]]:
+    # a composition ends when the next one is requested, i.e. after its serialization
+    stats.start_composition()
+    for composition, ctx, ehr_id in compositions:
+        yield composition, ctx, ehr_id
+        stats.end_composition(source=input_file, ehr_id=ehr_id)
+
+
+def from_xml(
+    input_file: Union[str, IO],
+    conf: Config,
+    template: Template,
+    relative_root: Optional[str] = None,
+    chunk: Tuple[int, int] = (0, 1),
+    stream: bool = False,
+) -> Iterator[Tuple[Composition, Ctx, str]]:
+    if stream and relative_root:
+        if chunk[0] > 0:
+            return
+        with _open_source(input_file, "rb") as f_obj:
+            for source in get_stats().iter(
+                "source.parse",
+                StreamingXPathSource(
+                    f_obj, list(conf.inverse_mappings.keys()), relative_root
+                ).iter_sources(),
+            ):
+                yield build_composition(conf, template, source.iter())
+        return
+
+    with get_stats().timer("source.parse"):
+        with _open_source(input_file, "r") as f_obj:
+            xpath_source = XPathSource(f_obj, list(conf.inverse_mappings.keys()))
+        relative_root_elements = (
+            xpath_source.get_elements(f"//ns:{relative_root}")
+            if relative_root
+            else [xpath_source.root]
+        )
+    index, count = chunk
+    n = len(relative_root_elements)
+    relative_root_elements = relative_root_elements[
+        n * index // count : n * (index + 1) // count
+    ]
     for el in relative_root_elements:
         xpath_source.relative_root = el
 
         source_kvs: Iterator[Tuple[SourceKey, Optional[str]]] = xpath_source.iter()
-        composition, ctx, ehr_id = build_composition(
+        yield build_composition(
             conf,
             template,
             source_kvs,
         )
-        _print_output(composition, ctx, None if skip_ehr_id else ehr_id)
 
 
 def from_json(
-    input_file: str,
-    *,
-    template_file: str,
-    conf_file: str,
+    input_file: Union[str, IO],
+    conf: Config,
+    template: Template,
     relative_root: Optional[str] = None,
-    skip_ehr_id: bool = False,
-):
+    chunk: Tuple[int, int] = (0, 1),
+    stream: bool = False,
+) -> Iterator[Tuple[Composition, Ctx, str]]:
+    if chunk[0] > 0:
+        return
+    if stream:
+        with _open_source(input_file, "r") as f_obj:
+            for source in get_stats().iter(
+                "source.parse",
+                StreamingJsonPathSource(
+                    f_obj, list(conf.inverse_mappings.keys())
+                ).iter_sources(),
+            ):
+                yield build_composition(conf, template, source.iter())
+        return
 
-    conf = conf_from_file(conf_file)
-    template = template_factory("anytree", json.load(open(template_file, "r"))).get()
-    jsonpath_source = JsonPathSource(
-        open(input_file, "r"), list(conf.inverse_mappings.keys())
-    )
+    with get_stats().timer("source.parse"):
+        with _open_source(input_file, "r") as f_obj:
+            jsonpath_source = JsonPathSource(
+                f_obj, list(conf.inverse_mappings.keys())
+            )
     source_kvs: Iterator[Tuple[SourceKey, Optional[str]]] = jsonpath_source.iter()
-    composition, ctx, ehr_id = build_composition(
+    yield build_composition(
         conf,
         template,
         source_kvs,
     )
-    _print_output(composition, ctx, None if skip_ehr_id else ehr_id)
 
 
-def _print_output(composition, ctx, ehr_id=None):
-    flat_comp = json.dumps(flat(composition, ctx))
-    if ehr_id:
-        print(ehr_id, flat_comp)
+def from_ndjson(
+    input_file: Union[str, IO],
+    conf: Config,
+    template: Template,
+    relative_root: Optional[str] = None,
+    chunk: Tuple[int, int] = (0, 1),
+    stream: bool = False,
+) -> Iterator[Tuple[Composition, Ctx, str]]:
+    if chunk[0] > 0:
+        return
+    with _open_source(input_file, "r") as f_obj:
+        for source in get_stats().iter(
+            "source.parse",
+            StreamingJsonPathSource(
+                f_obj, list(conf.inverse_mappings.keys()), ndjson=True
+            ).iter_sources(),
+        ):
+            yield build_composition(conf, template, source.iter())
+
+
+@contextmanager
+def _open_source(input_file: Union[str, IO], mode: str) -> Iterator[IO]:
+    # sources can also be file objects, like the request bodies of serve
+    if isinstance(input_file, str):
+        with open(input_file, mode) as f_obj:
+            yield f_obj
     else:
-        print(flat_comp)
+        yield input_file
+
+
+HANDLERS = {
+    ".xml": from_xml,
+    ".json": from_json,
+    ".ndjson": from_ndjson,
+    ".jsonl": from_ndjson,
+}
+
+
+def _get_handler(input_file: str):
+    ext = os.path.splitext(input_file)[1]
+    try:
+        return HANDLERS[ext]
+    except KeyError:
+        raise RuntimeError(
+            f"file {input_file} not supported, Supported types: {list(HANDLERS.keys())}"
+        )
+
+
+def _format_record(
+    composition, ctx, ehr_id, skip_ehr_id: bool, structured: bool = False
+) -> Record:
+    with get_stats().timer("serialization"):
+        serialized = json.dumps(
+            to_structured(composition, ctx) if structured else flat(composition, ctx)
+        )
+    return None if skip_ehr_id else ehr_id, serialized
 
 
-def skeleton(template_file: str):
+def skeleton(template_file: str, *, backend: str = "anytree"):
     """Generate a configuration skeleton for the given template.
 
-    :param template_file: the path to the web template (json)
+    :param template_file: the path to the web template (json) or compiled template
+    :param backend: template backend, anytree or compact
     """
-    template = template_factory("anytree", json.load(open(template_file, "r"))).get()
+    template = template_from_file(template_file, backend)
     print(template.get_conf_skeleton())
 
 
@@ -126,8 +655,14 @@ def date_isoformat(date: str) -> str:
     return parse_date(date).isoformat()
 
 
+def template_from_file(template_file: str, backend: str = "anytree") -> Template:
+    with get_stats().timer("template"):
+        return load_template(template_file, backend)
+
+
 def conf_from_file(conf_file: str) -> Config:
-    conf_kwargs = yaml.safe_load(open(conf_file, "r"))
+    with get_stats().timer("conf"):
+        conf_kwargs = yaml.safe_load(open(conf_file, "r"))
     return Config(
         paths=conf_kwargs["paths"],
         ehr_id=conf_kwargs["ehr_id"],
@@ -137,6 +672,49 @@ def conf_from_file(conf_file: str) -> Config:
     )
 
 
+@contextmanager
+def _instrumentation(
+    stats: bool,
+    trace_file: Optional[str],
+    profile: Optional[str],
+    cache_info: bool = True,
+) -> Iterator[Stats]:
+    """Enables stats (if stats or trace_file are set) and profiling for the
+    duration of the context. On exit, the stats summary is written on stderr
+    and the profile data to the profile file."""
+    trace = open(trace_file, "w", buffering=1) if trace_file else None
+    collected = enable_stats(trace) if stats or trace else get_stats()
+    profiler = cProfile.Profile() if profile else None
+    if profiler:
+        profiler.enable()
+    try:
+        yield collected
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile)
+        if collected.enabled:
+            disable_stats()
+            summary = collected.as_dict()
+            if cache_info:
+                summary["caches"] = _cache_info()
+            sys.stderr.write(json.dumps(summary) + "\n")
+        if trace:
+            trace.close()
+
+
+def _cache_info() -> Dict[str, Dict[str, int]]:
+    return {
+        name: cached.cache_info()._asdict()
+        for name, cached in (
+            ("jq", compile_jq),
+            ("date_isoformat", _date_isoformat),
+            ("jsonpath", compile_path),
+            ("xpath", compile_paths),
+        )
+    }
+
+
 if __name__ == "__main__":
     import defopt
 
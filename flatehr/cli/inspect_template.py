@@ -2,21 +2,18 @@ import json
 
 from anytree import RenderTree
 
-from flatehr.factory import template_factory
+from flatehr.artifact import load_template
 
 
 def main(template_file: str, *, aql_path: bool = False, inputs: bool = False):
     """Shows the template tree, with info about type, cardinality,
     requiredness and optionally aql path and expected inputs.
 
-    :param template_file: path to the web template (json)
+    :param template_file: path to the web template (json) or compiled template
     :param aql_path: flag, if true shows the aql path for each node
     :param inputs: flag, if true shows the inputs for each node
     """
-    with open(template_file, "r") as f_obj:
-        template_dict = json.load(f_obj)
-
-    template = template_factory("anytree", template_dict).get()
+    template = load_template(template_file, "anytree")
 
     for pre, _, node in RenderTree(template.root):
         try:
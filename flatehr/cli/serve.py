@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import io
+import json
+import logging
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from http import HTTPStatus
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from lxml import etree
+from pyaml import yaml
+
+from flatehr.build import Config
+from flatehr.cli.generate import HANDLERS, conf_from_file, template_from_file
+from flatehr.core import Template, flat
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_SIZE = 64 << 20
+MEDIA_TYPES = {
+    "application/xml": "xml",
+    "text/xml": "xml",
+    "application/json": "json",
+    "application/x-ndjson": "ndjson",
+    "application/jsonl": "ndjson",
+}
+
+
+class InvalidPayload(Exception):
+    ...
+
+
+class _Service:
+    def __init__(self, conf: Config, template: Template, relative_root: Optional[str]):
+        self.conf = conf
+        self.template = template
+        self.relative_root = relative_root
+
+
+_services: Dict[str, _Service] = {}
+
+
+def load_services(templates_file: str) -> Dict[str, _Service]:
+    """Loads the templates listed in a yaml file like:
+
+    <template id>:
+      template_file: <web template (or compiled template) path>
+      conf_file: <yaml configuration path>
+      relative_root: <optional id for the root(s) that maps 1:1 to composition>
+      backend: <optional template backend, anytree (default) or compact>
+    """
+    with open(templates_file, "r") as f_obj:
+        templates = yaml.safe_load(f_obj)
+    return {
+        template_id: _Service(
+            conf_from_file(service["conf_file"]),
+            template_from_file(
+                service["template_file"], service.get("backend", "anytree")
+            ),
+            service.get("relative_root"),
+        )
+        for template_id, service in templates.items()
+    }
+
+
+def _init_worker(templates_file: str):
+    global _services
+    _services = load_services(templates_file)
+
+
+def convert(
+    template_id: str,
+    payload: bytes,
+    source_format: str,
+    relative_root: Optional[str],
+    stream: bool = False,
+) -> bytes:
+    """Returns the json array of the compositions built from payload, as by
+    generate from-file (with --stream if stream is set), as objects with ehr_id
+    and composition (flat)."""
+    service = _services[template_id]
+    try:
+        f_obj = (
+            io.BytesIO(payload)
+            if source_format == "xml"
+            else io.StringIO(payload.decode())
+        )
+        compositions = list(
+            HANDLERS[f".{source_format}"](
+                f_obj,
+                service.conf,
+                service.template,
+                relative_root or service.relative_root,
+                stream=stream,
+            )
+        )
+    except (etree.XMLSyntaxError, UnicodeDecodeError, ValueError) as ex:
+        # lxml exceptions can not be pickled, only the message is returned
+        raise InvalidPayload(str(ex)) from None
+
+    return json.dumps(
+        [
+            {"ehr_id": ehr_id, "composition": flat(composition, ctx)}
+            for composition, ctx, ehr_id in compositions
+        ]
+    ).encode()
+
+
+class Server:
+    """HTTP/1.1 server converting sources into flat compositions with the preloaded
+    templates. Builds run in the executor, so that the event loop only handles I/O.
+
+    POST /templates/{id}/compositions[?relative_root=<id>][&stream=true]: converts
+        the body (Content-Type application/xml, application/json or
+        application/x-ndjson) as generate from-file (with --stream if stream is set)
+    GET /templates: lists the template ids
+    """
+
+    def __init__(
+        self,
+        template_ids: List[str],
+        executor: Executor,
+        max_body_size: int = MAX_BODY_SIZE,
+    ):
+        self._template_ids = template_ids
+        self._executor = executor
+        self._max_body_size = max_body_size
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+
+    @property
+    def port(self) -> int:
+        return self._server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self):
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        try:
+            keep_alive = True
+            while keep_alive:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode("latin-1").split()
+                headers = await _read_headers(reader)
+                keep_alive = (
+                    version == "HTTP/1.1"
+                    and headers.get("connection", "").lower() != "close"
+                )
+
+                if "transfer-encoding" in headers:
+                    status, body = _error(HTTPStatus.LENGTH_REQUIRED)
+                    keep_alive = False
+                else:
+                    length = int(headers.get("content-length", 0))
+                    if length > self._max_body_size:
+                        status, body = _error(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+                        keep_alive = False
+                    else:
+                        payload = await reader.readexactly(length)
+                        status, body = await self._dispatch(
+                            method, target, headers, payload
+                        )
+                _write_response(writer, status, body, keep_alive)
+                await writer.drain()
+        except (ValueError, asyncio.IncompleteReadError):
+            _write_response(writer, *_error(HTTPStatus.BAD_REQUEST), False)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(
+        self, method: str, target: str, headers: Dict[str, str], payload: bytes
+    ) -> Tuple[HTTPStatus, bytes]:
+        url = urlsplit(target)
+        parts = url.path.strip("/").split("/")
+
+        if parts == ["templates"]:
+            if method != "GET":
+                return _error(HTTPStatus.METHOD_NOT_ALLOWED)
+            return HTTPStatus.OK, json.dumps(self._template_ids).encode()
+
+        if len(parts) != 3 or parts[0] != "templates" or parts[2] != "compositions":
+            return _error(HTTPStatus.NOT_FOUND)
+        template_id = parts[1]
+        if template_id not in self._template_ids:
+            return _error(HTTPStatus.NOT_FOUND, f"template {template_id} not found")
+        if method != "POST":
+            return _error(HTTPStatus.METHOD_NOT_ALLOWED)
+
+        media_type = headers.get("content-type", "").split(";")[0].strip().lower()
+        try:
+            source_format = MEDIA_TYPES[media_type]
+        except KeyError:
+            return _error(
+                HTTPStatus.UNSUPPORTED_MEDIA_TYPE,
+                f"supported types: {list(MEDIA_TYPES.keys())}",
+            )
+        query = parse_qs(url.query)
+        relative_root = query.get("relative_root", [None])[0]
+        stream = query.get("stream", ["false"])[0].lower() in ("true", "1")
+
+        try:
+            body = await asyncio.get_running_loop().run_in_executor(
+                self._executor,
+                convert,
+                template_id,
+                payload,
+                source_format,
+                relative_root,
+                stream,
+            )
+        except InvalidPayload as ex:
+            return _error(HTTPStatus.BAD_REQUEST, str(ex))
+        except Exception:
+            # details are only logged, not sent to clients
+            logger.exception("conversion failed for template %s", template_id)
+            return _error(HTTPStatus.INTERNAL_SERVER_ERROR)
+        return HTTPStatus.OK, body
+
+
+async def _read_headers(reader: asyncio.StreamReader) -> Dict[str, str]:
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            return headers
+        key, value = line.decode("latin-1").split(":", 1)
+        headers[key.strip().lower()] = value.strip()
+
+
+def _error(status: HTTPStatus, message: Optional[str] = None) -> Tuple[HTTPStatus, bytes]:
+    return status, json.dumps({"error": message or status.phrase}).encode()
+
+
+def _write_response(
+    writer: asyncio.StreamWriter, status: HTTPStatus, body: bytes, keep_alive: bool
+):
+    writer.write(
+        (
+            f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+            "\r\n"
+        ).encode("latin-1")
+        + body
+    )
+
+
+def main(
+    templates_file: str,
+    *,
+    host: str = "127.0.0.1",
+    port: int = 8080,
+    workers: int = 1,
+    max_body_size: int = MAX_BODY_SIZE,
+):
+    """
+    Starts an HTTP server generating flat compositions with templates and configurations
+    loaded only once, at startup.
+    POST /templates/{id}/compositions converts the body (xml, json or ndjson, as set by
+    Content-Type) and returns a json array of {"ehr_id": ..., "composition": ...}.
+    An optional relative_root query parameter overrides the one of the template;
+    with stream=true, the body is read as by generate from-file --stream
+    (e.g. each element of a top level json array is a composition).
+
+    :param templates_file: yaml file mapping each template id to template_file,
+        conf_file and (optionally) relative_root and backend
+    :param host: address to bind
+    :param port: port to bind
+    :param workers: number of worker processes building compositions;
+        if 0, compositions are built by a thread of the server process
+    :param max_body_size: maximum size (bytes) of a request body
+    """
+    _init_worker(templates_file)
+    template_ids = list(_services.keys())
+    executor: Executor = (
+        ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(templates_file,)
+        )
+        if workers > 0
+        else ThreadPoolExecutor(max_workers=1)
+    )
+
+    async def _serve():
+        server = Server(template_ids, executor, max_body_size)
+        await server.start(host, port)
+        logger.info("serving %s on %s:%s", template_ids, host, server.port)
+        await server.serve_forever()
+
+    try:
+        asyncio.run(_serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        executor.shutdown()
+
+
+if __name__ == "__main__":
+    import defopt
+
+    defopt.run(main)
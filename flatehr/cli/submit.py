@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import glob
+import json
+import sys
+from typing import Dict, List, Optional, Tuple
+
+from flatehr.cli.generate import (
+    _get_handler,
+    conf_from_file,
+    generate,
+    template_from_file,
+)
+from flatehr.client import (
+    EHR_CACHE_SIZE,
+    Checkpoint,
+    EhrResolver,
+    OpenEhrClient,
+    Submitter,
+    Unit,
+)
+from flatehr.core import flat
+from flatehr.journal import Journal, composition_hash, file_hash
+
+
+def main(
+    pattern: str,
+    *,
+    template_file: str,
+    conf_file: str,
+    url: str,
+    template_id: str,
+    relative_root: Optional[str] = None,
+    stream: bool = False,
+    login: Optional[str] = None,
+    concurrency: int = 4,
+    retries: int = 3,
+    backoff: float = 0.5,
+    queue_size: Optional[int] = None,
+    failure_log: Optional[str] = None,
+    checkpoint_file: Optional[str] = None,
+    subject_namespace: Optional[str] = None,
+    subject_scheme: str = "id_scheme",
+    batch_size: int = 100,
+    ehr_cache_size: int = EHR_CACHE_SIZE,
+    ehr_cache_file: Optional[str] = None,
+    journal_file: Optional[str] = None,
+    only_changed: bool = False,
+    backend: str = "anytree",
+):
+    """
+    Generates compositions from all the files matching a glob pattern and posts them
+    (flat format) to an openEHR REST endpoint, like EHRbase.
+    Prints on stderr the number of submitted and failed compositions.
+
+    :param pattern: glob pattern matching the source files
+    :param template_file: web template (or compiled template) path
+    :param conf_file: yaml configuration path
+    :param url: base url of the openEHR server, like http://localhost:8080/ehrbase
+    :param template_id: id of the template on the openEHR server
+    :param relative_root: id for the root(s) that maps 1:1 to composition
+    :param stream: if set, sources are read incrementally (see generate)
+    :param login: user:password for basic authentication
+    :param concurrency: number of concurrent requests, each with a keep-alive connection
+    :param retries: retries of a request failed for connection errors or 408, 429 and 5xx statuses
+    :param backoff: seconds before the first retry, doubled at every retry
+    :param queue_size: compositions built and waiting to be submitted, by default twice the concurrency
+    :param failure_log: file where failed compositions are appended as json lines
+    :param checkpoint_file: file where completed sources are appended;
+        sources already there are skipped, so that an interrupted submission can be resumed
+    :param subject_namespace: if set, the ehr id of the configuration is a subject id
+        (in this namespace), resolved into the id of its EHR (created if missing)
+    :param subject_scheme: scheme of the subject ids of the created EHRs
+    :param batch_size: compositions whose subject ids are resolved together
+    :param ehr_cache_size: subject ids whose EHR id is kept in memory
+    :param ehr_cache_file: sqlite file where resolved EHR ids are kept between runs
+    :param journal_file: sqlite file recording processed files and submitted compositions;
+        files already processed are skipped, and compositions already submitted are not
+        submitted again, so that an interrupted run can be resumed
+    :param only_changed: if set with --journal-file, processed files are processed again
+        if their content, the configuration or the template have changed
+    :param backend: template backend, anytree or compact (faster to load and build)
+    """
+    input_files = sorted(glob.iglob(pattern, recursive=True))
+    for input_file in input_files:
+        _get_handler(input_file)
+
+    conf = conf_from_file(conf_file)
+    template = template_from_file(template_file, backend)
+    checkpoint = Checkpoint(checkpoint_file) if checkpoint_file else None
+    journal = (
+        Journal(
+            journal_file, file_hash(conf_file), file_hash(template_file), only_changed
+        )
+        if journal_file
+        else None
+    )
+    failure_log_obj = open(failure_log, "a") if failure_log else None
+    client = OpenEhrClient(url, login)
+    submitter = Submitter(
+        client,
+        template_id,
+        concurrency=concurrency,
+        retries=retries,
+        backoff=backoff,
+        queue_size=queue_size,
+        failure_log=failure_log_obj,
+        checkpoint=checkpoint,
+        journal=journal,
+    )
+    resolver = (
+        EhrResolver(
+            client,
+            subject_namespace,
+            scheme=subject_scheme,
+            concurrency=concurrency,
+            retries=retries,
+            backoff=backoff,
+            cache_size=ehr_cache_size,
+            cache_file=ehr_cache_file,
+        )
+        if subject_namespace
+        else None
+    )
+    # (source, ehr id, composition, unit), composition is None when the source ends
+    batch: List[Tuple[str, str, Optional[Dict], Optional[Unit]]] = []
+    try:
+        for input_file in input_files:
+            if checkpoint is not None and input_file in checkpoint:
+                continue
+            if journal is not None and not journal.start_file(
+                input_file, file_hash(input_file)
+            ):
+                continue
+            for index, (composition, ctx, ehr_id) in enumerate(
+                generate(input_file, conf, template, relative_root, stream=stream)
+            ):
+                flat_composition = flat(composition, ctx)
+                unit = None
+                if journal is not None:
+                    unit = (index, composition_hash(json.dumps(flat_composition)))
+                    if journal.is_done(input_file, *unit):
+                        continue
+                batch.append((input_file, ehr_id, flat_composition, unit))
+                if len(batch) >= batch_size or resolver is None:
+                    _submit_batch(batch, submitter, resolver)
+            batch.append((input_file, "", None, None))
+            if resolver is None:
+                _submit_batch(batch, submitter, resolver)
+        _submit_batch(batch, submitter, resolver)
+    finally:
+        try:
+            submitter.close()
+        finally:
+            if resolver is not None:
+                resolver.close()
+            if checkpoint is not None:
+                checkpoint.close()
+            if journal is not None:
+                journal.close()
+            if failure_log_obj:
+                failure_log_obj.close()
+    print(
+        f"submitted: {submitter.submitted}, failed: {submitter.failed}",
+        file=sys.stderr,
+    )
+
+
+def _submit_batch(
+    batch: List[Tuple[str, str, Optional[Dict], Optional[Unit]]],
+    submitter: Submitter,
+    resolver: Optional[EhrResolver],
+):
+    if resolver is not None:
+        ehr_ids, errors = resolver.resolve(
+            ehr_id for _, ehr_id, composition, _ in batch if composition is not None
+        )
+    for source, ehr_id, composition, unit in batch:
+        if composition is None:
+            submitter.end_source(source)
+        elif resolver is None:
+            submitter.submit(source, ehr_id, composition, unit)
+        elif ehr_id in errors:
+            submitter.fail(source, ehr_id, composition, errors[ehr_id], unit)
+        else:
+            submitter.submit(source, ehr_ids[ehr_id], composition, unit)
+    batch.clear()
+
+
+if __name__ == "__main__":
+    import defopt
+
+    defopt.run(main)
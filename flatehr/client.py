@@ -0,0 +1,540 @@
+"""Submission of flat compositions to an openEHR (EHRbase) REST endpoint."""
+
+import base64
+import http.client
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import (
+    IO,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+    cast,
+)
+from urllib.parse import urlencode, urlsplit
+
+from flatehr.journal import DONE, FAILED, Journal
+
+logger = logging.getLogger(__name__)
+
+# statuses worth a retry, any other error status is final
+RETRY_STATUSES = frozenset((408, 429, 500, 502, 503, 504))
+EHR_CACHE_SIZE = 100_000
+# subject ids per query of the on-disk cache, below the sqlite variables limit
+_SQLITE_CHUNK = 500
+
+T = TypeVar("T")
+# index of a composition in its source and hash of the composition
+Unit = Tuple[int, str]
+
+
+class SubmissionError(Exception):
+    def __init__(self, status: Optional[int], message: str):
+        super().__init__(f"{status}: {message}" if status else message)
+        self.status = status
+        self.message = message
+
+
+def retry(call: Callable[[], T], retries: int, backoff: float) -> T:
+    """Returns call(), retried with exponential backoff for connection errors
+    and statuses in RETRY_STATUSES."""
+    if retries < 0:
+        raise ValueError(f"invalid number of retries {retries}")
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        try:
+            return call()
+        except (OSError, http.client.HTTPException) as ex:
+            error = SubmissionError(None, str(ex))
+        except SubmissionError as ex:
+            if ex.status not in RETRY_STATUSES:
+                raise
+            error = ex
+        logger.debug("attempt %s failed: %s", attempt, error)
+    raise error
+
+
+class OpenEhrClient:
+    """Minimal openEHR REST client. Each thread uses its own keep-alive connection,
+    so that a composition costs a request, not a TCP/TLS handshake."""
+
+    def __init__(
+        self,
+        base_url: str,
+        login: Optional[str] = None,
+        timeout: float = 30.0,
+    ):
+        url = urlsplit(base_url)
+        if url.scheme not in ("http", "https"):
+            raise ValueError(f"unsupported url {base_url}")
+        self._scheme = url.scheme
+        self._netloc = url.netloc
+        self._base_path = url.path.rstrip("/")
+        self._timeout = timeout
+        self._headers = {"Content-Type": "application/json", "Accept": "application/json"}
+        if login:
+            self._headers["Authorization"] = (
+                f"Basic {base64.b64encode(login.encode()).decode()}"
+            )
+        self._local = threading.local()
+
+    def _connection(self) -> http.client.HTTPConnection:
+        try:
+            return self._local.connection
+        except AttributeError:
+            connection_class = (
+                http.client.HTTPSConnection
+                if self._scheme == "https"
+                else http.client.HTTPConnection
+            )
+            connection = self._local.connection = connection_class(
+                self._netloc, timeout=self._timeout
+            )
+            return connection
+
+    def _reset_connection(self):
+        try:
+            self._local.connection.close()
+            del self._local.connection
+        except AttributeError:
+            pass
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        params: Optional[Dict[str, str]] = None,
+        body: Optional[bytes] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> Tuple[int, bytes]:
+        """Returns status and body of the response. Connection errors are raised
+        after closing the connection, that is opened again by the next request."""
+        url = f"{self._base_path}{path}"
+        if params:
+            url += f"?{urlencode(params)}"
+        try:
+            connection = self._connection()
+            connection.request(
+                method,
+                url,
+                body=body,
+                headers=dict(self._headers, **headers) if headers else self._headers,
+            )
+            response = connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            self._reset_connection()
+            raise
+        if response.will_close:
+            self._reset_connection()
+        return response.status, data
+
+    def post_composition(self, ehr_id: str, template_id: str, composition: Dict):
+        status, body = self.request(
+            "POST",
+            "/rest/ecis/v1/composition",
+            {"format": "FLAT", "ehrId": ehr_id, "templateId": template_id},
+            json.dumps(composition).encode(),
+        )
+        _check_status(status, body)
+
+    def get_ehr_id(self, subject_id: str, namespace: str) -> Optional[str]:
+        """Returns the id of the EHR of the subject, None if it does not exist."""
+        status, body = self.request(
+            "GET",
+            "/rest/openehr/v1/ehr",
+            {"subject_id": subject_id, "subject_namespace": namespace},
+        )
+        if status == 404:
+            return None
+        _check_status(status, body)
+        return json.loads(body)["ehr_id"]["value"]
+
+    def create_ehr(
+        self, subject_id: str, namespace: str, scheme: str = "id_scheme"
+    ) -> str:
+        """Creates an EHR for the subject (whose id is in the given scheme),
+        returns its id."""
+        ehr_status = {
+            "_type": "EHR_STATUS",
+            "archetype_node_id": "openEHR-EHR-EHR_STATUS.generic.v1",
+            "name": {"value": "EHR Status"},
+            "subject": {
+                "external_ref": {
+                    "id": {"_type": "GENERIC_ID", "value": subject_id, "scheme": scheme},
+                    "namespace": namespace,
+                    "type": "PERSON",
+                }
+            },
+            "is_modifiable": True,
+            "is_queryable": True,
+        }
+        status, body = self.request(
+            "POST",
+            "/rest/openehr/v1/ehr",
+            body=json.dumps(ehr_status).encode(),
+            headers={"Prefer": "return=representation"},
+        )
+        _check_status(status, body)
+        return json.loads(body)["ehr_id"]["value"]
+
+    @property
+    def base_url(self) -> str:
+        return f"{self._scheme}://{self._netloc}{self._base_path}"
+
+    def close(self):
+        self._reset_connection()
+
+
+def _check_status(status: int, body: bytes):
+    if status >= 300:
+        raise SubmissionError(status, body.decode(errors="replace"))
+
+
+class EhrResolver:
+    """Resolves subject ids into EHR ids, creating the missing EHRs.
+    Resolved ids are kept in an LRU of cache_size entries and, if cache_file is set,
+    in a sqlite database, so that a subject is looked up on the server only once.
+    openEHR REST has no bulk EHR endpoints: the distinct subject ids of a batch
+    that are not cached are looked up (and then created) with concurrency requests.
+    Failed lookups and creations are returned as errors of their subjects."""
+
+    def __init__(
+        self,
+        client: OpenEhrClient,
+        namespace: str,
+        *,
+        scheme: str = "id_scheme",
+        concurrency: int = 4,
+        retries: int = 3,
+        backoff: float = 0.5,
+        cache_size: int = EHR_CACHE_SIZE,
+        cache_file: Optional[str] = None,
+    ):
+        self._client = client
+        self._namespace = namespace
+        self._scheme = scheme
+        self._retries = retries
+        self._backoff = backoff
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._cache_size = cache_size
+        self._lru: "OrderedDict[str, str]" = OrderedDict()
+        self._db: Optional[sqlite3.Connection] = None
+        if cache_file:
+            self._db = sqlite3.connect(cache_file)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS ehr (server TEXT, namespace TEXT,"
+                " subject_id TEXT, ehr_id TEXT, PRIMARY KEY (server, namespace, subject_id))"
+            )
+            self._db.commit()
+
+    def resolve(
+        self, subject_ids: Iterable[str]
+    ) -> Tuple[Dict[str, str], Dict[str, SubmissionError]]:
+        """Returns the EHR ids and the errors by subject id."""
+        resolved: Dict[str, str] = {}
+        missing: List[str] = []
+        for subject_id in dict.fromkeys(subject_ids):
+            try:
+                resolved[subject_id] = self._lru[subject_id]
+                self._lru.move_to_end(subject_id)
+            except KeyError:
+                missing.append(subject_id)
+
+        if missing and self._db is not None:
+            stored = self._load(missing)
+            self._remember(stored)
+            resolved.update(stored)
+            missing = [subject_id for subject_id in missing if subject_id not in stored]
+
+        errors: Dict[str, SubmissionError] = {}
+        if missing:
+            found = self._call_all(self._client.get_ehr_id, missing, errors)
+            created = self._call_all(
+                partial(self._client.create_ehr, scheme=self._scheme),
+                [s for s in missing if s not in errors and found[s] is None],
+                errors,
+            )
+            new = {
+                subject_id: cast(str, found[subject_id] or created[subject_id])
+                for subject_id in missing
+                if subject_id not in errors
+            }
+            self._remember(new)
+            self._store(new)
+            resolved.update(new)
+        return resolved, errors
+
+    def _call_all(
+        self,
+        func: Callable[[str, str], T],
+        subject_ids: List[str],
+        errors: Dict[str, SubmissionError],
+    ) -> Dict[str, T]:
+        futures = {
+            subject_id: self._executor.submit(
+                retry,
+                lambda subject_id=subject_id: func(subject_id, self._namespace),
+                self._retries,
+                self._backoff,
+            )
+            for subject_id in subject_ids
+        }
+        results = {}
+        for subject_id, future in futures.items():
+            try:
+                results[subject_id] = future.result()
+            except SubmissionError as ex:
+                errors[subject_id] = ex
+            except Exception as ex:
+                # e.g. an unexpected response body, only this subject fails
+                logger.warning("ehr of subject %s not resolved: %r", subject_id, ex)
+                errors[subject_id] = SubmissionError(None, f"{type(ex).__name__}: {ex}")
+        return results
+
+    def _remember(self, ehr_ids: Dict[str, str]):
+        self._lru.update(ehr_ids)
+        while len(self._lru) > self._cache_size:
+            self._lru.popitem(last=False)
+
+    def _load(self, subject_ids: List[str]) -> Dict[str, str]:
+        db = cast(sqlite3.Connection, self._db)
+        stored = {}
+        for i in range(0, len(subject_ids), _SQLITE_CHUNK):
+            chunk = subject_ids[i : i + _SQLITE_CHUNK]
+            stored.update(
+                db.execute(
+                    "SELECT subject_id, ehr_id FROM ehr WHERE server = ? AND namespace = ?"
+                    f" AND subject_id IN ({', '.join('?' * len(chunk))})",
+                    [self._client.base_url, self._namespace, *chunk],
+                )
+            )
+        return stored
+
+    def _store(self, ehr_ids: Dict[str, str]):
+        if self._db is None or not ehr_ids:
+            return
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO ehr VALUES (?, ?, ?, ?)",
+                [
+                    (self._client.base_url, self._namespace, subject_id, ehr_id)
+                    for subject_id, ehr_id in ehr_ids.items()
+                ],
+            )
+
+    def close(self):
+        self._executor.shutdown()
+        if self._db is not None:
+            self._db.close()
+
+
+class Checkpoint:
+    """Sources whose compositions have all been submitted (or logged as failed),
+    appended to a file, a line for each source."""
+
+    def __init__(self, checkpoint_file: str):
+        self._completed: Set[str] = set()
+        if os.path.exists(checkpoint_file):
+            with open(checkpoint_file, "r") as f_obj:
+                self._completed = {line.rstrip("\n") for line in f_obj if line.strip()}
+        self._f_obj = open(checkpoint_file, "a")
+        self._lock = threading.Lock()
+
+    def __contains__(self, source: str) -> bool:
+        return source in self._completed
+
+    def add(self, source: str):
+        with self._lock:
+            self._completed.add(source)
+            self._f_obj.write(f"{source}\n")
+            self._f_obj.flush()
+
+    def close(self):
+        self._f_obj.close()
+
+
+class Submitter:
+    """Posts compositions with concurrency threads, each with its own connection.
+    submit() blocks while queue_size compositions are waiting, so that building never
+    runs too far ahead of submission. Failed requests are retried with exponential
+    backoff; compositions still failing are written to failure_log as json lines.
+    If journal is set, compositions submitted with a unit (index in the source and
+    composition hash) are recorded as done or failed, and sources as completed.
+    Any other error of a thread (e.g. of journal or checkpoint) stops the submission:
+    it is raised by the following submit, end_source or close."""
+
+    def __init__(
+        self,
+        client: OpenEhrClient,
+        template_id: str,
+        *,
+        concurrency: int = 4,
+        retries: int = 3,
+        backoff: float = 0.5,
+        queue_size: Optional[int] = None,
+        failure_log: Optional[IO] = None,
+        checkpoint: Optional[Checkpoint] = None,
+        journal: Optional[Journal] = None,
+    ):
+        self._client = client
+        self._template_id = template_id
+        self._retries = retries
+        self._backoff = backoff
+        self._failure_log = failure_log
+        self._checkpoint = checkpoint
+        self._journal = journal
+        self._queue: "queue.Queue[Optional[Tuple[str, str, Dict, Optional[Unit]]]]" = (
+            queue.Queue(maxsize=queue_size or 2 * concurrency)
+        )
+        self._lock = threading.Lock()
+        # compositions not yet submitted by source, and sources with no more compositions
+        self._pending: Dict[str, int] = {}
+        self._ended: Set[str] = set()
+        self.submitted = 0
+        self.failed = 0
+        self._error: Optional[Exception] = None
+        self._threads = [
+            threading.Thread(target=self._run, daemon=True) for _ in range(concurrency)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(
+        self, source: str, ehr_id: str, composition: Dict, unit: Optional[Unit] = None
+    ):
+        self._raise_error()
+        with self._lock:
+            self._pending[source] = self._pending.get(source, 0) + 1
+        self._queue.put((source, ehr_id, composition, unit))
+
+    def fail(
+        self,
+        source: str,
+        ehr_id: str,
+        composition: Dict,
+        ex: SubmissionError,
+        unit: Optional[Unit] = None,
+    ):
+        """Logs a composition that can not be submitted, like those
+        whose ehr id can not be resolved."""
+        self._log_failure(source, ehr_id, composition, ex)
+        self._record(source, unit, FAILED)
+
+    def end_source(self, source: str):
+        """Marks that all the compositions of source have been submitted."""
+        self._raise_error()
+        with self._lock:
+            self._ended.add(source)
+            completed = not self._pending.get(source)
+        if completed:
+            self._complete(source)
+
+    def close(self):
+        """Waits for all the submitted compositions."""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    return
+                # after an error, compositions are discarded, so that the producer
+                # is not blocked on a full queue before seeing it
+                if self._error is not None:
+                    continue
+                try:
+                    self._process(*item)
+                except Exception as ex:
+                    logger.exception("submission stopped")
+                    with self._lock:
+                        self._error = self._error or ex
+        finally:
+            self._client.close()
+
+    def _process(
+        self, source: str, ehr_id: str, composition: Dict, unit: Optional[Unit]
+    ):
+        try:
+            self._post(ehr_id, composition)
+        except SubmissionError as ex:
+            self._log_failure(source, ehr_id, composition, ex)
+            self._record(source, unit, FAILED)
+        else:
+            with self._lock:
+                self.submitted += 1
+            self._record(source, unit, DONE)
+        self._done(source)
+
+    def _post(self, ehr_id: str, composition: Dict):
+        retry(
+            lambda: self._client.post_composition(
+                ehr_id, self._template_id, composition
+            ),
+            self._retries,
+            self._backoff,
+        )
+
+    def _log_failure(
+        self, source: str, ehr_id: str, composition: Dict, ex: SubmissionError
+    ):
+        logger.warning("composition for ehr %s from %s failed: %s", ehr_id, source, ex)
+        with self._lock:
+            self.failed += 1
+            if self._failure_log is not None:
+                self._failure_log.write(
+                    json.dumps(
+                        {
+                            "source": source,
+                            "ehr_id": ehr_id,
+                            "status": ex.status,
+                            "error": ex.message,
+                            "composition": composition,
+                        }
+                    )
+                    + "\n"
+                )
+                self._failure_log.flush()
+
+    def _record(self, source: str, unit: Optional[Unit], status: str):
+        if self._journal is not None and unit is not None:
+            self._journal.record(source, *unit, status)
+
+    def _done(self, source: str):
+        with self._lock:
+            self._pending[source] -= 1
+            completed = not self._pending[source] and source in self._ended
+        if completed:
+            self._complete(source)
+
+    def _complete(self, source: str):
+        with self._lock:
+            self._pending.pop(source, None)
+            self._ended.discard(source)
+        if self._checkpoint is not None:
+            self._checkpoint.add(source)
+        if self._journal is not None:
+            self._journal.complete_file(source)
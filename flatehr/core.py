@@ -1,9 +1,20 @@
 import abc
+import json
 import logging
 import os
 import re
 from dataclasses import dataclass
-from typing import Dict, List, Optional, Sequence, Tuple, TypeVar, Union, cast
+from typing import (
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+    Union,
+    cast,
+)
 
 from pipe import map
 
@@ -14,6 +25,10 @@ TemplatePath = str
 
 TNode = TypeVar("TNode", bound="_Node")
 
+# template nodes from a required child (included) to one of its required leaves,
+# and the leaf default values
+DefaultLeaf = Tuple[Tuple["TemplateNode", ...], Dict[str, str]]
+
 
 @dataclass
 class NullFlavour(Dict):
@@ -55,6 +70,8 @@ class NullFlavour(Dict):
 
 
 class _Node(abc.ABC):
+    __slots__ = ()
+
     @property
     @abc.abstractmethod
     def children(self: TNode) -> List[TNode]:
@@ -99,17 +116,83 @@ class _Node(abc.ABC):
 
 
 class Template:
-    def __init__(self, root: "TemplateNode"):
+    def __init__(self, root: "TemplateNode", backend: str = "anytree"):
         self._root = root
+        self._backend = backend
+        # every node by its path (without cardinality), root included
+        self._nodes: Dict[TemplatePath, "TemplateNode"] = {}
+        stack = [(root, root._id)]
+        while stack:
+            node, path = stack.pop()
+            self._nodes[path] = node
+            for child in node.children:
+                stack.append((child, f"{path}/{child._id}"))
+        self._required_defaults: Dict[
+            TemplatePath, Dict[str, Tuple[DefaultLeaf, ...]]
+        ] = {}
+        self._nodes_json: Dict[TemplatePath, str] = {}
 
     @property
     def root(self) -> "TemplateNode":
         return self._root
 
+    @property
+    def backend(self) -> str:
+        return self._backend
+
     def __getitem__(self, path: str) -> "TemplateNode":
+        try:
+            return self._nodes[path]
+        except KeyError:
+            pass
+        try:
+            return self._nodes[remove_cardinality(path).strip("/")]
+        except KeyError:
+            pass
         path = os.path.relpath(path, self.root._id)
         return cast(TemplateNode, self.root.get(path))
 
+    def node_json(self, path: TemplatePath) -> str:
+        """Returns the json of the node at path, serialized once
+        (as input for jq)."""
+        try:
+            return self._nodes_json[path]
+        except KeyError:
+            node_json = self._nodes_json[path] = json.dumps(self[path].json())
+            return node_json
+
+    def required_defaults(
+        self, path: TemplatePath
+    ) -> Dict[str, Tuple[DefaultLeaf, ...]]:
+        """Returns, by id of the required, not in context children of the node
+        at path (without cardinality), the required, not in context leaves reachable
+        through required nodes, in pre-order. Computed once for each node."""
+        try:
+            return self._required_defaults[path]
+        except KeyError:
+            pass
+
+        required_defaults = {}
+        for child in self[path].children:
+            if not child.required or child.in_context:
+                continue
+            leaves = []
+            stack = [(child, (child,))]
+            while stack:
+                node, branch = stack.pop()
+                if node.is_leaf:
+                    if not node.in_context:
+                        leaves.append((branch, default_values(node.inputs)))
+                    continue
+                for grandchild in reversed(node.children):
+                    if grandchild.required:
+                        stack.append((grandchild, branch + (grandchild,)))
+            if leaves:
+                required_defaults[child._id] = tuple(leaves)
+
+        self._required_defaults[path] = required_defaults
+        return required_defaults
+
     def get_conf_skeleton(self) -> str:
         conf_skeleton = set()
         indent = "  "
@@ -210,7 +293,12 @@ class Composition:
         return re.sub(f"(\/?{self._root._id}/)", "", path)
 
     def set_defaults(self):
-        self.root.set_defaults()
+        self.root.set_defaults(self._template)
+
+    def copy_nodes(self, source: "Composition"):
+        """Copies the nodes of source under the root. Values are shared,
+        since they are replaced and never modified in place."""
+        self._root._copy_children(source.root)
 
     #      for path in self.get_required_leaves():
     #          try:
@@ -227,6 +315,8 @@ class Composition:
 
 @dataclass
 class CompositionNode(_Node, abc.ABC):
+    __slots__ = ()
+
     template: "TemplateNode"
     value: Optional[Dict] = None
     null_flavour: Optional[NullFlavour] = None
@@ -258,9 +348,65 @@ class CompositionNode(_Node, abc.ABC):
     #      ...
 
     @abc.abstractmethod
-    def set_defaults(self):
+    def _create_child(self, template: "TemplateNode") -> "CompositionNode":
+        """Appends a new child (a new occurrence, for multiple cardinality ones)."""
         ...
 
+    def set_defaults(self, template: Template):
+        """Creates the missing required branches of the descendants,
+        setting the leaves to their default values."""
+        stack = [
+            (child, f"{remove_cardinality(str(self))}/{child.template._id}")
+            for child in reversed(self.children)
+        ]
+        while stack:
+            node, path = stack.pop()
+            children = node.children
+            required_defaults = template.required_defaults(path)
+            if required_defaults:
+                present = set(child.template._id for child in children)
+                for child_id, leaves in required_defaults.items():
+                    if child_id not in present:
+                        node._create_branches(leaves)
+            for child in reversed(children):
+                stack.append((child, f"{path}/{child.template._id}"))
+
+    def _copy_children(self, source: "CompositionNode"):
+        stack = [(source, self)]
+        while stack:
+            source_node, node = stack.pop()
+            for source_child in source_node.children:
+                child = node._create_child(source_child.template)
+                child.value = source_child.value
+                child.null_flavour = source_child.null_flavour
+                stack.append((source_child, child))
+
+    def _create_branches(self, leaves: Sequence[DefaultLeaf]):
+        # leaves are in pre-order: nodes created for the previous branch are reused
+        # as long as the template nodes are the same
+        created: List[CompositionNode] = []
+        previous: Tuple[TemplateNode, ...] = ()
+        for branch, values in leaves:
+            common = 0
+            while (
+                common < min(len(branch), len(previous))
+                and branch[common] is previous[common]
+            ):
+                common += 1
+            del created[common:]
+            for template in branch[common:]:
+                parent = created[-1] if created else self
+                created.append(parent._create_child(template))
+            created[-1].value = dict(values)
+            previous = branch
+
+
+@dataclass
+class NodeNotFound(Exception):
+    msg: str
+    node: "_Node"
+    child: str
+
 
 class NotaLeaf(Exception):
     ...
@@ -274,13 +420,25 @@ class InvalidDefault(Exception):
     ...
 
 
+def default_values(inputs: Sequence[Dict[str, str]]) -> Dict[str, str]:
+    values = {}
+    for input_ in inputs:
+        if "defaultValue" in input_:
+            values[
+                f"{'|' + input_['suffix'] if 'suffix' in input_ else ''}"
+            ] = input_["defaultValue"]
+            if "terminology" in input_:
+                values["|terminology"] = input_["terminology"]
+    return values
+
+
 def flat(
     composition: Composition, ctx: Optional[Dict[str, Dict[str, str]]] = None
 ) -> Dict[str, str]:
     dct = {}
     value_dicts = {
-        str(leaf): leaf.value
-        for leaf in composition.root.leaves
+        path: leaf.value
+        for path, leaf in _iter_leaves(composition.root)
         if leaf.value is not None
     }
     value_dicts.update(ctx or {})
@@ -288,3 +446,109 @@ def flat(
         for suffix, value in suffixes.items():
             dct[_id + suffix] = value
     return dct
+
+
+def _iter_leaves(root: CompositionNode) -> Iterator[Tuple[str, CompositionNode]]:
+    """Yields the leaves in preorder with their paths, built top-down: a single
+    concatenation for each node, instead of walking the ancestors of each leaf."""
+    stack = [(root._id, root)]
+    while stack:
+        path, node = stack.pop()
+        children = node.children
+        if children:
+            stack.extend((f"{path}/{child._id}", child) for child in reversed(children))
+        else:
+            yield path, node
+
+
+def structured(
+    composition: Composition, ctx: Optional[Dict[str, Dict[str, str]]] = None
+) -> Dict:
+    """Returns the composition in the structured format (the nested json accepted by
+    EHRbase with format=STRUCTURED), walking the tree once instead of splitting the
+    flat paths: each node is an array of its occurrences, in order, and each leaf is
+    its value or, if it has suffixes, an object of them (|code, |terminology...).
+    Branches without values are omitted, as in flat."""
+    root = composition.root
+    dct: Dict = {root._id: _structured_node(root) or {}}
+    if ctx:
+        ctx_dct: Dict = {}
+        for _id, suffixes in ctx.items():
+            for suffix, value in suffixes.items():
+                # ctx paths are objects, like ctx/subject|name
+                _set_path(ctx_dct, (_id + suffix).split("/", 1)[1], value, False)
+        dct["ctx"] = _collapse(ctx_dct)
+    return dct
+
+
+def _structured_node(node: CompositionNode) -> Optional[Dict]:
+    dct: Dict[str, List] = {}
+    for child in node.children:
+        if child.children:
+            value = _structured_node(child)
+        elif child.value is not None:
+            value = _structured_leaf(child.value)
+        else:
+            value = None
+        if value is not None:
+            # multiple cardinality children (:N) are created in order
+            dct.setdefault(child.template._id, []).append(value)
+    return dct or None
+
+
+def _structured_leaf(value: Dict):
+    # keys(), since ValueDict and NullFlavour do not use the storage of dict
+    if value.keys() == {""}:
+        return value[""]
+    leaf: Dict = {}
+    nested = False
+    for suffix, suffix_value in value.items():
+        if suffix.startswith("/"):
+            _set_path(leaf, suffix, suffix_value)
+            nested = True
+        else:
+            leaf[suffix] = suffix_value
+    if nested or "" in leaf:
+        return _collapse(leaf)
+    return leaf
+
+
+def _set_path(dct: Dict, path: str, value, arrays: bool = True):
+    """Sets value at a flat path (relative to dct), like /_null_flavour|code.
+    Nodes are arrays if arrays is set or if they have a cardinality (:N)."""
+    path, sep, attribute = path.partition("|")
+    for segment in path.split("/"):
+        if not segment:
+            continue
+        _id, colon, occurrence = segment.partition(":")
+        if arrays or colon:
+            occurrences = dct.setdefault(_id, [])
+            index = int(occurrence) if colon else 0
+            while len(occurrences) <= index:
+                occurrences.append({})
+            dct = occurrences[index]
+        else:
+            dct = dct.setdefault(_id, {})
+    dct[f"|{attribute}" if sep else ""] = value
+
+
+def _collapse(dct: Dict):
+    """An object with only a value ("" suffix) becomes the value, otherwise the
+    value is its |value attribute. Empty values (e.g. the place holder of null
+    flavoured leaves) are kept, as in flat: only if both the value and |value are set,
+    one of them is dropped (the value, unless |value is empty)."""
+    if dct.keys() == {""}:
+        return dct[""]
+    value_key = "" if "" in dct and dct.get("|value", "") == "" else "|value"
+    collapsed = {}
+    for key, value in dct.items():
+        if key in ("", "|value"):
+            if key != value_key:
+                continue
+            key = "|value"
+        elif isinstance(value, list):
+            value = [_collapse(v) for v in value]
+        elif isinstance(value, dict):
+            value = _collapse(value)
+        collapsed[key] = value
+    return collapsed
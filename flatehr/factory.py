@@ -2,7 +2,7 @@ import abc
 from typing import Generic, List, TypeVar
 
 from flatehr.core import Composition, Template
-from flatehr.impl.anytree_core import CompositionFactory, TemplateFactory
+from flatehr.impl import anytree_core, compact_core
 
 T = TypeVar("T", Template, Composition)
 
@@ -41,5 +41,7 @@ class UnsupportedBackend(Exception):
 template_factory = MetaFactory()
 composition_factory = MetaFactory()
 
-template_factory.register("anytree", TemplateFactory)
-composition_factory.register("anytree", CompositionFactory)
+template_factory.register("anytree", anytree_core.TemplateFactory)
+composition_factory.register("anytree", anytree_core.CompositionFactory)
+template_factory.register("compact", compact_core.TemplateFactory)
+composition_factory.register("compact", compact_core.CompositionFactory)
@@ -1,28 +1,20 @@
-from itertools import repeat
+from collections import defaultdict
 import logging
 import os
 from dataclasses import dataclass
 from typing import Dict, List, Optional, Tuple, Union, cast
 
 import anytree
-from pipe import chain, filter, map
 
 from flatehr.core import Composition
 from flatehr.core import CompositionNode as BaseCompositionNode
-from flatehr.core import InvalidDefault, Template
+from flatehr.core import InvalidDefault, NodeNotFound, Template
 from flatehr.core import TemplateNode as BaseTemplateNode
 from flatehr.core import WebTemplate, remove_cardinality, to_string
 
 logger = logging.getLogger(__name__)
 
 
-@dataclass
-class NodeNotFound(Exception):
-    msg: str
-    node: "Node"
-    child: str
-
-
 class NodeAlreadyExists(Exception):
     ...
 
@@ -36,15 +28,36 @@ class Node(anytree.NodeMixin):
         self._walker = anytree.Walker()
 
     def get(self, path: str) -> "Node":
-
-        try:
-            return (
-                self._resolver.glob(self, path)
-                if "*" in path
-                else self._resolver.get(self, path)
-            )
-        except anytree.ChildResolverError as ex:
-            raise NodeNotFound(f"node: {self}, path {path}", ex.node, ex.child) from ex
+        if "*" in path or path.startswith(self.separator):
+            try:
+                return (
+                    self._resolver.glob(self, path)
+                    if "*" in path
+                    else self._resolver.get(self, path)
+                )
+            except anytree.ChildResolverError as ex:
+                raise NodeNotFound(
+                    f"node: {self}, path {path}", ex.node, ex.child
+                ) from ex
+
+        node = self
+        for part in path.split(self.separator):
+            if part == "..":
+                node = node.parent
+            elif part in ("", "."):
+                pass
+            else:
+                child = node._child(part)
+                if child is None:
+                    raise NodeNotFound(f"node: {self}, path {path}", node, part)
+                node = child
+        return node
+
+    def _child(self, _id: str) -> Optional["Node"]:
+        for child in self.children:
+            if child._id == _id:
+                return child
+        return None
 
     def __str__(self) -> str:
         return self.separator.join([cast(Node, n)._id for n in super().path])
@@ -91,6 +104,16 @@ class TemplateNode(Node, BaseTemplateNode):
     def get(self, path: str) -> BaseTemplateNode:
         return cast(TemplateNode, super().get(remove_cardinality(path)))
 
+    def _child(self, _id: str) -> Optional["TemplateNode"]:
+        # templates are not modified once built, children are indexed on first lookup
+        try:
+            children_by_id = self._children_by_id
+        except AttributeError:
+            children_by_id = self._children_by_id = {
+                child._id: child for child in self.children
+            }
+        return children_by_id.get(_id)
+
     @property
     def default(self) -> str:
         try:
@@ -118,94 +141,50 @@ class CompositionNode(Node, BaseCompositionNode):
         self, template: TemplateNode, parent: Optional["CompositionNode"] = None
     ):
         if parent and template.inf_cardinality:
-            cardinality = len(cast(list, parent.get(f"{template._id}:*")))
+            cardinality = parent._occurrences[template._id]
             _id = f"{template._id}:{cardinality}"
         else:
             _id = template._id
 
         Node.__init__(self, _id=_id)
         BaseCompositionNode.__init__(self, template)
+        # children by id and, for multiple cardinality children,
+        # number of occurrences by template id
+        self._children_by_id: Dict[str, CompositionNode] = {}
+        self._occurrences: Dict[str, int] = defaultdict(int)
         Node.parent.fset(self, parent)
         self._ctx: Dict[str, Dict[str, str]] = {}
 
+    def _post_attach(self, parent: "CompositionNode"):
+        parent._children_by_id[self._id] = self
+        if self.template.inf_cardinality:
+            parent._occurrences[self.template._id] += 1
+
+    def _pre_detach(self, parent: "CompositionNode"):
+        del parent._children_by_id[self._id]
+
     def get(self, path) -> "CompositionNode":
         return cast(CompositionNode, Node.get(self, path))
 
+    def _child(self, _id: str) -> Optional["CompositionNode"]:
+        return self._children_by_id.get(_id)
+
+    def last_occurrence(self, _id: str) -> Optional["CompositionNode"]:
+        """Returns the last occurrence of the multiple cardinality child
+        with the given template id, None if there is none."""
+        cardinality = self._occurrences[_id]
+        if not cardinality:
+            return None
+        return self._children_by_id[f"{_id}:{cardinality - 1}"]
+
     def __getitem__(self, path: str) -> Union[List[Dict], Dict]:
         nodes = self.get(path)
         return (
             [node.value for node in nodes] if isinstance(nodes, list) else nodes.value
         )
 
-    def set_defaults(self):
-        def _set_defaults(node, path, inputs):
-
-            values = {}
-            for input_ in inputs:
-                if "defaultValue" in input_:
-                    values[
-                        f"{'|' + input_['suffix'] if 'suffix' in input_ else ''}"
-                    ] = input_["defaultValue"]
-                    if "terminology" in input_:
-                        values["|terminology"] = input_["terminology"]
-
-            node[path] = values
-
-        list(
-            self.descendants
-            | map(
-                lambda n: (
-                    n,
-                    set(
-                        [
-                            child._id
-                            for child in n.template.children
-                            if child.required and not child.in_context
-                        ]
-                    )
-                    - set(
-                        [
-                            remove_cardinality(child._id)
-                            for child in n.children
-                            if child.template.required and not child.template.in_context
-                        ]
-                    ),
-                )
-            )
-            | filter(lambda n_set: len(n_set[1]))
-            | map(lambda n_set: list(zip(repeat(n_set[0], len(n_set[1])), n_set[1])))
-            | chain
-            | map(
-                lambda n_path: (
-                    n_path[0],
-                    list(
-                        anytree.iterators.preorderiter.PreOrderIter(
-                            n_path[0].template.get(str(n_path[1])),
-                            stop=lambda n: not n.required,
-                            filter_=lambda n: n.is_leaf
-                            and not n.in_context
-                            and n.required,
-                        )
-                    ),
-                ),
-            )
-            | map(
-                lambda n_path: list(zip(repeat(n_path[0], len(n_path[1])), n_path[1]))
-            )
-            | chain
-            | map(
-                lambda n_path: (
-                    _set_defaults(
-                        n_path[0],
-                        os.path.relpath(
-                            str(n_path[1]),
-                            remove_cardinality(str(n_path[0])),
-                        ),
-                        n_path[1].inputs,
-                    )
-                )
-            )
-        )
+    def _create_child(self, template: TemplateNode) -> "CompositionNode":
+        return CompositionNode(template, self)
 
     def __setitem__(self, path, value: Union[Dict, "CompositionNode"]):
 
@@ -248,20 +227,9 @@ class CompositionNode(Node, BaseCompositionNode):
 
             if append_to_last_occurence:
                 if missing_child_template.inf_cardinality:
-                    cardinality = (
-                        len(
-                            cast(list, last_node.get(f"{missing_child_template._id}:*"))
-                        )
-                        - 1
-                    )
-                    if cardinality < 0:
-                        missing_child = CompositionNode(
-                            missing_child_template, last_node
-                        )
-                    else:
-                        missing_child = last_node.get(
-                            f"{missing_child_template._id}:{cardinality}"
-                        )
+                    missing_child = last_node.last_occurrence(
+                        missing_child_template._id
+                    ) or CompositionNode(missing_child_template, last_node)
                 else:
                     missing_child = CompositionNode(missing_child_template, last_node)
 
@@ -0,0 +1,548 @@
+import logging
+import os
+from array import array
+from fnmatch import fnmatchcase
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union, cast
+
+from flatehr.core import Composition
+from flatehr.core import CompositionNode as BaseCompositionNode
+from flatehr.core import InvalidDefault, NodeNotFound, Template
+from flatehr.core import TemplateNode as BaseTemplateNode
+from flatehr.core import WebTemplate, remove_cardinality
+
+logger = logging.getLogger(__name__)
+
+SEPARATOR = "/"
+
+REQUIRED = 1
+INF_CARDINALITY = 2
+IN_CONTEXT = 4
+
+# below this number of children, composition nodes look up children by scanning
+INDEX_THRESHOLD = 8
+
+
+class TemplateStore:
+    """Template nodes stored in parallel arrays, indexed in pre-order,
+    so that the descendants of node i are the nodes in [i + 1, subtree_ends[i])."""
+
+    def __init__(self, web_template: WebTemplate):
+        self.parents = array("l")
+        self.subtree_ends = array("l")
+        self.flags = array("B")
+        self.ids: List[str] = []
+        self.rm_types: List[str] = []
+        self.aql_paths: List[Optional[str]] = []
+        self.annotations: List[Tuple[Dict[str, str], ...]] = []
+        self.inputs: List[Tuple[Dict[str, str], ...]] = []
+        self.child_by_id: Dict[Tuple[int, str], int] = {}
+
+        stack = [(web_template["tree"], -1)]
+        while stack:
+            web_template_el, parent = stack.pop()
+            if web_template_el is None:
+                self.subtree_ends[parent] = len(self.ids)
+                continue
+
+            index = len(self.ids)
+            self.parents.append(parent)
+            self.subtree_ends.append(index + 1)
+            self.flags.append(
+                (REQUIRED if web_template_el["min"] == 1 else 0)
+                | (INF_CARDINALITY if web_template_el["max"] == -1 else 0)
+                | (IN_CONTEXT if web_template_el.get("inContext", False) else 0)
+            )
+            self.ids.append(web_template_el["id"])
+            self.rm_types.append(web_template_el["rmType"])
+            self.aql_paths.append(web_template_el.get("aqlPath"))
+            self.annotations.append(web_template_el.get("annotations", ()))
+            self.inputs.append(web_template_el.get("inputs", ()))
+            if parent >= 0:
+                self.child_by_id[(parent, web_template_el["id"])] = index
+
+            # None marks the end of the subtree
+            stack.append((None, index))
+            for child in reversed(web_template_el.get("children", [])):
+                stack.append((child, index))
+
+        self._nodes: List[Optional[TemplateNode]] = [None] * len(self.ids)
+
+    @classmethod
+    def from_columns(
+        cls,
+        parents: Sequence[int],
+        subtree_ends: Sequence[int],
+        flags: Sequence[int],
+        ids: List[str],
+        rm_types: List[str],
+        aql_paths: List[Optional[str]],
+        annotations: Sequence[Tuple[Dict[str, str], ...]],
+        inputs: Sequence[Tuple[Dict[str, str], ...]],
+    ) -> "TemplateStore":
+        """Returns a store of already built columns (e.g. of a compiled template),
+        without walking a web template."""
+        store = cls.__new__(cls)
+        store.parents = parents
+        store.subtree_ends = subtree_ends
+        store.flags = flags
+        store.ids = ids
+        store.rm_types = rm_types
+        store.aql_paths = aql_paths
+        store.annotations = annotations
+        store.inputs = inputs
+        store.child_by_id = dict(
+            zip(zip(parents[1:], ids[1:]), range(1, len(ids)))
+        )
+        store._nodes = [None] * len(ids)
+        return store
+
+    def node(self, index: int) -> "TemplateNode":
+        node = self._nodes[index]
+        if node is None:
+            node = self._nodes[index] = TemplateNode(self, index)
+        return node
+
+    def child_indexes(self, index: int) -> Iterator[int]:
+        child = index + 1
+        while child < self.subtree_ends[index]:
+            yield child
+            child = self.subtree_ends[child]
+
+    def is_leaf(self, index: int) -> bool:
+        return self.subtree_ends[index] == index + 1
+
+    def ancestor_indexes(self, index: int) -> List[int]:
+        """Indexes from the root to index (included)."""
+        indexes = []
+        while index >= 0:
+            indexes.append(index)
+            index = self.parents[index]
+        indexes.reverse()
+        return indexes
+
+
+class TemplateFactory:
+    def __init__(self, web_template: WebTemplate):
+        self._web_template = web_template
+
+    def get(self) -> Template:
+        store = TemplateStore(self._web_template)
+        return Template(store.node(0), backend="compact")
+
+
+class TemplateNode(BaseTemplateNode):
+    """View on a node of a TemplateStore."""
+
+    def __init__(self, store: TemplateStore, index: int):
+        self._store = store
+        self._index = index
+
+    def __eq__(self, other) -> bool:
+        return (
+            isinstance(other, TemplateNode)
+            and self._store is other._store
+            and self._index == other._index
+        )
+
+    def __hash__(self) -> int:
+        return hash((id(self._store), self._index))
+
+    def __repr__(self) -> str:
+        return f"TemplateNode({str(self)!r})"
+
+    def __str__(self) -> str:
+        return SEPARATOR.join(
+            self._store.ids[i] for i in self._store.ancestor_indexes(self._index)
+        )
+
+    @property
+    def _id(self) -> str:
+        return self._store.ids[self._index]
+
+    @property
+    def rm_type(self) -> str:
+        return self._store.rm_types[self._index]
+
+    @property
+    def aql_path(self) -> str:
+        return cast(str, self._store.aql_paths[self._index])
+
+    @property
+    def required(self) -> bool:
+        return bool(self._store.flags[self._index] & REQUIRED)
+
+    @property
+    def inf_cardinality(self) -> bool:
+        return bool(self._store.flags[self._index] & INF_CARDINALITY)
+
+    @property
+    def in_context(self) -> bool:
+        return bool(self._store.flags[self._index] & IN_CONTEXT)
+
+    @property
+    def annotations(self) -> Tuple[Dict[str, str], ...]:
+        return self._store.annotations[self._index]
+
+    @property
+    def inputs(self) -> Tuple[Dict[str, str], ...]:
+        return self._store.inputs[self._index]
+
+    @property
+    def children(self) -> List["TemplateNode"]:
+        return [self._store.node(i) for i in self._store.child_indexes(self._index)]
+
+    @property
+    def parent(self) -> Optional["TemplateNode"]:
+        parent = self._store.parents[self._index]
+        return self._store.node(parent) if parent >= 0 else None
+
+    @property
+    def path(self) -> Tuple["TemplateNode", ...]:
+        return tuple(
+            self._store.node(i) for i in self._store.ancestor_indexes(self._index)
+        )
+
+    @property
+    def ancestors(self) -> Tuple["TemplateNode", ...]:
+        return self.path[:-1]
+
+    @property
+    def is_leaf(self) -> bool:
+        return self._store.is_leaf(self._index)
+
+    @property
+    def leaves(self) -> List["TemplateNode"]:
+        return [
+            self._store.node(i)
+            for i in range(self._index, self._store.subtree_ends[self._index])
+            if self._store.is_leaf(i)
+        ]
+
+    def walk_to(self, dest: "TemplateNode") -> Tuple["TemplateNode", ...]:
+        return _walk(self, dest)
+
+    def get(
+        self, path: str
+    ) -> Union["TemplateNode", List["TemplateNode"]]:
+        return _resolve(self, remove_cardinality(path))
+
+    def _child(self, _id: str) -> Optional["TemplateNode"]:
+        index = self._store.child_by_id.get((self._index, _id))
+        return self._store.node(index) if index is not None else None
+
+    def find(self, _id: str) -> List["TemplateNode"]:
+        return [
+            self._store.node(i)
+            for i in range(self._index, self._store.subtree_ends[self._index])
+            if self._store.ids[i] == _id
+        ]
+
+    @property
+    def default(self) -> str:
+        try:
+            return self.inputs[0]["defaultValue"]
+        except (IndexError, KeyError) as ex:
+            raise InvalidDefault(f"path {self} has no valid default") from ex
+
+    def json(self):
+        return {"inputs": self.inputs}
+
+
+class CompositionFactory:
+    def __init__(self, template: Template):
+        self._template = template
+
+    def get(self) -> Composition:
+        template_root = cast(TemplateNode, self._template.root)
+        composition_root = CompositionNode(template_root._store, template_root._index)
+        return Composition(self._template, composition_root)
+
+
+class CompositionNode(BaseCompositionNode):
+    __slots__ = (
+        "_store",
+        "_tindex",
+        "_occurrence",
+        "_parent",
+        "_children",
+        "_by_template",
+        "value",
+        "null_flavour",
+    )
+
+    def __init__(
+        self,
+        store: TemplateStore,
+        tindex: int,
+        parent: Optional["CompositionNode"] = None,
+        occurrence: int = -1,
+    ):
+        self._store = store
+        self._tindex = tindex
+        self._occurrence = occurrence
+        self._parent = parent
+        # children in insertion order and, only for nodes with more than
+        # INDEX_THRESHOLD children, children by template index
+        # (a list for multiple cardinality ones)
+        self._children: Optional[List[CompositionNode]] = None
+        self._by_template: Optional[
+            Dict[int, Union[CompositionNode, List[CompositionNode]]]
+        ] = None
+        self.value: Optional[Dict] = None
+        self.null_flavour = None
+
+    __eq__ = object.__eq__
+    __hash__ = object.__hash__
+
+    def __repr__(self) -> str:
+        return f"CompositionNode({str(self)!r})"
+
+    def __str__(self) -> str:
+        return SEPARATOR.join(node._id for node in self.path)
+
+    @property
+    def _id(self) -> str:
+        _id = self._store.ids[self._tindex]
+        return _id if self._occurrence < 0 else f"{_id}:{self._occurrence}"
+
+    @property
+    def template(self) -> TemplateNode:
+        return self._store.node(self._tindex)
+
+    @property
+    def children(self) -> List["CompositionNode"]:
+        return list(self._children or ())
+
+    @property
+    def parent(self) -> Optional["CompositionNode"]:
+        return self._parent
+
+    @property
+    def path(self) -> Tuple["CompositionNode", ...]:
+        return self.ancestors + (self,)
+
+    @property
+    def ancestors(self) -> Tuple["CompositionNode", ...]:
+        ancestors = []
+        node = self._parent
+        while node is not None:
+            ancestors.append(node)
+            node = node._parent
+        return tuple(reversed(ancestors))
+
+    @property
+    def is_leaf(self) -> bool:
+        return not self._children
+
+    @property
+    def descendants(self) -> Tuple["CompositionNode", ...]:
+        return tuple(self._iter())[1:]
+
+    @property
+    def leaves(self) -> List["CompositionNode"]:
+        return [node for node in self._iter() if not node._children]
+
+    def _iter(self) -> Iterator["CompositionNode"]:
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            if node._children:
+                stack.extend(reversed(node._children))
+
+    def walk_to(self, dest: "CompositionNode") -> Tuple["CompositionNode", ...]:
+        return _walk(self, dest)
+
+    def find(self, _id: str) -> List["CompositionNode"]:
+        return [node for node in self._iter() if node._id == _id]
+
+    def get(self, path: str) -> "CompositionNode":
+        return cast(CompositionNode, _resolve(self, path))
+
+    def _child(self, _id: str) -> Optional["CompositionNode"]:
+        if not self._children:
+            return None
+        template_id, sep, occurrence = _id.rpartition(":")
+        if sep and occurrence.isdigit():
+            tchild = self._store.child_by_id.get((self._tindex, template_id))
+            if tchild is None or not self._store.flags[tchild] & INF_CARDINALITY:
+                return None
+            occurrences = self._occurrences(tchild)
+            return (
+                occurrences[int(occurrence)]
+                if int(occurrence) < len(occurrences)
+                else None
+            )
+
+        tchild = self._store.child_by_id.get((self._tindex, _id))
+        if tchild is None or self._store.flags[tchild] & INF_CARDINALITY:
+            return None
+        if self._by_template is not None:
+            return cast(Optional[CompositionNode], self._by_template.get(tchild))
+        for child in self._children:
+            if child._tindex == tchild:
+                return child
+        return None
+
+    def _occurrences(self, tindex: int) -> List["CompositionNode"]:
+        if self._by_template is not None:
+            return cast(List[CompositionNode], self._by_template.get(tindex, []))
+        return [child for child in self._children or () if child._tindex == tindex]
+
+    def _new_child(self, tindex: int) -> "CompositionNode":
+        if self._children is None:
+            self._children = []
+        if self._store.flags[tindex] & INF_CARDINALITY:
+            child = CompositionNode(
+                self._store, tindex, self, len(self._occurrences(tindex))
+            )
+        else:
+            child = CompositionNode(self._store, tindex, self)
+        self._children.append(child)
+
+        if self._by_template is not None:
+            self._index_child(child)
+        elif len(self._children) > INDEX_THRESHOLD:
+            self._by_template = {}
+            for indexed_child in self._children:
+                self._index_child(indexed_child)
+        return child
+
+    def _index_child(self, child: "CompositionNode"):
+        by_template = cast(Dict, self._by_template)
+        if child._occurrence < 0:
+            by_template[child._tindex] = child
+        else:
+            by_template.setdefault(child._tindex, []).append(child)
+
+    def _get_or_create_child(self, tindex: int) -> "CompositionNode":
+        if self._by_template is not None:
+            existing = self._by_template.get(tindex)
+            if isinstance(existing, list):
+                return existing[-1]
+            if existing is not None:
+                return existing
+        else:
+            # the last occurrence, for multiple cardinality children
+            for child in reversed(self._children or ()):
+                if child._tindex == tindex:
+                    return child
+        return self._new_child(tindex)
+
+    def __getitem__(self, path: str) -> Union[List[Dict], Dict]:
+        nodes = self.get(path)
+        return (
+            [node.value for node in nodes] if isinstance(nodes, list) else nodes.value
+        )
+
+    def __setitem__(self, path, value: Union[Dict, "CompositionNode"]):
+        nodes = self._get_or_create_node(path, "*" not in path)
+        if not isinstance(nodes, list):
+            nodes = [nodes]
+        for node in nodes:
+            if self._store.is_leaf(node._tindex):
+                node.value = value
+
+    def _get_or_create_node(
+        self, path: str, append_to_last_occurence: bool = True
+    ) -> Union["CompositionNode", List["CompositionNode"]]:
+        parts = path.split(SEPARATOR)
+        if append_to_last_occurence:
+            node = self
+            for part in parts:
+                if part == "..":
+                    node = cast(CompositionNode, node._parent)
+                elif part in ("", "."):
+                    pass
+                else:
+                    child = node._child(part)
+                    if child is None:
+                        tchild = node._store.child_by_id.get(
+                            (node._tindex, remove_cardinality(part))
+                        )
+                        if tchild is None:
+                            raise NodeNotFound(f"node: {node}, path {path}", node, part)
+                        child = node._get_or_create_child(tchild)
+                    node = child
+            return node
+
+        last_wildcard_idx = max(i for i, part in enumerate(parts) if "*" in part)
+        try:
+            wildcard_nodes = _resolve(
+                self, SEPARATOR.join(parts[: last_wildcard_idx + 1])
+            )
+        except NodeNotFound:
+            wildcard_nodes = []
+        remaining_path = SEPARATOR.join(parts[last_wildcard_idx + 1 :])
+        return [
+            cast(CompositionNode, node._get_or_create_node(remaining_path))
+            for node in cast(list, wildcard_nodes)
+        ]
+
+    def add(self, path: str) -> str:
+        parent = cast(
+            CompositionNode,
+            self._get_or_create_node(os.path.dirname(path.rstrip(SEPARATOR))),
+        )
+        tnode = cast(TemplateNode, self.template.get(path))
+        return str(parent._new_child(tnode._index))
+
+    def _create_child(self, template: BaseTemplateNode) -> "CompositionNode":
+        return self._new_child(cast(TemplateNode, template)._index)
+
+
+def _resolve(node, path: str):
+    """Resolves path from node, like anytree.Resolver get (or glob if path
+    contains a wildcard)."""
+    parts = path.split(SEPARATOR)
+    if "*" in path:
+        return _glob(node, parts)
+
+    for part in parts:
+        if part == "..":
+            node = node.parent
+        elif part in ("", "."):
+            pass
+        else:
+            child = node._child(part)
+            if child is None:
+                raise NodeNotFound(f"node: {node}, path {path}", node, part)
+            node = child
+    return node
+
+
+def _glob(node, parts: Sequence[str]) -> list:
+    if not parts:
+        return [node]
+    part, remainder = parts[0], parts[1:]
+    if part == "..":
+        return _glob(node.parent, remainder)
+    if part in ("", "."):
+        return _glob(node, remainder)
+    if "*" not in part:
+        child = node._child(part)
+        if child is None:
+            raise NodeNotFound(f"node: {node}, path {part}", node, part)
+        return _glob(child, remainder)
+
+    matches = []
+    for child in node.children:
+        if fnmatchcase(child._id, part):
+            try:
+                matches += _glob(child, remainder)
+            except NodeNotFound:
+                pass
+    return matches
+
+
+def _walk(start, dest) -> tuple:
+    start_path = start.path
+    dest_path = dest.path
+    common = 0
+    while (
+        common < min(len(start_path), len(dest_path))
+        and start_path[common] is dest_path[common]
+    ):
+        common += 1
+    upwards = tuple(reversed(start_path[common:]))
+    return (upwards + dest_path[common - 1 :])[1:]
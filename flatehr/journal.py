@@ -0,0 +1,157 @@
+"""Journal of ingested sources, for resuming interrupted runs.
+Each input file is recorded with the hashes of its content, configuration and
+template, and each of its compositions (unit) by relative root index, with the
+hash of the flat composition, together with the offsets of the output files."""
+
+import hashlib
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Tuple
+
+CHUNK_SIZE = 1 << 20
+
+STARTED = "started"
+DONE = "done"
+FAILED = "failed"
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f_obj:
+        for chunk in iter(lambda: f_obj.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def composition_hash(flat_composition: str) -> str:
+    return hashlib.sha256(flat_composition.encode()).hexdigest()
+
+
+class Journal:
+    """sqlite journal, safe to use from many threads.
+    A file is done when all its units have been processed without failures; done files
+    are skipped, unless only_changed is set and their content, configuration or template
+    hash has changed. A unit is done when it has been written or submitted with the
+    same composition hash, so that unchanged compositions are never emitted twice:
+    units are committed as soon as they are submitted, or written together with the
+    output offsets after them, so that output written by an interrupted run after
+    the last commit can be dropped (see get_sink)."""
+
+    def __init__(
+        self,
+        journal_file: str,
+        conf_hash: str,
+        template_hash: str,
+        only_changed: bool = False,
+    ):
+        self._conf_hash = conf_hash
+        self._template_hash = template_hash
+        self._only_changed = only_changed
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(journal_file, check_same_thread=False)
+        with self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY,"
+                " content_hash TEXT, conf_hash TEXT, template_hash TEXT, status TEXT)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS units (path TEXT, idx INTEGER,"
+                " composition_hash TEXT, status TEXT, PRIMARY KEY (path, idx))"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS outputs (path TEXT PRIMARY KEY,"
+                " offset INTEGER)"
+            )
+
+    def start_file(self, path: str, content_hash: str) -> bool:
+        """Returns False if the file is completed and can be skipped,
+        otherwise records it as started."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT content_hash, conf_hash, template_hash, status"
+                " FROM files WHERE path = ?",
+                (path,),
+            ).fetchone()
+            if row is not None and row[3] == DONE:
+                if not self._only_changed or row[:3] == (
+                    content_hash,
+                    self._conf_hash,
+                    self._template_hash,
+                ):
+                    return False
+            with self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                    (
+                        path,
+                        content_hash,
+                        self._conf_hash,
+                        self._template_hash,
+                        STARTED,
+                    ),
+                )
+            return True
+
+    def is_done(self, path: str, index: int, composition_hash: str) -> bool:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT composition_hash, status FROM units WHERE path = ? AND idx = ?",
+                (path, index),
+            ).fetchone()
+        return row == (composition_hash, DONE)
+
+    def record(
+        self, path: str, index: int, composition_hash: str, status: str = DONE
+    ):
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO units VALUES (?, ?, ?, ?)",
+                    (path, index, composition_hash, status),
+                )
+
+    def record_written(
+        self, units: List[Tuple[str, int, str]], offsets: Dict[str, int]
+    ):
+        """Records as done the units (path, index, composition hash) written to
+        the output files, which have been flushed up to offsets."""
+        with self._lock:
+            with self._db:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO units VALUES (?, ?, ?, ?)",
+                    [unit + (DONE,) for unit in units],
+                )
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO outputs VALUES (?, ?)", offsets.items()
+                )
+
+    def offsets(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._db.execute("SELECT path, offset FROM outputs"))
+
+    def complete_file(self, path: str):
+        """Records the file as done or, if some unit failed, as failed,
+        so that it is processed again (skipping its done units)."""
+        with self._lock:
+            with self._db:
+                failed = self._db.execute(
+                    "SELECT COUNT(*) FROM units WHERE path = ? AND status = ?",
+                    (path, FAILED),
+                ).fetchone()[0]
+                self._db.execute(
+                    "UPDATE files SET status = ? WHERE path = ?",
+                    (FAILED if failed else DONE, path),
+                )
+
+    def status(self, path: str) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT status FROM files WHERE path = ?", (path,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
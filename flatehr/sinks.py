@@ -0,0 +1,442 @@
+"""Sinks where generated compositions are written.
+A sink receives records (ehr id, flat composition serialized as json) and writes
+them in batches from a background thread, so that building compositions does not
+wait for output I/O."""
+
+import abc
+import functools
+import gzip
+import os
+import queue
+import sys
+import threading
+import zlib
+from typing import IO, Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+from urllib.parse import quote
+
+from flatehr.journal import composition_hash
+
+# ehr id (None if not written) and flat composition
+Record = Tuple[Optional[str], str]
+# called by the writer after a batch has been written and flushed, with the units
+# of its records and the offsets of the output files (see Journal.record_written)
+OnWritten = Callable[[List[Any], Dict[str, int]], None]
+
+BUFFER_SIZE = 1 << 20
+BATCH_SIZE = 1000
+QUEUE_SIZE = 8
+PARTITIONS = 16
+GZIP_LEVEL = 6
+
+COMPRESSIONS = {"gzip": ".gz", "zstd": ".zst"}
+
+_FLUSH = object()
+_CLOSE = object()
+
+
+class Sink(abc.ABC):
+    """Collects records in batches of batch_size, written by a background thread.
+    At most queue_size batches wait to be written, so that a slow output slows
+    down the producer instead of filling the memory.
+    If on_written is set, each batch is flushed once written and on_written is
+    called with the units given to write.
+    Errors of the writer are raised by the following write, flush or close."""
+
+    def __init__(
+        self,
+        batch_size: int = BATCH_SIZE,
+        queue_size: int = QUEUE_SIZE,
+        on_written: Optional[OnWritten] = None,
+    ):
+        self._batch_size = batch_size
+        self._on_written = on_written
+        self._batch: List[Record] = []
+        self._units: List[Any] = []
+        self._queue: queue.Queue = queue.Queue(queue_size)
+        self._error: Optional[BaseException] = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, ehr_id: Optional[str], composition: str, unit: Any = None):
+        self._batch.append((ehr_id, composition))
+        if unit is not None:
+            self._units.append(unit)
+        if len(self._batch) >= self._batch_size:
+            self._put_batch()
+
+    def writelines(self, records: Iterable[Record]):
+        for ehr_id, composition in records:
+            self.write(ehr_id, composition)
+
+    def flush(self):
+        """Blocks until all the records written so far are flushed to the output."""
+        self._put_batch()
+        self._queue.put(_FLUSH)
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        # the output is closed even after an error of the writer
+        if self._batch:
+            self._queue.put((self._batch, self._units))
+            self._batch, self._units = [], []
+        self._queue.put(_CLOSE)
+        self._thread.join()
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _put_batch(self):
+        self._raise_error()
+        if self._batch:
+            self._queue.put((self._batch, self._units))
+            self._batch, self._units = [], []
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                # after an error, batches are discarded, so that the producer
+                # is not blocked on a full queue before seeing it
+                if item is _CLOSE:
+                    self._close()
+                elif item is _FLUSH:
+                    if self._error is None:
+                        self._flush()
+                elif self._error is None:
+                    records, units = item
+                    self._write_batch(records)
+                    if self._on_written is not None:
+                        self._flush()
+                        self._on_written(units, self._offsets())
+            except BaseException as ex:
+                self._error = self._error or ex
+            finally:
+                self._queue.task_done()
+            if item is _CLOSE:
+                return
+
+    @abc.abstractmethod
+    def _write_batch(self, records: List[Record]):
+        ...
+
+    def _flush(self):
+        ...
+
+    def _close(self):
+        ...
+
+    def _offsets(self) -> Dict[str, int]:
+        return {}
+
+
+class NdjsonSink(Sink):
+    """A line for each composition: the ehr id (if not None), the separator and the
+    flat composition. Written to stdout if path is None."""
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        compression: Optional[str] = None,
+        append: bool = False,
+        separator: str = "\t",
+        offsets: Optional[Dict[str, int]] = None,
+        **kwargs,
+    ):
+        self._separator = separator
+        self._path = os.path.abspath(path) if path else None
+        if path:
+            self._out = _open_file(
+                path, compression, append, offsets or {}, kwargs.get("on_written")
+            )
+        elif compression:
+            self._out = _Output(sys.stdout.buffer, compression, close_raw=False)
+        else:
+            self._out = sys.stdout
+        super().__init__(**kwargs)
+
+    def _write_batch(self, records: List[Record]):
+        self._out.write("".join(_format_lines(records, self._separator)))
+
+    def _flush(self):
+        self._out.flush()
+
+    def _close(self):
+        if self._out is sys.stdout:
+            self._out.flush()
+        else:
+            self._out.close()
+
+    def _offsets(self) -> Dict[str, int]:
+        return {self._path: self._out.tell()} if self._path else {}
+
+
+class FilesSink(Sink):
+    """A json file for each composition, named after its hash (so that writing
+    again the same composition is idempotent), in a directory for each ehr id."""
+
+    def __init__(self, path: str, compression: Optional[str] = None, **kwargs):
+        self._path = path
+        self._compression = compression
+        self._dirs: Set[str] = set()
+        os.makedirs(path, exist_ok=True)
+        super().__init__(**kwargs)
+
+    def _write_batch(self, records: List[Record]):
+        ext = ".json" + COMPRESSIONS.get(self._compression or "", "")
+        for ehr_id, composition in records:
+            dir_path = (
+                os.path.join(self._path, quote(ehr_id, safe=""))
+                if ehr_id
+                else self._path
+            )
+            if dir_path not in self._dirs:
+                os.makedirs(dir_path, exist_ok=True)
+                self._dirs.add(dir_path)
+            with open_output(
+                os.path.join(dir_path, composition_hash(composition) + ext),
+                self._compression,
+            ) as f_obj:
+                f_obj.write(composition)
+
+
+class PartitionedSink(Sink):
+    """ndjson files part-00000.ndjson, part-00001.ndjson... (as many as partitions),
+    with the compositions of an ehr id always in the same file, so that files can be
+    processed (e.g. submitted) in parallel."""
+
+    def __init__(
+        self,
+        path: str,
+        compression: Optional[str] = None,
+        append: bool = False,
+        partitions: int = PARTITIONS,
+        separator: str = "\t",
+        offsets: Optional[Dict[str, int]] = None,
+        **kwargs,
+    ):
+        if partitions < 1:
+            raise ValueError(f"invalid number of partitions {partitions}")
+        self._path = path
+        self._compression = compression
+        self._append = append
+        self._partitions = partitions
+        self._separator = separator
+        self._initial_offsets = offsets or {}
+        self._files: Dict[int, "_Output"] = {}
+        os.makedirs(path, exist_ok=True)
+        super().__init__(**kwargs)
+
+    def _write_batch(self, records: List[Record]):
+        partitions: Dict[int, List[Record]] = {}
+        for record in records:
+            # without ehr id, compositions are spread by their content
+            key = (record[0] or record[1]).encode()
+            partitions.setdefault(zlib.crc32(key) % self._partitions, []).append(
+                record
+            )
+        for partition, partition_records in partitions.items():
+            self._get_file(partition).write(
+                "".join(_format_lines(partition_records, self._separator))
+            )
+
+    def _get_file(self, partition: int) -> "_Output":
+        try:
+            return self._files[partition]
+        except KeyError:
+            f_obj = self._files[partition] = _open_file(
+                os.path.join(
+                    self._path,
+                    f"part-{partition:05d}.ndjson"
+                    + COMPRESSIONS.get(self._compression or "", ""),
+                ),
+                self._compression,
+                self._append,
+                self._initial_offsets,
+                self._on_written,
+            )
+            return f_obj
+
+    def _flush(self):
+        for f_obj in self._files.values():
+            f_obj.flush()
+
+    def _close(self):
+        for f_obj in self._files.values():
+            f_obj.close()
+
+    def _offsets(self) -> Dict[str, int]:
+        return {f_obj.name: f_obj.tell() for f_obj in self._files.values()}
+
+
+SINKS = {
+    "ndjson": NdjsonSink,
+    "files": FilesSink,
+    "partitioned": PartitionedSink,
+}
+
+
+def get_sink(
+    output: Optional[str] = None,
+    format: str = "ndjson",
+    compression: Optional[str] = None,
+    append: bool = False,
+    partitions: int = PARTITIONS,
+    separator: str = "\t",
+    offsets: Optional[Dict[str, int]] = None,
+    **kwargs,
+) -> Sink:
+    """Returns the sink for the given format. output is a file (stdout if None)
+    for ndjson, a directory otherwise. If not set, compression is inferred from
+    the output extension (.gz, .zst). separator is written between ehr id and
+    composition in ndjson lines. Appended files longer than their offsets (by
+    absolute path) are truncated first. kwargs are passed to Sink."""
+    if compression is None and output and format == "ndjson":
+        compression = next(
+            (name for name, ext in COMPRESSIONS.items() if output.endswith(ext)), None
+        )
+    if compression is not None and compression not in COMPRESSIONS:
+        raise RuntimeError(
+            f"compression {compression} not supported, "
+            f"Supported compressions: {list(COMPRESSIONS.keys())}"
+        )
+    try:
+        sink_class = SINKS[format]
+    except KeyError:
+        raise RuntimeError(
+            f"format {format} not supported, Supported formats: {list(SINKS.keys())}"
+        )
+    if sink_class is NdjsonSink:
+        return NdjsonSink(output, compression, append, separator, offsets, **kwargs)
+    if output is None:
+        raise RuntimeError(f"format {format} requires an output directory")
+    if sink_class is FilesSink:
+        return FilesSink(output, compression, **kwargs)
+    return PartitionedSink(
+        output, compression, append, partitions, separator, offsets, **kwargs
+    )
+
+
+def open_output(
+    path: str,
+    compression: Optional[str] = None,
+    append: bool = False,
+    truncate: Optional[int] = None,
+) -> "_Output":
+    """Opens a text file for writing, with a large buffer and optionally compressed.
+    If append and truncate are set, the file is first truncated to truncate bytes."""
+    raw = open(path, "ab" if append else "wb")
+    if append and truncate is not None and raw.tell() > truncate:
+        raw.truncate(truncate)
+        raw.seek(0, os.SEEK_END)
+    return _Output(raw, compression)
+
+
+def _open_file(
+    path: str,
+    compression: Optional[str],
+    append: bool,
+    offsets: Dict[str, int],
+    on_written: Optional[OnWritten],
+) -> "_Output":
+    path = os.path.abspath(path)
+    f_obj = open_output(path, compression, append, offsets.get(path))
+    if on_written is not None:
+        # the initial offset, so that what an interrupted run writes after it
+        # is dropped when resuming
+        on_written([], {path: f_obj.tell()})
+    return f_obj
+
+
+class _Output:
+    """Text output with a large buffer, optionally compressed.
+    Each buffer is written as a whole gzip member (or zstd frame), so that a file
+    flushed and then truncated at its offset can be appended to and read back as
+    a single stream."""
+
+    def __init__(
+        self, raw: IO[bytes], compression: Optional[str] = None, close_raw: bool = True
+    ):
+        self._raw = raw
+        self._compress = _get_compressor(compression)
+        self._close_raw = close_raw
+        self._chunks: List[bytes] = []
+        self._size = 0
+
+    @property
+    def name(self) -> str:
+        return self._raw.name
+
+    def write(self, text: str) -> int:
+        data = text.encode()
+        self._chunks.append(data)
+        self._size += len(data)
+        if self._size >= BUFFER_SIZE:
+            self._write_chunks()
+        return len(text)
+
+    def flush(self):
+        self._write_chunks()
+        self._raw.flush()
+
+    def tell(self) -> int:
+        """The offset of the data flushed so far."""
+        return self._raw.tell()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self._close_raw:
+                self._raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _write_chunks(self):
+        if self._chunks:
+            data = b"".join(self._chunks)
+            self._chunks, self._size = [], 0
+            self._raw.write(self._compress(data) if self._compress else data)
+
+
+def _get_compressor(compression: Optional[str]) -> Optional[Callable[[bytes], bytes]]:
+    if compression is None:
+        return None
+    if compression == "gzip":
+        return functools.partial(gzip.compress, compresslevel=GZIP_LEVEL)
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError(
+                "zstd compression requires the zstandard package "
+                "(pip install flatehr[zstd])"
+            )
+        return zstandard.ZstdCompressor().compress
+    raise RuntimeError(f"compression {compression} not supported")
+
+
+def _format_lines(records: List[Record], separator: str) -> Iterable[str]:
+    return (
+        f"{ehr_id}{separator}{composition}\n"
+        if ehr_id is not None
+        else f"{composition}\n"
+        for ehr_id, composition in records
+    )
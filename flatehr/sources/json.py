@@ -1,14 +1,17 @@
 import json
-from itertools import repeat
-from typing import IO, Iterator, Sequence, Tuple
+from functools import lru_cache
+from typing import IO, Any, Dict, Iterator, List, Sequence, Tuple
 
+from jsonpath_ng import JSONPath
 from jsonpath_ng.ext import parse
-from pipe import chain, map, sort
+from jsonpath_ng.jsonpath import DatumInContext, Fields, Index
 
 from flatehr.sources.base import Key, Source, Value
 
 JsonPath = str
 
+CHUNK_SIZE = 1 << 16
+
 
 class JsonPathSource(Source):
     def __init__(self, input_file: IO, paths: Sequence[JsonPath]):
@@ -16,19 +19,178 @@ class JsonPathSource(Source):
         self._paths = paths
 
     def iter(self) -> Iterator[Tuple[Key, Value]]:
+        return _iter(self._json, self._paths)
 
-        mappings = (
-            self._paths
-            | map(lambda path: list(zip(repeat(path), parse(path).find(self._json))))
-            | chain
-            | sort(lambda el: str(el[1].full_path))
-            | map(
-                lambda el: (
-                    el[0],
-                    None if isinstance(el[1].value, dict) else el[1].value,
-                )
-            )
+
+class StreamingJsonPathSource:
+    """Yields a source for each record of the input: each line for NDJSON,
+    each element of the top level array otherwise (or the whole document,
+    if it is not an array). Records are read one at a time, so memory is
+    bounded by the size of the largest one."""
+
+    def __init__(self, input_file: IO, paths: Sequence[JsonPath], ndjson: bool = False):
+        self._input_file = input_file
+        self._paths = paths
+        self._ndjson = ndjson
+
+    def iter_sources(self) -> Iterator["DocumentSource"]:
+        records = (
+            iter_ndjson(self._input_file)
+            if self._ndjson
+            else iter_array(self._input_file)
         )
+        for record in records:
+            yield DocumentSource(record, self._paths)
+
+
+class DocumentSource(Source):
+    def __init__(self, document: Any, paths: Sequence[JsonPath]):
+        self._json = document
+        self._paths = paths
+
+    def iter(self) -> Iterator[Tuple[Key, Value]]:
+        return _iter(self._json, self._paths)
+
+
+@lru_cache(maxsize=None)
+def compile_path(path: JsonPath) -> JSONPath:
+    """Returns the parsed JSONPath expression, cached for the whole process
+    (parsing is often slower than the evaluation itself)."""
+    return parse(path)
+
+
+# children by position within the container, matches (path and value)
+_TrieNode = Tuple[Dict[int, Any], List[Tuple[Key, Value]]]
+
+
+def _iter(document: Any, paths: Sequence[JsonPath]) -> Iterator[Tuple[Key, Value]]:
+    """Yields the matches of all the paths in document order: the positions of the
+    matches are collected in a trie, walked along the containers of the document
+    (matches at the same position in the order of paths)."""
+    positions: Dict[int, Dict[str, int]] = {}
+    trie: _TrieNode = ({}, [])
+    for path in paths:
+        for datum in compile_path(path).find(document):
+            node = trie
+            for index in _document_position(datum, positions):
+                try:
+                    node = node[0][index]
+                except KeyError:
+                    child: _TrieNode = ({}, [])
+                    node[0][index] = child
+                    node = child
+            node[1].append(
+                (path, None if isinstance(datum.value, dict) else datum.value)
+            )
+    return _walk(document, trie)
+
+
+def _walk(value: Any, node: _TrieNode) -> Iterator[Tuple[Key, Value]]:
+    children, matches = node
+    yield from matches
+    if not children:
+        return
+    walked = 0
+    if isinstance(value, (dict, list)):
+        for index, child in enumerate(
+            value.values() if isinstance(value, dict) else value
+        ):
+            child_node = children.get(index)
+            if child_node is not None:
+                yield from _walk(child, child_node)
+                walked += 1
+                if walked == len(children):
+                    return
+    # positions that are not in the document (e.g. of len), after the walked ones
+    for index, child_node in children.items():
+        if not isinstance(value, (dict, list)) or index >= len(value):
+            yield from _walk(None, child_node)
+
+
+def _document_position(
+    datum: DatumInContext, positions: Dict[int, Dict[str, int]]
+) -> Tuple[int, ...]:
+    """Returns the position of each ancestor (and of the datum) within its parent,
+    so that tuples compare in document order."""
+    position = []
+    while datum.context is not None:
+        container = datum.context.value
+        if isinstance(datum.path, Fields) and isinstance(container, dict):
+            try:
+                keys = positions[id(container)]
+            except KeyError:
+                keys = positions[id(container)] = {
+                    key: i for i, key in enumerate(container)
+                }
+            position.append(keys.get(datum.path.fields[0], 0))
+        elif isinstance(datum.path, Index) and isinstance(container, list):
+            index = datum.path.indices[0]
+            position.append(index if index >= 0 else index + len(container))
+        else:
+            position.append(0)
+        datum = datum.context
+    position.reverse()
+    return tuple(position)
+
+
+def iter_ndjson(input_file: IO) -> Iterator[Any]:
+    for line in input_file:
+        if line.strip():
+            yield json.loads(line)
+
+
+def iter_array(input_file: IO, chunk_size: int = CHUNK_SIZE) -> Iterator[Any]:
+    """Yields the elements of a top level json array, decoding them one at a time
+    (or the whole document, if it is not an array)."""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+
+    def _skip(chars: str):
+        nonlocal buffer, pos, eof
+        while True:
+            while pos < len(buffer) and buffer[pos] in chars:
+                pos += 1
+            if pos < len(buffer) or eof:
+                return
+            buffer, pos = input_file.read(chunk_size), 0
+            eof = not buffer
+
+    def _decode() -> Any:
+        nonlocal buffer, pos, eof
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+                # a number could continue in the next chunk
+                if end < len(buffer) or eof:
+                    pos = end
+                    return value
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            # the chunk read grows with the buffer, so that decoding a big record
+            # takes linear time
+            chunk = input_file.read(max(chunk_size, len(buffer) - pos))
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+    _skip(" \t\r\n")
+    if pos < len(buffer) and buffer[pos] != "[":
+        yield _decode()
+        return
+    pos += 1
 
-        for mapping in mappings:
-            yield mapping
+    _skip(" \t\r\n")
+    if pos < len(buffer) and buffer[pos] == "]":
+        return
+    while True:
+        _skip(" \t\r\n")
+        yield _decode()
+        _skip(" \t\r\n")
+        if pos < len(buffer) and buffer[pos] == "]":
+            return
+        if pos >= len(buffer) or buffer[pos] != ",":
+            raise json.JSONDecodeError("expecting ',' delimiter", buffer, pos)
+        pos += 1
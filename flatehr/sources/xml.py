@@ -1,15 +1,28 @@
-from itertools import repeat
-from typing import IO, Iterator, Optional, Sequence, Tuple
+import heapq
+from functools import lru_cache
+from operator import itemgetter
+from typing import (
+    IO,
+    Any,
+    Dict,
+    FrozenSet,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
 
 from lxml import etree
 from lxml.etree import _Element
-from pipe import chain, map, sort
 
 from flatehr.sources.base import Source, Key, Value
 
 
 XPath = str
 
+XPATH_CACHE_SIZE = 256
+
 
 class Element:
     def __init__(self, base_element: _Element):
@@ -27,21 +40,18 @@ class XPathSource(Source):
         self._paths = paths
         self._relative_root = relative_root
         self._tree = etree.parse(self._input_file)
-        self._ns_func = etree.FunctionNamespace(None)
-        self._ns = self.root._element.nsmap
-        self._ns["ns"] = self._ns.pop(None)
-
-        def first(context):
-            return context.context_node[0]
-
-        self._ns_func["first"] = first
+        self._ns = _get_namespaces(self.root._element)
+        self._xpaths = compile_paths(tuple(paths), frozenset(self._ns.items()))
 
     @property
     def root(self):
         return Element(self._tree.getroot())
 
     def get_elements(self, path: XPath) -> Sequence[Element]:
-        return [Element(_) for _ in self._tree.xpath(path, namespaces=self._ns)]
+        # evaluated once per source, and possibly built from a request
+        # (see serve): not cached
+        xpath = etree.XPath(path, namespaces=self._ns, extensions=_EXTENSIONS)
+        return [Element(_) for _ in xpath(self._tree)]
 
     @property
     def relative_root(self) -> Optional[Element]:
@@ -52,33 +62,182 @@ class XPathSource(Source):
         self._relative_root = element
 
     def iter(self) -> Iterator[Tuple[Key, Value]]:
-        def get_xml_element(xpath_result):
-            return (
-                xpath_result
-                if isinstance(xpath_result, _Element)
-                else xpath_result.getparent()
-            )
-
         root = self._tree.getroot()
 
         relative_root = (
             self.relative_root._element if self.relative_root is not None else root
         )
-
-        mappings = (
-            self._paths
-            | map(
-                lambda path: list(
-                    zip(
-                        repeat(path),
-                        relative_root.xpath(path, namespaces=self._ns),
-                    )
-                )
+        return _iter(relative_root, self._paths, self._xpaths)
+
+
+class StreamingXPathSource:
+    """Parses the input incrementally, yielding a source for each element
+    with tag relative_root as soon as it has been parsed.
+    Once the next source is requested, the element and its preceding siblings are removed,
+    so memory does not grow with the input size. Since XPaths are evaluated on
+    a partially parsed document, they must be relative to the relative root:
+    absolute paths (like //ns:Event) raise a ValueError."""
+
+    def __init__(self, input_file: IO, paths: Sequence[XPath], relative_root: str):
+        absolute_paths = [path for path in paths if _is_absolute(path)]
+        if absolute_paths:
+            raise ValueError(
+                "streamed xpaths must be relative to the relative root "
+                f"{relative_root}, got {', '.join(absolute_paths)}"
             )
-            | chain
-            | sort(lambda el: get_xml_element(el[1]).sourceline)
-            | map(lambda el: (el[0], None if isinstance(el[1], _Element) else el[1]))
+        self._input_file = input_file
+        self._paths = paths
+        self._relative_root = relative_root
+
+    def iter_sources(self) -> Iterator["ElementSource"]:
+        ns: Optional[Dict[str, str]] = None
+        tag = None
+        xpaths: Tuple[etree.XPath, ...] = ()
+        for event, el in etree.iterparse(
+            self._input_file, events=("start", "end"), huge_tree=True
+        ):
+            if ns is None:
+                ns = _get_namespaces(el)
+                tag = etree.QName(ns.get("ns"), self._relative_root).text
+                xpaths = compile_paths(tuple(self._paths), frozenset(ns.items()))
+            if event != "end" or el.tag != tag:
+                continue
+
+            yield ElementSource(Element(el), self._paths, ns, xpaths)
+
+            el.clear()
+            while el.getprevious() is not None:
+                del el.getparent()[0]
+
+
+def _is_absolute(path: XPath) -> bool:
+    return path.lstrip("( ").startswith("/")
+
+
+class ElementSource(Source):
+    def __init__(
+        self,
+        element: Element,
+        paths: Sequence[XPath],
+        namespaces: Dict[str, str],
+        xpaths: Optional[Sequence[etree.XPath]] = None,
+    ):
+        self._element = element
+        self._paths = paths
+        self._ns = namespaces
+        self._xpaths = (
+            compile_paths(tuple(paths), frozenset(namespaces.items()))
+            if xpaths is None
+            else xpaths
         )
 
-        for mapping in mappings:
-            yield mapping
+    def iter(self) -> Iterator[Tuple[Key, Value]]:
+        return _iter(self._element._element, self._paths, self._xpaths)
+
+
+def _iter(
+    relative_root: _Element,
+    paths: Sequence[XPath],
+    xpaths: Sequence[etree.XPath],
+) -> Iterator[Tuple[Key, Value]]:
+    """Yields the matches of all the paths in document order, merging the
+    matches of each path (XPath node-sets are already in document order)."""
+    # keys of the matched elements and their ancestors only, so that no map
+    # of the whole document is built
+    keys: Dict[_Element, Tuple[int, ...]] = {}
+
+    def _matches(
+        path: XPath, xpath: etree.XPath
+    ) -> List[Tuple[Tuple[Tuple[int, ...], int, int], XPath, Any]]:
+        result = xpath(relative_root)
+        return [
+            (
+                (_element_key(match, keys), 0, 0)
+                if isinstance(match, _Element)
+                else _document_position(match, relative_root, keys),
+                path,
+                match,
+            )
+            for match in (result if isinstance(result, list) else [result])
+        ]
+
+    for _, path, match in heapq.merge(
+        *(_matches(path, xpath) for path, xpath in zip(paths, xpaths)),
+        key=itemgetter(0),
+    ):
+        yield path, None if isinstance(match, _Element) else match
+
+
+def _document_position(
+    match: Any, relative_root: _Element, keys: Dict[_Element, Tuple[int, ...]]
+) -> Tuple[Tuple[int, ...], int, int]:
+    if isinstance(match, _Element):
+        return _element_key(match, keys), 0, 0
+
+    parent = getattr(match, "getparent", None)
+    element = parent() if parent else None
+    if element is None:
+        # not a node (e.g. string(), count()): before the relative root
+        return _element_key(relative_root, keys), -1, 0
+    if match.is_attribute:
+        return _element_key(element, keys), 1, 0
+    if match.is_tail:
+        # after the last descendant, the tails of nested elements from the innermost
+        last, depth = element, 0
+        while len(last):
+            last = last[-1]
+        ancestor = element.getparent()
+        while ancestor is not None:
+            depth += 1
+            ancestor = ancestor.getparent()
+        return _element_key(last, keys), 3, -depth
+    return _element_key(element, keys), 2, 0
+
+
+def _element_key(
+    element: _Element, keys: Dict[_Element, Tuple[int, ...]]
+) -> Tuple[int, ...]:
+    """Returns the indexes among siblings of the element and its ancestors (from
+    the root), that sort in document order, caching them in keys."""
+    missing = []
+    key: Tuple[int, ...] = ()
+    while element is not None:
+        try:
+            key = keys[element]
+            break
+        except KeyError:
+            missing.append(element)
+            element = element.getparent()
+    for element in reversed(missing):
+        parent = element.getparent()
+        key = key + (parent.index(element),) if parent is not None else ()
+        keys[element] = key
+    return key
+
+
+def _get_namespaces(element: _Element) -> Dict[str, str]:
+    ns = dict(element.nsmap)
+    if None in ns:
+        ns["ns"] = ns.pop(None)
+    return ns
+
+
+@lru_cache(maxsize=XPATH_CACHE_SIZE)
+def compile_paths(
+    paths: Tuple[XPath, ...], namespaces: FrozenSet[Tuple[str, str]]
+) -> Tuple[etree.XPath, ...]:
+    """Returns the paths compiled with the given namespaces and the flatehr
+    extension functions, caching the most recent ones: expressions are parsed once,
+    not for every relative root. The cache is bounded, since namespaces come from
+    the documents."""
+    ns = dict(namespaces)
+    return tuple(
+        etree.XPath(path, namespaces=ns, extensions=_EXTENSIONS) for path in paths
+    )
+
+
+def _first(context):
+    return context.context_node[0]
+
+
+_EXTENSIONS = {(None, "first"): _first}
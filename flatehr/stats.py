@@ -0,0 +1,141 @@
+"""Wall time and call counts of the generation stages.
+Collected only when enabled, otherwise get_stats() returns a Stats whose
+timers do nothing."""
+
+import json
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+from typing import IO, Any, Dict, Iterable, Iterator, Optional
+
+StageStats = Dict[str, Dict[str, float]]
+
+
+class _Timer:
+    def __init__(self, stats: "Stats", stage: str):
+        self._stats = stats
+        self._stage = stage
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+
+    def __exit__(self, *args):
+        self._stats.add(self._stage, time.perf_counter() - self._start)
+
+
+class Stats:
+    """Accumulates elapsed time and calls by stage. If trace is set, the stages of
+    each composition are also written to it as a json line by end_composition()."""
+
+    enabled = True
+
+    def __init__(self, trace: Optional[IO] = None):
+        self._elapsed: Dict[str, float] = defaultdict(float)
+        self._calls: Dict[str, int] = defaultdict(int)
+        self._timers: Dict[str, _Timer] = {}
+        self._trace = trace
+        self._composition_elapsed: Dict[str, float] = defaultdict(float)
+        self._compositions = 0
+
+    def add(self, stage: str, elapsed: float, calls: int = 1):
+        self._elapsed[stage] += elapsed
+        self._calls[stage] += calls
+        if self._trace is not None:
+            self._composition_elapsed[stage] += elapsed
+
+    def timer(self, stage: str):
+        """Returns a context manager adding its elapsed time to stage.
+        Not reentrant for the same stage."""
+        try:
+            return self._timers[stage]
+        except KeyError:
+            timer = self._timers[stage] = _Timer(self, stage)
+            return timer
+
+    def iter(self, stage: str, iterable: Iterable) -> Iterator:
+        """Yields from iterable, adding the time spent in getting each item to stage."""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(stage, time.perf_counter() - start, 0)
+                return
+            self.add(stage, time.perf_counter() - start)
+            yield item
+
+    def start_composition(self):
+        self._composition_elapsed.clear()
+
+    def end_composition(self, **info: Any):
+        self._compositions += 1
+        if self._trace is not None:
+            self._trace.write(
+                json.dumps(
+                    dict(
+                        info,
+                        stages={
+                            k: round(v, 6) for k, v in self._composition_elapsed.items()
+                        },
+                    )
+                )
+                + "\n"
+            )
+            self._composition_elapsed.clear()
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "compositions": self._compositions,
+            "stages": {
+                stage: {"calls": self._calls[stage], "seconds": round(elapsed, 6)}
+                for stage, elapsed in sorted(self._elapsed.items())
+            },
+        }
+
+    def merge(self, other: Dict[str, Any]):
+        """Adds the stats of another Stats (as returned by as_dict())."""
+        self._compositions += other["compositions"]
+        for stage, stage_stats in other["stages"].items():
+            self._elapsed[stage] += stage_stats["seconds"]
+            self._calls[stage] += int(stage_stats["calls"])
+
+
+class _DisabledStats(Stats):
+    enabled = False
+
+    def add(self, stage: str, elapsed: float, calls: int = 1):
+        ...
+
+    def timer(self, stage: str):
+        return _NULL_TIMER
+
+    def iter(self, stage: str, iterable: Iterable) -> Iterable:
+        return iterable
+
+    def start_composition(self):
+        ...
+
+    def end_composition(self, **info: Any):
+        ...
+
+
+_NULL_TIMER = nullcontext()
+_DISABLED = _DisabledStats()
+_stats: Stats = _DISABLED
+
+
+def get_stats() -> Stats:
+    return _stats
+
+
+def enable_stats(trace: Optional[IO] = None) -> Stats:
+    global _stats
+    _stats = Stats(trace)
+    return _stats
+
+
+def disable_stats():
+    global _stats
+    _stats = _DISABLED
@@ -11,7 +11,7 @@ parser.add_argument('-c', '--conf', type=str, help='composition generation conf'
 parser.add_argument('-p', '--processes', type=int, help='Parallel processes used', default=1)
 EOF
 # set -xeu
-ls $INFILE  | xargs -n1 -P $PROCESSES   flatehr generate from-file -c $CONF -t $TEMPLATE | \
+flatehr generate from-glob --workers $PROCESSES -c $CONF -t $TEMPLATE "$INFILE" | \
   tqdm --total $(ls $INFILE | wc -l)  | \
   while read ehr_id  comp ; do curl -X POST  -u $LOGIN -H 'Content-type: application/json' "$server/ehrbase/rest/ecis/v1/composition/?format=FLAT&ehrId=$ehr_id&templateId=crc_cohort_rev"  -d "$comp" 1>>out 2>&1 ; done 1>>out 2>&1
 
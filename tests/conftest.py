@@ -6,6 +6,13 @@ from flatehr.factory import template_factory, composition_factory
 from flatehr.cli.generate import conf_from_file
 
 
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setenv("FLATEHR_CACHE_DIR", str(cache_dir))
+    return cache_dir
+
+
 @pytest.fixture
 def web_template_json(web_template_path):
     with open(web_template_path) as f_obj:
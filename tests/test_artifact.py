@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from flatehr.artifact import InvalidArtifact, compile_file, load_template
+from flatehr.factory import template_factory
+
+
+@pytest.fixture
+def compiled_template(tmp_path, web_template_path):
+    compiled_template = tmp_path / "template.fehr"
+    compile_file(web_template_path, str(compiled_template))
+    return compiled_template
+
+
+@pytest.mark.parametrize("backend", template_factory.backends())
+@pytest.mark.parametrize(
+    "web_template_path",
+    [
+        "./tests/resources/web_template.json",
+        "./tests/resources/aql_path_missing_webtemplate.json",
+    ],
+)
+def test_load_compiled(backend, template, compiled_template):
+    compiled = load_template(str(compiled_template), backend)
+    assert compiled.backend == backend
+    assert compiled.get_conf_skeleton() == template.get_conf_skeleton()
+    for leaf, compiled_leaf in zip(template.root.leaves, compiled.root.leaves):
+        for attr in (
+            "_id",
+            "rm_type",
+            "aql_path",
+            "required",
+            "inf_cardinality",
+            "in_context",
+            "annotations",
+            "inputs",
+        ):
+            assert getattr(leaf, attr) == getattr(compiled_leaf, attr)
+
+
+@pytest.mark.parametrize("web_template_path", ["./tests/resources/web_template.json"])
+def test_corrupted(compiled_template):
+    data = bytearray(compiled_template.read_bytes())
+    data[-1] ^= 0xFF
+    compiled_template.write_bytes(bytes(data))
+    with pytest.raises(InvalidArtifact):
+        load_template(str(compiled_template))
+
+
+@pytest.mark.parametrize("web_template_path", ["./tests/resources/web_template.json"])
+def test_cache(cache_dir, web_template_path):
+    template = load_template(web_template_path)
+    cached = list(cache_dir.glob("*.fehr"))
+    assert len(cached) == 1
+
+    mtime = cached[0].stat().st_mtime_ns
+    assert (
+        load_template(web_template_path).get_conf_skeleton()
+        == template.get_conf_skeleton()
+    )
+    assert cached[0].stat().st_mtime_ns == mtime
+
+
+@pytest.mark.parametrize("web_template_path", ["./tests/resources/web_template.json"])
+def test_cache_disabled(cache_dir, web_template_path):
+    load_template(web_template_path, cache_dir="")
+    assert not cache_dir.exists()
@@ -3,7 +3,7 @@
 import sys
 import pytest
 
-from flatehr.build import build_composition
+from flatehr.build import build_composition, compile_jq
 from flatehr.core import flat
 from flatehr.factory import template_factory
 
@@ -38,3 +38,54 @@ def test_user_defined_function(conf_udf, template, source_kvs_json_udf):
     flat_composition = flat(composition, ctx)
     assert flat_composition == {"ctx/subject|name": "fake_1"}
     sys.path.remove("tests/")
+
+
+@pytest.mark.parametrize("backend", template_factory.backends())
+@pytest.mark.parametrize("web_template_path", ["./tests/resources/web_template.json"])
+def test_render_plan_reused(conf, template):
+    render_plan = conf.render_plan
+    flat_compositions = []
+    for _ in range(2):
+        composition, ctx, _ = build_composition(
+            conf, template, iter([("//ns:Dataelement_3_1/text()", "10")])
+        )
+        flat_compositions.append(flat(composition, ctx))
+    assert conf.render_plan is render_plan
+    assert flat_compositions[0] == flat_compositions[1]
+
+
+@pytest.mark.parametrize("backend", template_factory.backends())
+@pytest.mark.parametrize("web_template_path", ["./tests/resources/web_template.json"])
+def test_prototype_reused(conf, template):
+    path = "test/patient_data/primary_diagnosis/diagnosis_timing/primary_diagnosis"
+    flat_compositions = []
+    for value in ("10", "20"):
+        composition, ctx, _ = build_composition(
+            conf, template, iter([("//ns:Dataelement_3_1/text()", value)])
+        )
+        flat_compositions.append(flat(composition, ctx))
+    prototype = conf.prototype(template)
+    assert conf.prototype(template) is prototype
+    flat_prototype = flat(prototype.composition, prototype.ctx)
+    assert flat_prototype.items() <= flat_compositions[0].items()
+    assert not any(key.startswith(path) for key in flat_prototype)
+    assert flat_compositions[0][f"{path}:0/age_at_diagnosis"] == "P10Y"
+    assert flat_compositions[1][f"{path}:0/age_at_diagnosis"] == "P20Y"
+
+
+@pytest.mark.parametrize("backend", template_factory.backends())
+@pytest.mark.parametrize("web_template_path", ["./tests/resources/web_template.json"])
+def test_jq_cached(conf, template):
+    compile_jq.cache_clear()
+    for _ in range(3):
+        composition, ctx, _ = build_composition(
+            conf, template, iter([("//ns:Dataelement_85_1/text()", "male")])
+        )
+        flat_composition = flat(composition, ctx)
+        assert flat_composition["test/patient_data/gender/biological_sex|code"] == "8507"
+        assert (
+            flat_composition["test/patient_data/gender/biological_sex|terminology"]
+            == "omop_vocabulary"
+        )
+    cache_info = compile_jq.cache_info()
+    assert (cache_info.misses, cache_info.hits) == (2, 4)
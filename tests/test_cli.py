@@ -2,11 +2,19 @@
 # -*- coding: utf-8 -*-
 
 from contextlib import redirect_stdout
+import gzip
 import io
 import json
+import shutil
+import signal
+import subprocess
+import sys
 import pytest
-from flatehr.cli.generate import from_file
+from flatehr.cli.generate import from_dir, from_file, from_glob
+from flatehr.cli.compile_template import main as compile_template
+from flatehr.cli.entrypoint import main as entrypoint
 from flatehr.cli.inspect_template import main as inspect
+from flatehr.journal import STARTED, Journal
 
 
 @pytest.mark.parametrize(
@@ -24,7 +32,8 @@ from flatehr.cli.inspect_template import main as inspect
         ),
     ],
 )
-def test_from_file(input_file, template_file, conf_file, expected_composition):
+@pytest.mark.parametrize("backend", ["anytree", "compact"])
+def test_from_file(input_file, template_file, conf_file, backend, expected_composition):
     f = io.StringIO()
     with redirect_stdout(f):
         from_file(
@@ -32,11 +41,205 @@ def test_from_file(input_file, template_file, conf_file, expected_composition):
             template_file=template_file,
             conf_file=conf_file,
             skip_ehr_id=True,
+            backend=backend,
         )
     stdout = f.getvalue()
     assert json.loads(stdout) == expected_composition
 
 
+@pytest.mark.parametrize(
+    "input_file,template_file, conf_file",
+    [
+        (
+            "tests/resources/source.xml",
+            "tests/resources/web_template.json",
+            "tests/resources/xml_conf.yaml",
+        ),
+        (
+            "tests/resources/source.json",
+            "tests/resources/web_template.json",
+            "tests/resources/json_conf.yaml",
+        ),
+    ],
+)
+def test_from_dir(input_file, template_file, conf_file, expected_composition, tmp_path):
+    ext = input_file.rsplit(".", 1)[1]
+    for i in range(3):
+        shutil.copy(input_file, tmp_path / f"source_{i}.{ext}")
+    (tmp_path / "README.txt").write_text("not a source")
+
+    output_file = tmp_path / "compositions.ndjson"
+    from_dir(
+        str(tmp_path),
+        template_file=template_file,
+        conf_file=conf_file,
+        output_file=str(output_file),
+    )
+    lines = output_file.read_text().splitlines()
+    assert len(lines) == 3
+    for line in lines:
+        ehr_id, flat_composition = line.split("\t")
+        assert ehr_id
+        assert json.loads(flat_composition) == expected_composition
+
+
+def test_from_glob(expected_composition, tmp_path):
+    for i in range(2):
+        shutil.copy("tests/resources/source.xml", tmp_path / f"source_{i}.xml")
+
+    f = io.StringIO()
+    with redirect_stdout(f):
+        from_glob(
+            str(tmp_path / "*.xml"),
+            template_file="tests/resources/web_template.json",
+            conf_file="tests/resources/xml_conf.yaml",
+            skip_ehr_id=True,
+        )
+    lines = f.getvalue().splitlines()
+    assert [json.loads(line) for line in lines] == [expected_composition] * 2
+
+
+def test_from_file_stream(tmp_path):
+    conf_file = tmp_path / "conf.yaml"
+    conf_file.write_text(
+        """
+ehr_id:
+  maps_to: []
+  value: "ehr_id"
+paths:
+  ctx/language: en
+  ctx/time:
+    maps_to:
+      - "./@name"
+    suffixes:
+      "": "{{ date_isoformat(maps_to[0]) }}"
+  test/histopathology/result_group/laboratory_test_result/any_event/test_name:
+    maps_to:
+      - "self::ns:Event[@eventtype='Histopathology']/@eventtype"
+    suffixes:
+      "": "{{ maps_to[0] }}"
+"""
+    )
+    outputs = []
+    for stream in (False, True):
+        f = io.StringIO()
+        with redirect_stdout(f):
+            from_file(
+                "tests/resources/source.xml",
+                template_file="tests/resources/web_template.json",
+                conf_file=str(conf_file),
+                relative_root="Event",
+                skip_ehr_id=True,
+                stream=stream,
+            )
+        outputs.append(f.getvalue().splitlines())
+    assert len(outputs[1]) == 8
+    assert outputs[1] == outputs[0]
+
+
+def test_from_file_stream_absolute_paths():
+    # the paths of xml_conf.yaml are absolute, they cannot be streamed
+    with pytest.raises(ValueError, match="must be relative"):
+        from_file(
+            "tests/resources/source.xml",
+            template_file="tests/resources/web_template.json",
+            conf_file="tests/resources/xml_conf.yaml",
+            relative_root="Event",
+            stream=True,
+        )
+
+
+@pytest.mark.parametrize("ext", [".json", ".ndjson", ".jsonl"])
+def test_from_file_json_records(ext, tmp_path):
+    kwargs = dict(
+        template_file="tests/resources/web_template.json",
+        conf_file="tests/resources/json_conf.yaml",
+        skip_ehr_id=True,
+    )
+    f = io.StringIO()
+    with redirect_stdout(f):
+        from_file("tests/resources/source.json", **kwargs)
+    expected = f.getvalue().splitlines()
+
+    with open("tests/resources/source.json") as f_obj:
+        record = json.load(f_obj)
+    input_file = tmp_path / f"source{ext}"
+    input_file.write_text(
+        json.dumps([record] * 3)
+        if ext == ".json"
+        else "\n".join(json.dumps(record) for _ in range(3))
+    )
+    f = io.StringIO()
+    with redirect_stdout(f):
+        from_file(str(input_file), stream=True, **kwargs)
+    assert f.getvalue().splitlines() == expected * 3
+
+
+@pytest.mark.parametrize("ordered", [True, False])
+@pytest.mark.parametrize("relative_root", [None, "Event"])
+def test_from_glob_workers(ordered, relative_root, tmp_path):
+    for i in range(3):
+        shutil.copy("tests/resources/source.xml", tmp_path / f"source_{i}.xml")
+
+    kwargs = dict(
+        template_file="tests/resources/web_template.json",
+        conf_file="tests/resources/xml_conf.yaml",
+        relative_root=relative_root,
+        skip_ehr_id=True,
+    )
+    serial_output = tmp_path / "serial.ndjson"
+    parallel_output = tmp_path / "parallel.ndjson"
+    from_glob(str(tmp_path / "*.xml"), output_file=str(serial_output), **kwargs)
+    from_glob(
+        str(tmp_path / "*.xml"),
+        output_file=str(parallel_output),
+        workers=2,
+        ordered=ordered,
+        **kwargs,
+    )
+
+    serial_lines = serial_output.read_text().splitlines()
+    parallel_lines = parallel_output.read_text().splitlines()
+    if ordered:
+        assert parallel_lines == serial_lines
+    else:
+        assert sorted(parallel_lines) == sorted(serial_lines)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_from_glob_stats(workers, tmp_path, capsys):
+    for i in range(2):
+        shutil.copy("tests/resources/source.xml", tmp_path / f"source_{i}.xml")
+    trace_file = tmp_path / "trace.jsonl"
+    profile = tmp_path / "profile.out"
+
+    from_glob(
+        str(tmp_path / "*.xml"),
+        template_file="tests/resources/web_template.json",
+        conf_file="tests/resources/xml_conf.yaml",
+        relative_root="Event",
+        output_file=str(tmp_path / "output.ndjson"),
+        workers=workers,
+        stats=True,
+        trace_file=str(trace_file),
+        profile=str(profile),
+    )
+
+    n_compositions = len((tmp_path / "output.ndjson").read_text().splitlines())
+    summary = json.loads(capsys.readouterr().err.splitlines()[-1])
+    assert summary["compositions"] == n_compositions
+    assert summary["stages"]["build"]["calls"] == n_compositions
+    assert summary["stages"]["serialization"]["calls"] == n_compositions
+    for stage in ("template", "source.parse", "source.extract", "render", "mutation"):
+        assert summary["stages"][stage]["calls"] > 0
+    assert ("caches" in summary) == (workers == 1)
+
+    trace = [json.loads(line) for line in trace_file.read_text().splitlines()]
+    assert len(trace) == n_compositions
+    assert all("build" in record["stages"] for record in trace)
+    assert profile.stat().st_size > 0
+
+
 @pytest.mark.parametrize("template_file", ("tests/resources/web_template.json",))
 def test_inspect(template_file, expected_inspect):
     f = io.StringIO()
@@ -46,5 +249,299 @@ def test_inspect(template_file, expected_inspect):
     assert stdout == expected_inspect
 
 
+def test_inspect_compiled(expected_inspect, tmp_path):
+    compiled_template = str(tmp_path / "template.fehr")
+    compile_template("tests/resources/web_template.json", output_file=compiled_template)
+    f = io.StringIO()
+    with redirect_stdout(f):
+        inspect(compiled_template, aql_path=True, inputs=True)
+    assert f.getvalue() == expected_inspect
+
+
 def test_missing_aql_path(missing_aql_path_webtemplate):
     inspect(missing_aql_path_webtemplate, aql_path=True)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_from_glob_journal(workers, tmp_path):
+    sources = tmp_path / "sources"
+    sources.mkdir()
+    for i in range(2):
+        shutil.copy("tests/resources/source.xml", sources / f"source_{i}.xml")
+    output = tmp_path / "output.ndjson"
+    kwargs = dict(
+        template_file="tests/resources/web_template.json",
+        conf_file="tests/resources/xml_conf.yaml",
+        relative_root="Event",
+        skip_ehr_id=True,
+        output_file=str(output),
+        workers=workers,
+        journal_file=str(tmp_path / "journal.sqlite"),
+    )
+
+    from_glob(str(sources / "*.xml"), **kwargs)
+    lines = output.read_text().splitlines()
+    assert len(lines) == 16
+
+    # completed files are skipped
+    from_glob(str(sources / "*.xml"), **kwargs)
+    assert output.read_text().splitlines() == lines
+
+    # with only_changed, changed files are processed again,
+    # but only new compositions are written
+    source = (sources / "source_1.xml").read_text()
+    (sources / "source_1.xml").write_text(source + "\n<!-- changed -->\n")
+    from_glob(str(sources / "*.xml"), only_changed=True, **kwargs)
+    assert output.read_text().splitlines() == lines
+
+    (sources / "source_1.xml").write_text(source.replace(">male<", ">female<"))
+    from_glob(str(sources / "*.xml"), only_changed=True, **kwargs)
+    new_lines = output.read_text().splitlines()[len(lines) :]
+    assert len(new_lines) == 8
+
+
+KILLED_RUN = """
+import functools, os, signal, sys
+from flatehr.cli import generate
+from flatehr.journal import Journal
+
+# small batches, so that the output is flushed while the file is processed:
+# the run is killed once the third batch is written, before it is journaled
+generate.get_sink = functools.partial(generate.get_sink, batch_size=5)
+record_written = Journal.record_written
+batches = []
+
+
+def record_written_or_kill(self, units, offsets):
+    if units:
+        batches.append(units)
+        if len(batches) == 3:
+            os.kill(os.getpid(), signal.SIGKILL)
+    record_written(self, units, offsets)
+
+
+Journal.record_written = record_written_or_kill
+generate.from_glob(
+    sys.argv[1],
+    template_file="tests/resources/web_template.json",
+    conf_file="tests/resources/json_conf.yaml",
+    skip_ehr_id=True,
+    output_file=sys.argv[2],
+    journal_file=sys.argv[3],
+)
+"""
+
+
+@pytest.mark.parametrize("output_name", ["output.ndjson", "output.ndjson.gz"])
+def test_from_glob_journal_resume(output_name, tmp_path):
+    n_compositions = 30
+    with open("tests/resources/source.json") as f_obj:
+        line = json.dumps(json.load(f_obj))
+    (tmp_path / "sources").mkdir()
+    input_file = tmp_path / "sources" / "source.ndjson"
+    input_file.write_text(f"{line}\n" * n_compositions)
+    output = tmp_path / output_name
+    journal_file = tmp_path / "journal.sqlite"
+    _open = gzip.open if output_name.endswith(".gz") else open
+
+    process = subprocess.run(
+        [sys.executable, "-c", KILLED_RUN, str(input_file), str(output), str(journal_file)]
+    )
+    assert process.returncode == -signal.SIGKILL
+    with _open(output, "rt") as f_obj:
+        assert len(f_obj.read().splitlines()) == 15
+
+    journal = Journal(str(journal_file), "", "")
+    assert journal.status(str(input_file)) == STARTED
+    journal.close()
+
+    from_glob(
+        str(tmp_path / "sources" / "*.ndjson"),
+        template_file="tests/resources/web_template.json",
+        conf_file="tests/resources/json_conf.yaml",
+        skip_ehr_id=True,
+        output_file=str(output),
+        journal_file=str(journal_file),
+    )
+    with _open(output, "rt") as f_obj:
+        lines = f_obj.read().splitlines()
+    assert len(lines) == n_compositions
+    assert len({json.loads(line)["ctx/language"] for line in lines}) == 1
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+@pytest.mark.parametrize(
+    "output,format,compression",
+    [
+        ("output.ndjson.gz", "ndjson", None),
+        ("output", "files", None),
+        ("output", "files", "gzip"),
+        ("output", "partitioned", None),
+        ("output", "partitioned", "gzip"),
+    ],
+)
+def test_from_glob_sinks(output, format, compression, workers, tmp_path):
+    for i in range(2):
+        shutil.copy("tests/resources/source.xml", tmp_path / f"source_{i}.xml")
+    kwargs = dict(
+        template_file="tests/resources/web_template.json",
+        conf_file="tests/resources/xml_conf.yaml",
+        relative_root="Event",
+        workers=workers,
+    )
+    from_glob(
+        str(tmp_path / "*.xml"), output_file=str(tmp_path / "expected.ndjson"), **kwargs
+    )
+    # ehr ids are random
+    expected = [
+        line.split("\t")[1]
+        for line in (tmp_path / "expected.ndjson").read_text().splitlines()
+    ]
+
+    output_path = tmp_path / output
+    from_glob(
+        str(tmp_path / "*.xml"),
+        output_file=str(output_path),
+        format=format,
+        compression=compression,
+        partitions=4,
+        **kwargs,
+    )
+    _open = gzip.open if compression or output.endswith(".gz") else open
+    if format == "files":
+        paths = list(output_path.glob("*/*"))
+        ehr_ids = [path.parent.name for path in paths]
+        compositions = []
+        for path in paths:
+            with _open(path, "rt") as f_obj:
+                compositions.append(f_obj.read())
+    else:
+        ehr_ids, compositions = [], []
+        for path in [output_path] if format == "ndjson" else output_path.iterdir():
+            with _open(path, "rt") as f_obj:
+                part = [line.split("\t") for line in f_obj.read().splitlines()]
+            ehr_ids += [ehr_id for ehr_id, _ in part]
+            compositions += [composition for _, composition in part]
+        if format == "partitioned":
+            assert len(list(output_path.iterdir())) <= 4
+    assert len(set(ehr_ids)) == len(expected)
+    assert sorted(compositions) == sorted(expected)
+
+
+@pytest.mark.parametrize("backend", ["anytree", "compact"])
+@pytest.mark.parametrize("workers", [1, 2])
+def test_from_glob_structured(workers, backend, expected_composition, tmp_path):
+    for i in range(2):
+        shutil.copy("tests/resources/source.xml", tmp_path / f"source_{i}.xml")
+    output = tmp_path / "output.ndjson"
+    from_glob(
+        str(tmp_path / "*.xml"),
+        template_file="tests/resources/web_template.json",
+        conf_file="tests/resources/xml_conf.yaml",
+        skip_ehr_id=True,
+        output_file=str(output),
+        workers=workers,
+        structured=True,
+        backend=backend,
+    )
+    compositions = [json.loads(line) for line in output.read_text().splitlines()]
+    assert len(compositions) == 2
+    for composition in compositions:
+        assert composition["ctx"]["time"] == expected_composition["ctx/time"]
+        assert composition["ctx"]["subject"] == {"|name": "42112"}
+        assert composition["test"]["histopathology"][0]["result_group"][0][
+            "laboratory_test_result"
+        ][0]["any_event"] == [{"test_name": ["Histopathology"]}] * 2
+        assert composition["test"]["patient_data"][0]["gender"] == [
+            {
+                "biological_sex": [
+                    {"|code": "8507", "|value": "MALE", "|terminology": "omop_vocabulary"}
+                ]
+            }
+        ]
+
+
+def test_entrypoint_from_file(expected_composition, capsys):
+    entrypoint(
+        [
+            "generate",
+            "from-file",
+            "-t",
+            "tests/resources/web_template.json",
+            "-c",
+            "tests/resources/xml_conf.yaml",
+            "-s",
+            "tests/resources/source.xml",
+        ]
+    )
+    assert json.loads(capsys.readouterr().out) == expected_composition
+
+
+def test_entrypoint_backend(expected_composition, capsys):
+    entrypoint(
+        [
+            "generate",
+            "from-file",
+            "-t",
+            "tests/resources/web_template.json",
+            "-c",
+            "tests/resources/xml_conf.yaml",
+            "-s",
+            "--backend",
+            "compact",
+            "tests/resources/source.xml",
+        ]
+    )
+    assert json.loads(capsys.readouterr().out) == expected_composition
+
+
+def test_entrypoint_from_glob(tmp_path):
+    shutil.copy("tests/resources/source.xml", tmp_path / "source.xml")
+    output_file = tmp_path / "output.ndjson"
+    entrypoint(
+        [
+            "generate",
+            "from-glob",
+            "-t",
+            "tests/resources/web_template.json",
+            "-c",
+            "tests/resources/xml_conf.yaml",
+            "-r",
+            "Event",
+            "-o",
+            str(output_file),
+            "-w",
+            "2",
+            str(tmp_path / "*.xml"),
+        ]
+    )
+    assert len(output_file.read_text().splitlines()) == 8
+
+
+@pytest.mark.parametrize(
+    "command,flags",
+    [
+        (["generate", "from-dir"], ["-t", "-c", "-r", "-s", "-o", "-w"]),
+        (["submit"], ["-t", "-c", "-u", "-l", "-f"]),
+        (["inspect"], ["-a", "-i"]),
+        (["template", "compile"], ["-o"]),
+    ],
+)
+def test_entrypoint_short_flags(command, flags, capsys):
+    with pytest.raises(SystemExit):
+        entrypoint(command + ["-h"])
+    usage = capsys.readouterr().out
+    for flag in flags:
+        assert f"{flag} " in usage or f"{flag}," in usage
+
+
+def test_from_file_ehr_id(expected_composition, capsys):
+    from_file(
+        "tests/resources/source.xml",
+        template_file="tests/resources/web_template.json",
+        conf_file="tests/resources/xml_conf.yaml",
+    )
+    # unlike from-dir and from-glob, the ehr id is separated by a space
+    ehr_id, flat_composition = capsys.readouterr().out.rstrip("\n").split(" ", 1)
+    assert ehr_id and "\t" not in ehr_id
+    assert json.loads(flat_composition) == expected_composition
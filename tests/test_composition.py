@@ -7,7 +7,7 @@ import pytest
 
 from flatehr.core import Composition, IncompatibleDataType, NotaLeaf, NullFlavour
 from flatehr.factory import composition_factory, template_factory
-from flatehr.core import flat
+from flatehr.core import flat, structured
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -47,6 +47,47 @@ def test_composition_add_multiple_instances(composition):
     }
 
 
+@pytest.mark.parametrize("backend", template_factory.backends())
+@pytest.mark.parametrize("web_template_path", ["./tests/resources/web_template.json"])
+def test_composition_many_instances(composition):
+    path = "test/histopathology/result_group/laboratory_test_result/any_event"
+
+    for i in range(50):
+        added = composition.add(path)
+        assert added == f"{path}:{i}"
+        composition[f"{path}/test_name"] = {"": f"test-{i}"}
+
+    assert composition[f"{path}:42/test_name"] == {"": "test-42"}
+    assert flat(composition) == {
+        f"{path}:{i}/test_name": f"test-{i}" for i in range(50)
+    }
+
+
+@pytest.mark.parametrize("backend", template_factory.backends())
+@pytest.mark.parametrize("web_template_path", ["./tests/resources/web_template.json"])
+def test_composition_set_missing_defaults(composition):
+    path = "test/histopathology/result_group/laboratory_test_result/any_event"
+    for i in range(3):
+        composition.add(path)
+        composition[f"{path}/time"] = {"": f"time-{i}"}
+        if i == 1:
+            composition[f"{path}/test_name"] = {"": "test-1"}
+    composition["test/patient_data/gender/biological_sex"] = {"|code": "8532"}
+
+    composition.set_defaults()
+    flat_composition = flat(composition)
+
+    assert flat_composition[f"{path}:0/test_name"] == "Histopathology analysis"
+    assert flat_composition[f"{path}:1/test_name"] == "test-1"
+    assert flat_composition[f"{path}:2/test_name"] == "Histopathology analysis"
+    assert (
+        flat_composition["test/patient_data/primary_diagnosis/primary_diagnosis|code"]
+        == "44803809"
+    )
+    # the root missing children are not created
+    assert not any(key.startswith("test/context") for key in flat_composition)
+
+
 #  @pytest.mark.parametrize("backend", template_factory.backends())
 #  def test_composition_create_dv_text_with_default(composition):
 #      path = "test/targeted_therapy_start/start_of_targeted_therapy/from_event"
@@ -105,6 +146,130 @@ def test_set_null_flavour(composition):
     #  )
 
 
+@pytest.mark.parametrize("backend", template_factory.backends())
+@pytest.mark.parametrize("web_template_path", ["./tests/resources/web_template.json"])
+def test_structured(composition):
+    path = "test/histopathology/result_group/laboratory_test_result/any_event"
+    for i in range(3):
+        composition.add(path)
+        composition[f"{path}/test_name"] = {"": f"test-{i}"}
+    composition["test/patient_data/gender/biological_sex"] = {
+        "|code": "8507",
+        "|value": "MALE",
+    }
+    composition[
+        "test/patient_data/primary_diagnosis/primary_diagnosis"
+    ] = NullFlavour.get_default()
+    # a branch without values is omitted
+    composition.add("test/patient_data/primary_diagnosis/diagnosis_timing")
+
+    ctx = {"ctx/language": {"": "en"}, "ctx/territory": {"|code": "IT"}}
+    assert structured(composition, ctx) == {
+        "test": {
+            "histopathology": [
+                {
+                    "result_group": [
+                        {
+                            "laboratory_test_result": [
+                                {
+                                    "any_event": [
+                                        {"test_name": [f"test-{i}"]} for i in range(3)
+                                    ]
+                                }
+                            ]
+                        }
+                    ]
+                }
+            ],
+            "patient_data": [
+                {
+                    "gender": [
+                        {"biological_sex": [{"|code": "8507", "|value": "MALE"}]}
+                    ],
+                    "primary_diagnosis": [
+                        {
+                            "primary_diagnosis": [
+                                {
+                                    "_null_flavour": [
+                                        {
+                                            "|value": "unknown",
+                                            "|code": "253",
+                                            "|terminology": "openehr",
+                                        }
+                                    ],
+                                    # the place holder, as in flat
+                                    "|value": "",
+                                }
+                            ]
+                        }
+                    ],
+                }
+            ],
+        },
+        "ctx": {"language": "en", "territory": {"|code": "IT"}},
+    }
+
+
+@pytest.mark.parametrize("backend", template_factory.backends())
+@pytest.mark.parametrize("web_template_path", ["./tests/resources/web_template.json"])
+@pytest.mark.parametrize(
+    "value,expected",
+    [
+        ({"": "MALE", "|code": "8507"}, {"|value": "MALE", "|code": "8507"}),
+        # with |value set, the bare value is dropped
+        (
+            {"": "male", "|value": "MALE", "|code": "8507"},
+            {"|value": "MALE", "|code": "8507"},
+        ),
+        (
+            {"": "MALE", "|value": "", "|code": "8507"},
+            {"|value": "MALE", "|code": "8507"},
+        ),
+        # empty values are kept, as in flat
+        ({"": "", "|code": "8507"}, {"|value": "", "|code": "8507"}),
+        ({"|value": "", "|code": "8507"}, {"|value": "", "|code": "8507"}),
+        ({"": ""}, ""),
+    ],
+)
+def test_structured_leaf_value(value, expected, composition):
+    composition["test/patient_data/gender/biological_sex"] = value
+    assert structured(composition)["test"]["patient_data"][0]["gender"] == [
+        {"biological_sex": [expected]}
+    ]
+
+
+def _structured_values(value):
+    if isinstance(value, list):
+        for item in value:
+            yield from _structured_values(item)
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from _structured_values(item)
+    else:
+        yield value
+
+
+@pytest.mark.parametrize("backend", template_factory.backends())
+@pytest.mark.parametrize("web_template_path", ["./tests/resources/web_template.json"])
+def test_structured_same_leaves_as_flat(composition):
+    path = "test/histopathology/result_group/laboratory_test_result/any_event"
+    for i in range(2):
+        composition.add(path)
+        composition[f"{path}/test_name"] = {"": f"test-{i}" if i else ""}
+    composition["test/patient_data/gender/biological_sex"] = {
+        "|code": "8507",
+        "|value": "",
+    }
+    composition[
+        "test/patient_data/primary_diagnosis/primary_diagnosis"
+    ] = NullFlavour.get_default()
+    ctx = {"ctx/language": {"": ""}, "ctx/territory": {"|code": "IT"}}
+
+    flat_values = sorted(flat(composition, ctx).values())
+    assert "" in flat_values
+    assert sorted(_structured_values(structured(composition, ctx))) == flat_values
+
+
 #  @pytest.mark.parametrize("backend", template_factory.backends())
 #  @pytest.mark.parametrize(
 #      "web_template_path", ["./tests/resources/complex_template.json"]
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import redirect_stdout
+import io
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import pytest
+from pyaml import yaml
+
+from flatehr.cli import serve
+from flatehr.cli.generate import from_file
+from flatehr.cli.serve import Server
+
+
+@pytest.fixture
+def templates_file(tmp_path):
+    templates_file = tmp_path / "templates.yaml"
+    templates_file.write_text(
+        yaml.safe_dump(
+            {
+                "xml": {
+                    "template_file": "tests/resources/web_template.json",
+                    "conf_file": "tests/resources/xml_conf.yaml",
+                },
+                "json": {
+                    "template_file": "tests/resources/web_template.json",
+                    "conf_file": "tests/resources/json_conf.yaml",
+                    "backend": "compact",
+                },
+            }
+        )
+    )
+    return str(templates_file)
+
+
+@pytest.fixture(params=["thread", "process"])
+def server_url(request, templates_file):
+    serve._init_worker(templates_file)
+    executor = (
+        ThreadPoolExecutor(max_workers=1)
+        if request.param == "thread"
+        else ProcessPoolExecutor(
+            max_workers=1, initializer=serve._init_worker, initargs=(templates_file,)
+        )
+    )
+    loop = asyncio.new_event_loop()
+    server = Server(list(serve._services.keys()), executor)
+    loop.run_until_complete(server.start())
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    yield f"http://127.0.0.1:{server.port}"
+
+    asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+    executor.shutdown()
+
+
+def _post(url, data, content_type):
+    request = Request(url, data=data, headers={"Content-Type": content_type})
+    with urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def _from_file(input_file, conf_file, **kwargs):
+    f = io.StringIO()
+    with redirect_stdout(f):
+        from_file(
+            input_file,
+            template_file="tests/resources/web_template.json",
+            conf_file=conf_file,
+            skip_ehr_id=True,
+            **kwargs,
+        )
+    return [json.loads(line) for line in f.getvalue().splitlines()]
+
+
+@pytest.mark.parametrize("relative_root", [None, "Event"])
+def test_serve_xml(server_url, relative_root):
+    with open("tests/resources/source.xml", "rb") as f_obj:
+        payload = f_obj.read()
+    url = f"{server_url}/templates/xml/compositions"
+    if relative_root:
+        url += f"?relative_root={relative_root}"
+
+    response = _post(url, payload, "application/xml")
+
+    expected = _from_file(
+        "tests/resources/source.xml",
+        "tests/resources/xml_conf.yaml",
+        relative_root=relative_root,
+    )
+    assert [c["composition"] for c in response] == expected
+    assert all(c["ehr_id"] for c in response)
+
+
+def test_serve_json(server_url):
+    with open("tests/resources/source.json") as f_obj:
+        record = json.load(f_obj)
+    expected = _from_file("tests/resources/source.json", "tests/resources/json_conf.yaml")
+
+    url = f"{server_url}/templates/json/compositions"
+    response = _post(
+        f"{url}?stream=true", json.dumps([record] * 2).encode(), "application/json"
+    )
+    assert [c["composition"] for c in response] == expected * 2
+
+    response = _post(
+        url,
+        "\n".join(json.dumps(record) for _ in range(3)).encode(),
+        "application/x-ndjson",
+    )
+    assert [c["composition"] for c in response] == expected * 3
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_serve_same_as_from_file(server_url, stream, tmp_path):
+    # without stream, a top level array is a single source, as in from-file
+    with open("tests/resources/source.json") as f_obj:
+        record = json.load(f_obj)
+    input_file = tmp_path / "source.json"
+    input_file.write_text(json.dumps([record] * 2))
+    expected = _from_file(
+        str(input_file), "tests/resources/json_conf.yaml", stream=stream
+    )
+
+    url = f"{server_url}/templates/json/compositions"
+    if stream:
+        url += "?stream=true"
+    response = _post(url, input_file.read_bytes(), "application/json")
+    assert [c["composition"] for c in response] == expected
+
+
+@pytest.mark.parametrize("server_url", ["thread"], indirect=True)
+def test_serve_unexpected_error(server_url, monkeypatch, caplog):
+    def convert(*args):
+        raise RuntimeError("internal detail")
+
+    monkeypatch.setattr(serve, "convert", convert)
+    with pytest.raises(HTTPError) as ex:
+        _post(f"{server_url}/templates/xml/compositions", b"<a/>", "application/xml")
+    assert ex.value.code == 500
+    assert json.loads(ex.value.read()) == {"error": "Internal Server Error"}
+    assert "internal detail" in caplog.text
+
+
+def test_serve_templates(server_url):
+    with urlopen(f"{server_url}/templates") as response:
+        assert sorted(json.loads(response.read())) == ["json", "xml"]
+
+
+@pytest.mark.parametrize(
+    "path,data,content_type,status",
+    [
+        ("/templates/missing/compositions", b"<a/>", "application/xml", 404),
+        ("/other", b"<a/>", "application/xml", 404),
+        ("/templates/xml/compositions", b"<a/>", "text/plain", 415),
+        ("/templates/xml/compositions", b"<a>", "application/xml", 400),
+        ("/templates/json/compositions", b"[{]", "application/json", 400),
+        ("/templates/xml/compositions", None, "application/xml", 405),
+    ],
+)
+def test_serve_errors(server_url, path, data, content_type, status):
+    with pytest.raises(HTTPError) as ex:
+        if data is None:
+            urlopen(f"{server_url}{path}")
+        else:
+            _post(f"{server_url}{path}", data, content_type)
+    assert ex.value.code == status
+    assert "error" in json.loads(ex.value.read())
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import gzip
+import io
+import json
+from contextlib import redirect_stdout
+
+import pytest
+
+from flatehr.sinks import FilesSink, NdjsonSink, PartitionedSink, get_sink
+
+RECORDS = [
+    (f"ehr-{i % 5}", json.dumps({"ctx/language": "en", "index": i})) for i in range(50)
+]
+
+
+def test_ndjson_sink_stdout():
+    f = io.StringIO()
+    with redirect_stdout(f):
+        with NdjsonSink(batch_size=7) as sink:
+            sink.writelines(RECORDS)
+            sink.write(None, "{}")
+    assert f.getvalue().splitlines() == [
+        f"{ehr_id}\t{composition}" for ehr_id, composition in RECORDS
+    ] + ["{}"]
+
+
+def test_ndjson_sink_gzip_append(tmp_path):
+    output = str(tmp_path / "output.ndjson.gz")
+    for append in (False, True):
+        with get_sink(output, append=append) as sink:
+            sink.writelines(RECORDS)
+            sink.flush()
+    with gzip.open(output, "rt") as f_obj:
+        assert len(f_obj.read().splitlines()) == 2 * len(RECORDS)
+
+
+@pytest.mark.parametrize("name", ["output.ndjson", "output.ndjson.gz"])
+def test_ndjson_sink_offsets(name, tmp_path):
+    output = str(tmp_path / name)
+    written = []
+    with get_sink(
+        output,
+        append=True,
+        batch_size=20,
+        on_written=lambda units, offsets: written.append((units, offsets)),
+    ) as sink:
+        for index, record in enumerate(RECORDS):
+            sink.write(*record, index)
+    assert written[0] == ([], {output: 0})
+    assert [units for units, _ in written[1:]] == [
+        list(range(20)),
+        list(range(20, 40)),
+        list(range(40, 50)),
+    ]
+
+    # data after the offset of the second batch are dropped
+    offsets = written[2][1]
+    with open(output, "ab") as f_obj:
+        f_obj.write(b"partial")
+    with get_sink(output, append=True, offsets=offsets) as sink:
+        sink.writelines(RECORDS[40:])
+    with (gzip.open if name.endswith(".gz") else open)(output, "rt") as f_obj:
+        assert f_obj.read().splitlines() == [
+            f"{ehr_id}\t{composition}" for ehr_id, composition in RECORDS
+        ]
+
+
+def test_partitioned_sink(tmp_path):
+    with PartitionedSink(str(tmp_path), partitions=3, batch_size=4) as sink:
+        sink.writelines(RECORDS)
+
+    partitions = {}
+    for path in tmp_path.iterdir():
+        assert path.name.startswith("part-")
+        for line in path.read_text().splitlines():
+            partitions.setdefault(line.split("\t")[0], set()).add(path.name)
+    assert len(partitions) == 5
+    assert all(len(names) == 1 for names in partitions.values())
+
+
+def test_files_sink(tmp_path):
+    with FilesSink(str(tmp_path / "output")) as sink:
+        sink.writelines(RECORDS)
+        sink.writelines(RECORDS)
+        sink.write("a/b", "{}")
+
+    assert sorted(path.name for path in (tmp_path / "output").iterdir()) == [
+        "a%2Fb"
+    ] + [f"ehr-{i}" for i in range(5)]
+    assert len(list((tmp_path / "output").glob("ehr-*/*.json"))) == len(RECORDS)
+
+
+def test_sink_error(tmp_path):
+    sink = FilesSink(str(tmp_path), batch_size=1)
+    # the directory of the ehr id can not be created
+    (tmp_path / "ehr").write_text("")
+    sink.write("ehr", "{}")
+    with pytest.raises(OSError):
+        sink.flush()
+    sink.close()
+
+
+def test_get_sink_errors(tmp_path):
+    with pytest.raises(RuntimeError):
+        get_sink(str(tmp_path), "parquet")
+    with pytest.raises(RuntimeError):
+        get_sink(str(tmp_path / "output.ndjson"), compression="lz4")
+    with pytest.raises(RuntimeError):
+        get_sink(None, "files")
+
+
+def test_zstd(tmp_path):
+    zstandard = pytest.importorskip("zstandard")
+    output = str(tmp_path / "output.ndjson.zst")
+    with get_sink(output) as sink:
+        sink.writelines(RECORDS)
+    with zstandard.open(output, "rt") as f_obj:
+        assert len(f_obj.read().splitlines()) == len(RECORDS)
@@ -1,10 +1,23 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import io
+import json
+
 import pytest
-from flatehr.sources.json import JsonPathSource
 
-from flatehr.sources.xml import XPathSource
+from flatehr.sources.json import (
+    JsonPathSource,
+    StreamingJsonPathSource,
+    compile_path,
+)
+
+from flatehr.sources.xml import (
+    XPATH_CACHE_SIZE,
+    StreamingXPathSource,
+    XPathSource,
+    compile_paths,
+)
 
 
 @pytest.mark.parametrize(
@@ -25,6 +38,62 @@ def test_xpath_source(expected_values, xml_source):
     assert values == expected_values
 
 
+@pytest.mark.parametrize(
+    "paths",
+    [
+        (
+            "./@eventtype",
+            ".//ns:Dataelement_54_2/text()",
+            ".//ns:Value/text()",
+        )
+    ],
+)
+def test_streaming_xpath_source(paths, xml_source):
+    xpath_source = XPathSource(xml_source, paths)
+    expected_values = []
+    for el in xpath_source.get_elements("//ns:Event"):
+        xpath_source.relative_root = el
+        expected_values.append(tuple(xpath_source.iter()))
+
+    with open(xml_source, "rb") as f:
+        streaming_source = StreamingXPathSource(f, paths, "Event")
+        values = [tuple(source.iter()) for source in streaming_source.iter_sources()]
+    assert values == expected_values
+
+
+def test_xpath_source_document_order():
+    xml = io.BytesIO(
+        b"<a><b>1<c>2</c></b><b>3</b><c>4</c>"
+        b"<b>\n5\n</b>6<c x='7'/></a>"
+    )
+    xpath_source = XPathSource(xml, ["//c/@x", "//b/text()", "//c/text()", "//a/text()"])
+    assert [value for _, value in xpath_source.iter()] == [
+        "1",
+        "2",
+        "3",
+        "4",
+        "\n5\n",
+        "6",
+        "7",
+    ]
+
+
+def test_xpath_source_document_order_relative_root():
+    xml = io.BytesIO(
+        b"<a>" + b"".join(b"<b i='%d'><c/></b>" % i for i in range(12)) + b"</a>"
+    )
+    xpath_source = XPathSource(
+        xml, ["//b[@i='11']/@i", "./c", "./@i", "//b[@i='2']/@i"]
+    )
+    xpath_source.relative_root = xpath_source.get_elements("//b[@i='5']")[0]
+    assert list(xpath_source.iter()) == [
+        ("//b[@i='2']/@i", "2"),
+        ("./@i", "5"),
+        ("./c", None),
+        ("//b[@i='11']/@i", "11"),
+    ]
+
+
 @pytest.mark.parametrize(
     "expected_values",
     [
@@ -42,3 +111,54 @@ def test_jsonpath_source(expected_values, json_source):
         xpath_source = JsonPathSource(f, [p for p in paths])
     values = tuple(xpath_source.iter())
     assert values == expected_values
+
+
+@pytest.mark.parametrize("ndjson", [False, True])
+@pytest.mark.parametrize(
+    "paths", [("$..Event[?(@.@eventtype == Sample)]", "$..Dataelement_54_2.'#text'")]
+)
+def test_streaming_jsonpath_source(ndjson, paths, json_source):
+    with open(json_source, "r") as f:
+        expected_values = tuple(JsonPathSource(f, paths).iter())
+        f.seek(0)
+        record = json.load(f)
+
+    data = (
+        "\n".join(json.dumps(record) for _ in range(3))
+        if ndjson
+        else json.dumps([record] * 3, indent=2)
+    )
+    streaming_source = StreamingJsonPathSource(io.StringIO(data), paths, ndjson)
+    values = [tuple(source.iter()) for source in streaming_source.iter_sources()]
+    assert values == [expected_values] * 3
+
+
+def test_compile_path_cached():
+    path = "$..Dataelement_54_2.'#text'"
+    assert compile_path(path) is compile_path(path)
+
+
+def test_compile_paths_bounded():
+    compile_paths.cache_clear()
+    # namespaces come from the documents, relative roots of serve from requests
+    for i in range(XPATH_CACHE_SIZE + 10):
+        xpath_source = XPathSource(
+            io.BytesIO(f"<a xmlns='urn:{i}'><b/></a>".encode()), ["./ns:b"]
+        )
+        assert len(xpath_source.get_elements(f"//ns:b[{i} >= 0]")) == 1
+    assert compile_paths.cache_info().currsize == XPATH_CACHE_SIZE
+
+
+def test_jsonpath_source_document_order():
+    document = {"b": [{"x": i, "y": -i} for i in range(12)], "a": {"x": "last"}}
+    source = JsonPathSource(io.StringIO(json.dumps(document)), ["$..y", "$..x"])
+    assert [value for _, value in source.iter()] == [
+        value for i in range(12) for value in (i, -i)
+    ] + ["last"]
+
+
+def test_jsonpath_source_document_order_descendants():
+    # jsonpath_ng yields the matches of a level before the nested ones
+    document = {"a": {"b": 1, "c": {"b": 2}}, "b": 3}
+    source = JsonPathSource(io.StringIO(json.dumps(document)), ["$..b"])
+    assert [value for _, value in source.iter()] == [1, 2, 3]
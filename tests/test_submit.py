@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import shutil
+import sqlite3
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+from pyaml import yaml
+
+from flatehr.cli.submit import main as submit
+from flatehr.client import (
+    EhrResolver,
+    OpenEhrClient,
+    SubmissionError,
+    Submitter,
+    retry,
+)
+from flatehr.journal import Journal
+
+
+class StubEhrServer(ThreadingHTTPServer):
+    """Records posted compositions; the first failures requests are answered
+    with failure_status. EHRs are looked up and created by subject id."""
+
+    daemon_threads = True
+
+    def __init__(self, failures=0, failure_status=503):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.failures = failures
+        self.failure_status = failure_status
+        self.compositions = []
+        self.requests = 0
+        self.clients = set()
+        self.lock = threading.Lock()
+        self.ehrs = {}
+        self.external_refs = {}
+        self.ehr_lookups = 0
+        self.ehr_creations = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/ehrbase"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        query = parse_qs(urlsplit(self.path).query)
+        with server.lock:
+            server.ehr_lookups += 1
+            ehr_id = server.ehrs.get(query["subject_id"][0])
+        if query["subject_id"][0] == "malformed":
+            self._respond(200, {"ehr_id": None})
+        elif ehr_id:
+            self._respond(200, {"ehr_id": {"value": ehr_id}})
+        else:
+            self._respond(404, {})
+
+    def do_POST(self):
+        server = self.server
+        url = urlsplit(self.path)
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if url.path.endswith("/openehr/v1/ehr"):
+            subject_id = body["subject"]["external_ref"]["id"]["value"]
+            with server.lock:
+                server.external_refs[subject_id] = body["subject"]["external_ref"]
+                server.ehr_creations += 1
+                ehr_id = server.ehrs[subject_id] = str(uuid.uuid4())
+            self._respond(201, {"ehr_id": {"value": ehr_id}})
+            return
+
+        with server.lock:
+            server.requests += 1
+            server.clients.add(self.client_address)
+            failed = server.requests <= server.failures
+            if not failed:
+                server.compositions.append((url.path, parse_qs(url.query), body))
+        self._respond(server.failure_status if failed else 201, {})
+
+    def _respond(self, status, body):
+        response = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        ...
+
+
+@pytest.fixture
+def stub_server(request):
+    server = StubEhrServer(*getattr(request, "param", ()))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def sources(tmp_path):
+    for i in range(3):
+        shutil.copy("tests/resources/source.xml", tmp_path / f"source_{i}.xml")
+    return tmp_path
+
+
+def _submit(sources, stub_server, conf_file="tests/resources/xml_conf.yaml", **kwargs):
+    submit(
+        str(sources / "*.xml"),
+        template_file="tests/resources/web_template.json",
+        conf_file=conf_file,
+        url=stub_server.url,
+        template_id="test",
+        relative_root="Event",
+        backoff=0,
+        **kwargs,
+    )
+
+
+def test_submit(sources, stub_server):
+    _submit(sources, stub_server, concurrency=2)
+
+    # source.xml has 8 events
+    assert len(stub_server.compositions) == 24
+    path, params, composition = stub_server.compositions[0]
+    assert path == "/ehrbase/rest/ecis/v1/composition"
+    assert params["format"] == ["FLAT"]
+    assert params["templateId"] == ["test"]
+    assert params["ehrId"]
+    assert composition
+    # connections are kept alive
+    assert len(stub_server.clients) <= 2
+
+
+@pytest.mark.parametrize("stub_server", [(2, 503)], indirect=True)
+def test_submit_retries(sources, stub_server, tmp_path):
+    failure_log = tmp_path / "failures.ndjson"
+    _submit(sources, stub_server, concurrency=1, failure_log=str(failure_log))
+
+    assert len(stub_server.compositions) == 24
+    assert stub_server.requests == 26
+    assert not failure_log.exists() or not failure_log.read_text()
+
+
+@pytest.mark.parametrize("stub_server", [(1, 400)], indirect=True)
+def test_submit_failure_log(sources, stub_server, tmp_path):
+    failure_log = tmp_path / "failures.ndjson"
+    _submit(sources, stub_server, concurrency=1, failure_log=str(failure_log))
+
+    assert len(stub_server.compositions) == 23
+    assert stub_server.requests == 24
+    failures = [json.loads(line) for line in failure_log.read_text().splitlines()]
+    assert len(failures) == 1
+    assert failures[0]["status"] == 400
+    assert failures[0]["source"].endswith("source_0.xml")
+    assert failures[0]["composition"]
+
+
+def test_submit_checkpoint(sources, stub_server, tmp_path):
+    checkpoint_file = tmp_path / "checkpoint.txt"
+    checkpoint_file.write_text(f"{sources / 'source_0.xml'}\n")
+
+    _submit(sources, stub_server, checkpoint_file=str(checkpoint_file))
+    assert len(stub_server.compositions) == 16
+    assert sorted(checkpoint_file.read_text().splitlines()) == [
+        str(sources / f"source_{i}.xml") for i in range(3)
+    ]
+
+    _submit(sources, stub_server, checkpoint_file=str(checkpoint_file))
+    assert len(stub_server.compositions) == 16
+
+
+@pytest.mark.parametrize("stub_server", [(1, 400)], indirect=True)
+def test_submit_journal(sources, stub_server, tmp_path):
+    journal_file = tmp_path / "journal.sqlite"
+    _submit(sources, stub_server, concurrency=1, journal_file=str(journal_file))
+    assert len(stub_server.compositions) == 23
+
+    # only the failed composition is submitted again
+    _submit(sources, stub_server, concurrency=1, journal_file=str(journal_file))
+    assert len(stub_server.compositions) == 24
+
+    _submit(sources, stub_server, concurrency=1, journal_file=str(journal_file))
+    assert len(stub_server.compositions) == 24
+
+    # changed files are processed again, but unchanged compositions are skipped
+    source = sources / "source_2.xml"
+    source.write_text(source.read_text() + "\n<!-- changed -->\n")
+    _submit(
+        sources,
+        stub_server,
+        journal_file=str(journal_file),
+        only_changed=True,
+    )
+    assert len(stub_server.compositions) == 24
+    source.write_text(source.read_text().replace(">male<", ">female<"))
+    _submit(
+        sources,
+        stub_server,
+        journal_file=str(journal_file),
+        only_changed=True,
+    )
+    assert len(stub_server.compositions) == 32
+
+
+def test_journal_record_committed(tmp_path):
+    # a submitted composition is committed at once, so that it is not posted
+    # again after the process is killed
+    journal = Journal(str(tmp_path / "journal.sqlite"), "conf", "template")
+    journal.record("source", 0, "hash")
+    other = Journal(str(tmp_path / "journal.sqlite"), "conf", "template")
+    assert other.is_done("source", 0, "hash")
+    other.close()
+    journal.close()
+
+
+def test_submitter_connection_error(tmp_path):
+    failure_log = tmp_path / "failures.ndjson"
+    with open(failure_log, "w") as f_obj:
+        # nothing listens on port 1
+        submitter = Submitter(
+            OpenEhrClient("http://127.0.0.1:1", timeout=1),
+            "test",
+            concurrency=1,
+            retries=1,
+            backoff=0,
+            failure_log=f_obj,
+        )
+        submitter.submit("source", "ehr", {"path": "value"})
+        submitter.end_source("source")
+        submitter.close()
+    assert submitter.failed == 1
+    failure = json.loads(failure_log.read_text())
+    assert failure["status"] is None
+    assert failure["ehr_id"] == "ehr"
+
+
+def test_submitter_unexpected_error(stub_server, tmp_path):
+    journal = Journal(str(tmp_path / "journal.sqlite"), "conf", "template")
+    # recording a unit fails
+    journal.close()
+    submitter = Submitter(
+        OpenEhrClient(stub_server.url),
+        "test",
+        concurrency=1,
+        queue_size=1,
+        journal=journal,
+    )
+    errors = []
+
+    def produce():
+        try:
+            for i in range(20):
+                submitter.submit("source", "ehr", {"path": "value"}, (i, "hash"))
+            submitter.end_source("source")
+        except sqlite3.ProgrammingError as ex:
+            errors.append(ex)
+        with pytest.raises(sqlite3.ProgrammingError):
+            submitter.close()
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    producer.join(10)
+    # the producer is not blocked on the full queue
+    assert not producer.is_alive()
+    assert errors
+
+
+def test_retry_invalid_retries():
+    with pytest.raises(ValueError):
+        retry(lambda: None, -1, 0)
+
+
+def test_submission_error():
+    assert str(SubmissionError(503, "unavailable")) == "503: unavailable"
+
+
+def test_submit_resolve_ehr_id(sources, stub_server, tmp_path):
+    conf = yaml.safe_load(open("tests/resources/xml_conf.yaml"))
+    conf["ehr_id"]["value"] = "patient-1"
+    conf_file = tmp_path / "conf.yaml"
+    conf_file.write_text(yaml.safe_dump(conf))
+    ehr_cache_file = tmp_path / "ehr.sqlite"
+
+    for _ in range(2):
+        _submit(
+            sources,
+            stub_server,
+            conf_file=str(conf_file),
+            subject_namespace="test",
+            subject_scheme="patient_id",
+            batch_size=5,
+            ehr_cache_file=str(ehr_cache_file),
+        )
+
+    assert len(stub_server.compositions) == 48
+    assert {params["ehrId"][0] for _, params, _ in stub_server.compositions} == {
+        stub_server.ehrs["patient-1"]
+    }
+    assert stub_server.external_refs["patient-1"]["id"]["scheme"] == "patient_id"
+    # the second run reads the ehr id from the cache file
+    assert stub_server.ehr_lookups == 1
+    assert stub_server.ehr_creations == 1
+
+
+def test_ehr_resolver(stub_server):
+    stub_server.ehrs["existing"] = "ehr-0"
+    resolver = EhrResolver(OpenEhrClient(stub_server.url), "test", cache_size=2)
+
+    ehr_ids, errors = resolver.resolve(["existing", "new", "existing", "new"])
+    assert not errors
+    assert ehr_ids == {"existing": "ehr-0", "new": stub_server.ehrs["new"]}
+    assert stub_server.ehr_lookups == 2
+    assert stub_server.ehr_creations == 1
+
+    # cached
+    assert resolver.resolve(["existing", "new"])[0] == ehr_ids
+    assert stub_server.ehr_lookups == 2
+
+    # "existing" is evicted, the least recently used
+    resolver.resolve(["other"])
+    resolver.resolve(["existing"])
+    assert stub_server.ehr_lookups == 4
+    resolver.close()
+
+
+def test_ehr_resolver_errors():
+    resolver = EhrResolver(
+        OpenEhrClient("http://127.0.0.1:1", timeout=1), "test", retries=0
+    )
+    ehr_ids, errors = resolver.resolve(["subject"])
+    assert not ehr_ids
+    assert errors["subject"].status is None
+    resolver.close()
+
+
+def test_ehr_resolver_unexpected_response(stub_server):
+    resolver = EhrResolver(OpenEhrClient(stub_server.url), "test", retries=0)
+    ehr_ids, errors = resolver.resolve(["malformed", "new"])
+    assert ehr_ids == {"new": stub_server.ehrs["new"]}
+    assert errors["malformed"].message.startswith("TypeError")
+    resolver.close()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import gc
+import io
+
+import pytest
+from lxml import etree
+
+from flatehr.build import _get_suffix_env, compile_suffixes, date_isoformat
+
+SMART_STRING = etree.parse(io.BytesIO(b"<a>test</a>")).xpath("/a/text()")[0]
+VALUE_MAP = {"test": "IT", "le test": "FR", "10": "ten", 10: 10, "none": None}
+
+
+def _render(render):
+    try:
+        return render()
+    except Exception as ex:
+        return type(ex)
+
+
+@pytest.mark.parametrize(
+    "template",
+    [
+        "{{ maps_to[0] }}",
+        "{{maps_to[1]}}",
+        "{{ value_map[maps_to[0]]  }}",
+        "{{ value_map[ maps_to[1] ] }}",
+        "{{ date_isoformat(maps_to[0]) }}",
+        "ISO_3166-1",
+        "constant\n",
+        "",
+        "P{{ maps_to[0] }}Y",
+        "{{ maps_to[0] | upper }}",
+    ],
+)
+@pytest.mark.parametrize(
+    "maps_to",
+    [
+        [],
+        ["test"],
+        ["le test", "test"],
+        [SMART_STRING],
+        ["items"],
+        ["none"],
+        [10],
+        [1.5],
+        [None],
+        [True],
+        [["unhashable"]],
+        ["2021-05-01"],
+        ["2021-05-01T10:11:12+02:00", "10"],
+        ["not a date"],
+    ],
+)
+def test_fast_path_matches_jinja(template, maps_to):
+    (compiled,) = compile_suffixes({"": template}, _get_suffix_env({}))
+    expected = _render(
+        lambda: compiled.template.render(maps_to=maps_to, value_map=VALUE_MAP)
+    )
+    assert _render(lambda: compiled.render(maps_to, VALUE_MAP)) == expected
+
+
+@pytest.mark.parametrize(
+    "template", ["{{ maps_to[0] }}", "{{ value_map[maps_to[0]] }}", "constant"]
+)
+def test_fast_path_detected(template):
+    (compiled,) = compile_suffixes({"": template}, _get_suffix_env({}))
+    assert compiled.fast_path is not None
+
+
+def test_date_isoformat_udf():
+    (compiled,) = compile_suffixes(
+        {"": "{{ date_isoformat(maps_to[0]) }}"},
+        _get_suffix_env({"date_isoformat": lambda date: f"udf {date}"}),
+    )
+    assert compiled.render(["2021-05-01"], {}) == "udf 2021-05-01"
+
+
+def test_date_isoformat_cached():
+    date_isoformat.cache_clear()
+    for _ in range(3):
+        assert date_isoformat("2021-05-01") == "2021-05-01T00:00:00"
+    cache_info = date_isoformat.cache_info()
+    assert (cache_info.misses, cache_info.hits) == (1, 2)
+
+
+def test_date_isoformat_cache_releases_source():
+    date = etree.parse(io.BytesIO(b"<date>2021-05-01</date>")).xpath("/date/text()")[0]
+    (compiled,) = compile_suffixes(
+        {"": "{{ date_isoformat(maps_to[0]) }}"}, _get_suffix_env({})
+    )
+    assert compiled.render([date], {}) == "2021-05-01T00:00:00"
+    del date
+    gc.collect()
+    # the smart string (and so its document) is not kept by the cache
+    assert not any(
+        isinstance(obj, etree._ElementUnicodeResult) and obj.getparent().tag == "date"
+        for obj in gc.get_objects()
+    )
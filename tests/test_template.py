@@ -116,3 +116,20 @@ def test_attrs(template_node, expected_attrs):
 def test_conf_skeleton(template, expected_conf_skeleton):
     conf_skeleton = template.get_conf_skeleton()
     assert conf_skeleton == expected_conf_skeleton
+
+
+@pytest.mark.parametrize("backend", template_factory.backends())
+@pytest.mark.parametrize("web_template_path", ["./tests/resources/web_template.json"])
+@pytest.mark.parametrize(
+    "path,relative_path",
+    [
+        ("test", "."),
+        ("test/context/", "context"),
+        (
+            "test/histopathology/result_group/laboratory_test_result/any_event:3/test_name",
+            "histopathology/result_group/laboratory_test_result/any_event/test_name",
+        ),
+    ],
+)
+def test_getitem(template, path, relative_path):
+    assert template[path] is template.root.get(relative_path)